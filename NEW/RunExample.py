@@ -1,6 +1,4 @@
-import numpy as np
-import matplotlib.pyplot as plt
-from scipy.io import loadmat
+from mat_loader import load_mat_cube, mat_variables
 from cube_inspector import CubeInspector
 from cube_inspector import calculate_false_color_images
  
@@ -9,12 +7,13 @@ def main():
     # Load .mat file
     mat_file_path = r'C:\Users\suraf\NEW\indian_pines.mat'
 
-    data = loadmat(mat_file_path)
+    variables = mat_variables(mat_file_path)
     
-    print("Keys in the .mat file:", data.keys())
+    print("Keys in the .mat file:", variables)
     
-    if 'indian_pines' in data:
-        hyperspectral_data = data['indian_pines']
+    if 'indian_pines' in variables:
+        # Opened lazily for MATLAB v7.3 files.
+        hyperspectral_data = load_mat_cube(mat_file_path, 'indian_pines')
         print("Hyperspectral data loaded successfully.")
         
         print("Type of hyperspectral_data:", type(hyperspectral_data))
@@ -32,8 +31,6 @@ def main():
     else:
     
         print("Key 'indian_pines' not found in the .mat file.")
-        hyperspectral_data = data['wavelengths']
-        print(hyperspectral_data)
 
 if __name__ == "__main__":
     main()
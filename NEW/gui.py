@@ -1,23 +1,43 @@
 import tkinter as tk
-from camera_interface import CameraInterface
-import numpy as np
+from tkinter import ttk
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
-from scipy.io import loadmat
+from mat_loader import load_mat_cube, mat_variables
 from cube_inspector import CubeInspector
 from cube_inspector import calculate_false_color_images
 import logging
 
+# How often finished background jobs are checked for, in milliseconds.
+POLL_INTERVAL_MS = 100
+
+
+def _init_camera():
+    # Imported here so that the GUI starts even where the camera library is missing.
+    from camera_interface import CameraInterface
+    return CameraInterface()
+
+
 class App:
     def __init__(self, root):
         self.root = root
         self.root.title("GUI App")
 
-        # Create CameraInterface instance
-        self.camera_interface = CameraInterface()
+        # Slow jobs (camera warm-up and capture, cube loading) run in these threads so
+        # that the window stays responsive. Tk and matplotlib are only touched from
+        # the main thread, which polls the jobs with root.after().
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.jobs = []
 
         # Create CubeInspector instance
         self.cube_inspector = None
 
+        # The cube and its false color images are loaded once for the lifetime of the GUI.
+        self.cube = None
+        self.false_color_images = None
+
+        # Do not block the Tk main loop when showing the inspector.
+        plt.ion()
+
         # Create GUI buttons
         self.capture_btn = tk.Button(root, text="Capture Image", command=self.capture_image)
         self.capture_btn.pack()
@@ -25,33 +45,119 @@ class App:
         self.display_cube_btn = tk.Button(root, text="Display Cube", command=self.display_cube)
         self.display_cube_btn.pack()
 
-       
+        self.status = tk.StringVar(value="Ready")
+        tk.Label(root, textvariable=self.status).pack()
+        self.progress = ttk.Progressbar(root, mode='indeterminate', length=200)
+        self.progress.pack()
+
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+        # The camera warms up in the background. Capturing waits for it.
+        self.camera_future = self.run_job(_init_camera, "Initializing camera...", self.camera_ready,
+                                          self.capture_btn)
+
+    def run_job(self, job, message, on_done, button=None):
+        """Run job in the background and call on_done(result) in the main thread when it finishes.
+
+        The button, if given, is disabled while the job runs.
+        """
+
+        if button is not None:
+            button.config(state=tk.DISABLED)
+        future = self.executor.submit(job)
+        self.jobs.append((future, message, on_done, button))
+        if len(self.jobs) == 1:
+            self.progress.start()
+            self.root.after(POLL_INTERVAL_MS, self.poll_jobs)
+        self.status.set(message)
+        return future
+
+    def poll_jobs(self):
+        """Deliver finished jobs and keep polling while any are running."""
+
+        running = []
+        for job in self.jobs:
+            future, message, on_done, button = job
+            if not future.done():
+                running.append(job)
+                continue
+            if button is not None:
+                button.config(state=tk.NORMAL)
+            try:
+                result = future.result()
+            except Exception as e:
+                logging.error(f"{message} failed: {e}")
+                self.status.set(f"{message} failed: {e}")
+                continue
+            on_done(result)
+        self.jobs = running
+        if self.jobs:
+            self.status.set(self.jobs[-1][1])
+            self.root.after(POLL_INTERVAL_MS, self.poll_jobs)
+        else:
+            self.progress.stop()
+
+    def camera_ready(self, camera):
+        self.status.set("Camera ready")
 
     def capture_image(self):
-        self.camera_interface.turn_on()
-        self.camera_interface.capture_image('captured_image.jpg')
-        self.camera_interface.turn_off()
+        def job():
+            camera = self.camera_future.result()
+            camera.turn_on()
+            camera.capture_image('captured_image.jpg')
+            camera.turn_off()
+
+        self.run_job(job, "Capturing image...", self.image_captured, self.capture_btn)
+
+    def image_captured(self, _):
         logging.info("Image captured and saved")
+        self.status.set("Image captured and saved")
 
     def display_cube(self):
-        mat_file_path = 'indian_pines.mat'
-        data = loadmat(mat_file_path)
-        if 'indian_pines' in data:
-            hyperspectral_data = data['indian_pines']
-            spectral_blue = 38  
-            spectral_green = 29  
+        if self.cube is not None:
+            self.show_cube()
+            return
+
+        def job():
+            mat_file_path = 'indian_pines.mat'
+            if 'indian_pines' not in mat_variables(mat_file_path):
+                raise KeyError("Key 'indian_pines' not found in the .mat file.")
+            # Opened lazily for MATLAB v7.3 files.
+            cube = load_mat_cube(mat_file_path, 'indian_pines')
+            spectral_blue = 38
+            spectral_green = 29
             spectral_red = 89
-            false_color_images = calculate_false_color_images([hyperspectral_data], spectral_blue, spectral_green, spectral_red)
-            self.cube_inspector = CubeInspector(org=hyperspectral_data)
-            self.cube_inspector.false_color_images = false_color_images
-            self.cube_inspector.show()
-        else:
-            logging.error("Key 'indian_pines' not found in the .mat file.")
+            false_color_images = calculate_false_color_images([cube], spectral_blue, spectral_green, spectral_red)
+            return cube, false_color_images
+
+        self.run_job(job, "Loading cube...", self.cube_loaded, self.display_cube_btn)
+
+    def cube_loaded(self, result):
+        self.cube, self.false_color_images = result
+        self.status.set("Cube loaded")
+        self.show_cube()
+
+    def show_cube(self):
+        # A new inspector only if there is none or its window was closed.
+        if self.cube_inspector is None or not self.cube_inspector.plot_inited:
+            self.cube_inspector = CubeInspector(org=self.cube)
+            self.cube_inspector.false_color_images = self.false_color_images
+        self.cube_inspector.show()
+
+    def close(self):
+        """Stop background jobs, release the camera, and close the window."""
+
+        for future, _, _, _ in self.jobs:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        camera_future = self.camera_future
+        if camera_future.done() and not camera_future.cancelled() and camera_future.exception() is None:
+            camera_future.result().close()
+        self.root.destroy()
 
-   
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     root = tk.Tk()
     app = App(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
@@ -0,0 +1,120 @@
+"""
+
+Loading of hyperspectral cubes from MATLAB .mat files.
+
+MATLAB v7.3 files are HDF5 files. Their variables are opened lazily through
+h5py, so only the parts that are shown are read, in the file's own chunks.
+Older files cannot be read partially, so they are loaded with
+scipy.io.loadmat, which reads only the requested variable. Optionally, such a
+cube is converted once into a .npy file in a cache directory and memory
+mapped from there on later runs.
+
+Loaded cubes are cached for the lifetime of the program, so showing the same
+cube again costs nothing. The cache notices if the file changes on disk.
+
+"""
+
+import logging
+import os
+import sys
+
+import numpy as np
+from scipy.io import loadmat, whosmat
+
+# The main program is not installed as a package.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from analysis.cube_accessor import CubeAccessor, HDF5CubeAccessor, NumpyCubeAccessor, _is_hdf5
+
+# Open cubes keyed by (absolute path, variable name).
+_cache = {}
+
+
+def is_v73(path) -> bool:
+    """True if the .mat file is a MATLAB v7.3 (HDF5) file."""
+
+    return _is_hdf5(path)
+
+
+def mat_variables(path) -> list:
+    """Names of the variables in a .mat file without loading them."""
+
+    if is_v73(path):
+        import h5py
+        with h5py.File(path, 'r') as f:
+            return [name for name in f.keys() if not name.startswith('#')]
+    return [name for name, _, _ in whosmat(path)]
+
+
+def _npy_cache_path(path, key, cache_dir) -> str:
+    base = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{base}_{key}.npy")
+
+
+def _load_v5(path, key, cache_dir) -> CubeAccessor:
+    if cache_dir is not None:
+        npy_path = _npy_cache_path(path, key, cache_dir)
+        if os.path.exists(npy_path) and os.path.getmtime(npy_path) >= os.path.getmtime(path):
+            logging.info(f"Memory mapping cube '{key}' from '{npy_path}'.")
+            return NumpyCubeAccessor(np.load(npy_path, mmap_mode='r'))
+
+    variables = loadmat(path, variable_names=[key])
+    if key not in variables:
+        raise KeyError(f"Variable '{key}' not found in '{path}'. Variables are {mat_variables(path)}.")
+    cube = variables[key]
+    if cube.ndim != 3:
+        raise ValueError(f"Variable '{key}' in '{path}' is not a cube but has shape {cube.shape}.")
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(npy_path, cube)
+        logging.info(f"Converted cube '{key}' to '{npy_path}' for memory mapping.")
+        return NumpyCubeAccessor(np.load(npy_path, mmap_mode='r'))
+    return NumpyCubeAccessor(cube)
+
+
+def load_mat_cube(path, key=None, cache_dir=None) -> CubeAccessor:
+    """
+    Open a cube stored in a .mat file.
+
+    Parameters:
+    path (str): Path of the .mat file.
+    key (str): Name of the cube variable. The largest three-dimensional variable is used if not given.
+    cache_dir (str): If given, cubes of pre v7.3 files are converted into .npy files in this directory
+        and memory mapped instead of being loaded into memory on later runs.
+
+    Returns:
+    CubeAccessor: The cube in (height x width x spectral bands) order. Accepted by CubeInspector and
+        the calculate functions of cube_inspector. Do not close it, as it is shared through the cache.
+    """
+
+    abs_path = os.path.abspath(path)
+    mtime = os.path.getmtime(abs_path)
+    cache_key = (abs_path, key)
+    cached = _cache.get(cache_key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    if is_v73(abs_path):
+        logging.info(f"Opening MATLAB v7.3 file '{abs_path}' lazily.")
+        cube = HDF5CubeAccessor(abs_path, key=key)
+    else:
+        if key is None:
+            cubes = [(np.prod(shape), name) for name, shape, _ in whosmat(abs_path) if len(shape) == 3]
+            if not cubes:
+                raise ValueError(f"No three-dimensional variables in '{abs_path}'.")
+            key = max(cubes)[1]
+        cube = _load_v5(abs_path, key, cache_dir)
+
+    if cached is not None:
+        cached[1].close()
+    _cache[cache_key] = (mtime, cube)
+    return cube
+
+
+def clear_cache():
+    """Close and forget all cached cubes."""
+
+    for _, cube in _cache.values():
+        cube.close()
+    _cache.clear()
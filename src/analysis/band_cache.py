@@ -0,0 +1,148 @@
+"""
+
+Band-major copy of a cube for fast band images.
+
+Cubes are stored as (scan_index, y, x), so the image of a single band is a
+strided gather over the whole cube. BandMajorCache makes a contiguous
+(x, scan_index, y) copy once, after which a band image is a plain slice.
+Per-band minimum, maximum, and percentiles are computed during the build, so
+showing a band needs no passes over the data either.
+
+The copy is kept in memory or, for big cubes, in a memory mapped .npy file.
+It can be built in a background thread. Until the build is ready, band() and
+band_limits() fall back to the original cube.
+
+"""
+
+import logging
+import os
+import threading
+import numpy as np
+
+from core import properties as P
+from analysis.cube_accessor import cube_values
+
+
+class BandMajorCache:
+    """Band-major (x, scan_index, y) copy of a cube with per-band statistics."""
+
+    def __init__(self, data, path=None, percentiles=P.band_cache_percentiles):
+        """Create a cache for a cube. Call build() or start() to build it.
+
+        Parameters
+        ----------
+            data : DataArray, numpy array, or CubeAccessor
+                Cube with dimensions (scan_index, y, x), or (row, column, band)
+                for other sources than xarray. See analysis.cube_accessor.
+            path : str, optional
+                If given, the copy is a memory mapped .npy file in this path.
+                Otherwise it is kept in memory.
+            percentiles : tuple of two floats
+                Lower and upper percentiles computed for each band.
+        """
+
+        self._source = cube_values(data)
+        self.shape = tuple(data.shape)
+        self.path = path
+        self.percentiles = percentiles
+        self._bands = None
+        self.band_min = None
+        self.band_max = None
+        self.band_percentiles = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self):
+        """Build the cache in a background thread."""
+
+        if self.ready or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self.build, name='BandMajorCache', daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout=None) -> bool:
+        """Wait until the cache is built. Returns True if it is ready."""
+
+        return self._ready.wait(timeout)
+
+    def build(self):
+        """Build the band-major copy and the per-band statistics."""
+
+        if self.ready:
+            return
+        scans, h, w = self.shape
+        values = self._source
+        if self.path is not None:
+            bands = np.lib.format.open_memmap(self.path, mode='w+', dtype=values.dtype, shape=(w, scans, h))
+        else:
+            bands = np.empty((w, scans, h), dtype=values.dtype)
+
+        # Copy in chunks of scan lines, which are contiguous in the source.
+        chunk = max(1, P.band_cache_chunk_bytes // max(1, h * w * values.dtype.itemsize))
+        for start in range(0, scans, chunk):
+            stop = min(scans, start + chunk)
+            bands[:, start:stop, :] = values[start:stop].transpose(2, 0, 1)
+
+        band_min = np.empty(w, dtype=np.float64)
+        band_max = np.empty(w, dtype=np.float64)
+        band_percentiles = np.empty((w, 2), dtype=np.float64)
+        # Percentiles from a sparse sample keep the build fast.
+        sample_step = max(1, -(-(scans * h) // P.band_cache_percentile_samples))
+        chunk = max(1, P.band_cache_chunk_bytes // max(1, scans * h * values.dtype.itemsize))
+        for start in range(0, w, chunk):
+            stop = min(w, start + chunk)
+            flat = bands[start:stop].reshape(stop - start, -1)
+            band_min[start:stop] = flat.min(axis=1)
+            band_max[start:stop] = flat.max(axis=1)
+            band_percentiles[start:stop] = np.percentile(flat[:, ::sample_step], self.percentiles, axis=1).T
+
+        if self.path is not None:
+            bands.flush()
+        self._bands = bands
+        self.band_min = band_min
+        self.band_max = band_max
+        self.band_percentiles = band_percentiles
+        self._ready.set()
+        logging.info(f"Band-major cache of shape {bands.shape} ready.")
+
+    def band(self, index:int) -> np.ndarray:
+        """Image (scan_index, y) of a band."""
+
+        if self.ready:
+            return self._bands[index]
+        return np.asarray(self._source[:, :, index])
+
+    def band_limits(self, index:int, robust=False):
+        """Value range of a band as (low, high).
+
+        Parameters
+        ----------
+            robust : bool, default False
+                If True, the percentiles are returned instead of minimum and maximum.
+        """
+
+        if self.ready:
+            if robust:
+                return tuple(self.band_percentiles[index])
+            return self.band_min[index], self.band_max[index]
+        image = self.band(index)
+        if robust:
+            return tuple(np.percentile(image, self.percentiles))
+        return float(np.min(image)), float(np.max(image))
+
+    def close(self):
+        """Release the copy. A memory mapped file is removed."""
+
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+        self._bands = None
+        self._ready.clear()
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logging.warning(f"Could not remove band cache file '{self.path}': {e}")
@@ -0,0 +1,138 @@
+"""
+
+Prefix-sum (cumulative sum along the band axis) index of a cube.
+
+With S[k] being the sum of bands 0..k-1 of every pixel, the sum over any band
+range [start, stop) is S[stop] - S[start] for all pixels at once. Building the
+index costs one pass over the cube, after which the mean of any band range,
+e.g. a colour channel of a false colour image, takes two slices and a
+subtraction regardless of the range width. Sums of squares can be added with
+add_squares(), which gives pixel norms and variances of any band range the
+same way.
+
+The index is stored band-major (band, scan_index, y) so that the slices are
+contiguous. Sums are accumulated and stored in float64. A range sum is the
+difference of two prefix sums, so its rounding error is relative to the
+prefix sum at the end of the range, not to the range itself. With float32
+storage a narrow range at high band indices of a cube with a wide value
+range would lose most of its digits, e.g. a single band out of a thousand to
+about 1e-3 relative, which shows in false colour images, band math, and
+spectral similarity. float64 keeps such ranges accurate to about 1e-12.
+
+"""
+
+import logging
+import numpy as np
+
+from core import properties as P
+from analysis.cube_accessor import cube_values
+
+
+class PrefixSumIndex:
+    """Cumulative sums of a cube along the band axis."""
+
+    def __init__(self, data, dtype=np.float64):
+        """Build the index of a cube.
+
+        Parameters
+        ----------
+            data : DataArray, numpy array, or CubeAccessor
+                Cube with dimensions (scan_index, y, x), x being the band axis.
+                See analysis.cube_accessor for other sources.
+            dtype : numpy dtype, default float64
+                Storage type of the sums. float32 halves the memory, but narrow band
+                ranges then lose precision as explained in the module docstring.
+        """
+
+        values = cube_values(data)
+        scans, h, w = values.shape
+        self.band_count = w
+        self.shape = (scans, h)
+        self.dtype = dtype
+        self._values = values
+        self._sums = self._prefix_sums(values, squared=False)
+        self._square_sums = None
+        logging.info(f"Prefix-sum index of {w} bands built.")
+
+    def _prefix_sums(self, values, squared):
+        scans, h, w = values.shape
+        sums = np.empty((w + 1, scans, h), dtype=self.dtype)
+        sums[0] = 0
+        # Accumulate in chunks of scan lines to keep the float64 temporaries small.
+        chunk = max(1, P.band_cache_chunk_bytes // max(1, h * w * 8))
+        for start in range(0, scans, chunk):
+            stop = min(scans, start + chunk)
+            block = values[start:stop].astype(np.float64)
+            if squared:
+                np.multiply(block, block, out=block)
+            sums[1:, start:stop, :] = np.cumsum(block, axis=2).transpose(2, 0, 1)
+        return sums
+
+    @property
+    def has_squares(self) -> bool:
+        return self._square_sums is not None
+
+    def add_squares(self):
+        """Build the prefix sums of squared values if not built yet."""
+
+        if self._square_sums is None:
+            self._square_sums = self._prefix_sums(self._values, squared=True)
+            logging.info(f"Prefix sums of squares of {self.band_count} bands built.")
+
+    def clip_range(self, start:int, stop:int):
+        """Band range clipped to the cube. An empty range is widened to one band."""
+
+        start = int(np.clip(start, 0, self.band_count - 1))
+        stop = int(np.clip(stop, start + 1, self.band_count))
+        return start, stop
+
+    def band_sum(self, start:int, stop:int) -> np.ndarray:
+        """Sum of bands [start, stop) of every pixel as a (scan_index, y) array."""
+
+        start, stop = self.clip_range(start, stop)
+        return self._sums[stop] - self._sums[start]
+
+    def band_mean(self, start:int, stop:int) -> np.ndarray:
+        """Mean of bands [start, stop) of every pixel as a (scan_index, y) array."""
+
+        start, stop = self.clip_range(start, stop)
+        return (self._sums[stop] - self._sums[start]) / (stop - start)
+
+    def square_sum(self, start:int, stop:int, region=(slice(None), slice(None))) -> np.ndarray:
+        """Sum of squares of bands [start, stop) of every pixel in region.
+
+        Parameters
+        ----------
+            region : tuple of two slices
+                Region (scan_index, y) of the pixels. Whole image by default.
+        """
+
+        self.add_squares()
+        start, stop = self.clip_range(start, stop)
+        return self._square_sums[stop][region] - self._square_sums[start][region]
+
+    def region_sum(self, start:int, stop:int, region=(slice(None), slice(None))) -> np.ndarray:
+        """Sum of bands [start, stop) of every pixel in region (scan_index, y)."""
+
+        start, stop = self.clip_range(start, stop)
+        return self._sums[stop][region] - self._sums[start][region]
+
+    def band_means(self, ranges) -> np.ndarray:
+        """Means of several band ranges stacked along the last axis.
+
+        Parameters
+        ----------
+            ranges : list of (start, stop) tuples or slices
+
+        Returns
+        -------
+            numpy array
+                Array of shape (scan_index, y, len(ranges)).
+        """
+
+        means = np.empty(self.shape + (len(ranges),), dtype=np.float64)
+        for i, r in enumerate(ranges):
+            if isinstance(r, slice):
+                r = (r.start, r.stop)
+            means[..., i] = self.band_mean(*r)
+        return means
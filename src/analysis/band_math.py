@@ -0,0 +1,293 @@
+"""
+
+Band math: spectral index images from formulas over band ranges.
+
+An index is written as an arithmetic expression, e.g. a normalized difference
+
+    (b[800:820] - b[660:680]) / (b[800:820] + b[660:680])
+
+where b[start:stop] is the mean of bands [start, stop) of each pixel and b[i]
+a single band. w[low:high] is the mean of the bands whose x coordinate (e.g.
+wavelength) is between low and high, and w[value] the band nearest to value.
+Numbers, + - * / **, parentheses, and the functions abs, sqrt, log, exp, min,
+and max are allowed. Expressions may refer to other named indices by name.
+
+Expressions are parsed with Python's ast module and only the nodes listed
+above are accepted, so nothing is ever executed. Band range means come from
+a prefix-sum index (see PrefixSumIndex), so any range costs two subtractions
+per pixel. The image is evaluated in blocks of scan lines. Within a block,
+each operation writes into a buffer of an earlier operation that is not
+needed anymore, so the temporaries take only a few block-sized buffers and
+results go straight into a preallocated output image.
+
+Named indices are given in the control file of a session:
+
+    [band_indices]
+        ndvi = "(w[800:820] - w[660:680]) / (w[800:820] + w[660:680])"
+
+"""
+
+import ast
+import logging
+import numpy as np
+
+from core import properties as P
+from analysis.band_index import PrefixSumIndex
+from analysis.cube_accessor import open_cube
+
+# Allowed functions and the ufuncs implementing them.
+FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'exp': np.exp, 'min': np.minimum, 'max': np.maximum}
+
+_BINARY = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide, ast.Pow: np.power}
+_UNARY = {ast.USub: np.negative, ast.UAdd: np.positive}
+
+# Names of band variables. b is indexed by band, w by the x coordinate.
+BAND = 'b'
+COORDINATE = 'w'
+
+
+def _number(node) -> float:
+    """Value of a number node, possibly negated. Raises ValueError for other nodes."""
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _number(node.operand)
+        return -value if isinstance(node.op, ast.USub) else value
+    # Python 3.7 parses numbers as ast.Num and later versions as ast.Constant.
+    if isinstance(node, getattr(ast, 'Num', ())) and not isinstance(node, ast.Constant):
+        return node.n
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    raise ValueError(f"Expected a number, got '{_source(node)}'.")
+
+
+def _source(node) -> str:
+    try:
+        return ast.unparse(node)
+    except AttributeError:
+        # Python < 3.9
+        return type(node).__name__
+
+
+class BandMath:
+    """Evaluates band math expressions over a cube."""
+
+    def __init__(self, data, viewable=None, index:PrefixSumIndex=None, use_index=True, named=None):
+        """Create an engine for a cube.
+
+        Parameters
+        ----------
+            data : Dataset, DataArray, numpy array, or CubeAccessor
+                Cube with dimensions (scan_index, y, x), x being the band axis.
+                See analysis.cube_accessor for other sources.
+            viewable : str, optional
+                Data variable to use if data is a Dataset.
+            index : PrefixSumIndex, optional
+                Prefix-sum index of the same cube, e.g., one built for false color images.
+            use_index : bool, default True
+                If False and index is not given, band ranges are averaged directly from
+                the data block by block. This avoids building the index, which takes a
+                pass over the cube and memory of a float copy of it, so it is cheaper
+                for a single index with narrow ranges.
+            named : dict, optional
+                Named expressions {name: expression} that expressions may refer to.
+        """
+
+        self.accessor = open_cube(data, viewable)
+        self.values = self.accessor.values
+        self.band_count = self.accessor.band_count
+        self.coords = np.asarray(self.accessor.band_coords(), dtype=np.float64)
+        if index is None and use_index:
+            index = PrefixSumIndex(self.accessor)
+        self.index = index
+        self.named = dict(named) if named is not None else {}
+
+    def _clip(self, start, stop):
+        start = int(np.clip(start, 0, self.band_count - 1))
+        stop = int(np.clip(stop, start + 1, self.band_count))
+        return start, stop
+
+    def _coordinate_range(self, low, high):
+        """Bands whose coordinate is in [low, high]. The nearest band if there are none."""
+
+        if high is None and low is not None:
+            nearest = int(np.argmin(np.abs(self.coords - low)))
+            return nearest, nearest + 1
+        low = -np.inf if low is None else low
+        high = np.inf if high is None else high
+        inside = np.flatnonzero((self.coords >= min(low, high)) & (self.coords <= max(low, high)))
+        if inside.size == 0:
+            return self._coordinate_range((low + high) / 2, None)
+        return int(inside[0]), int(inside[-1]) + 1
+
+    def _band_range(self, node) -> tuple:
+        """Band range (start, stop) of a b[...] or w[...] node."""
+
+        name = node.value.id
+        key = node.slice
+        # Python < 3.9 wraps plain subscripts in ast.Index.
+        if type(key).__name__ == 'Index':
+            key = key.value
+        if isinstance(key, ast.Slice):
+            if key.step is not None:
+                raise ValueError(f"Band ranges cannot have a step.")
+            low = _number(key.lower) if key.lower is not None else None
+            high = _number(key.upper) if key.upper is not None else None
+            if name == BAND:
+                return self._clip(0 if low is None else low, self.band_count if high is None else high)
+            return self._coordinate_range(low, high if high is not None else np.inf)
+        value = _number(key)
+        if name == BAND:
+            return self._clip(value, value + 1)
+        return self._coordinate_range(value, None)
+
+    def compile(self, expression:str, _seen=()):
+        """Parse and check an expression.
+
+        Returns
+        -------
+            tree : ast node
+                Checked expression tree with named indices inlined.
+            ranges : list of (start, stop)
+                Distinct band ranges the expression uses.
+
+        Raises
+        ------
+            ValueError
+                If the expression is not valid band math.
+        """
+
+        try:
+            tree = ast.parse(expression.strip(), mode='eval').body
+        except SyntaxError as e:
+            raise ValueError(f"Invalid band math expression '{expression}': {e.msg}.")
+        ranges = []
+        tree = self._check(tree, ranges, _seen)
+        return tree, ranges
+
+    def _check(self, node, ranges, seen):
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            node.left = self._check(node.left, ranges, seen)
+            node.right = self._check(node.right, ranges, seen)
+            return node
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+            node.operand = self._check(node.operand, ranges, seen)
+            return node
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+                and not node.keywords:
+            arity = FUNCTIONS[node.func.id].nin
+            if len(node.args) != arity:
+                raise ValueError(f"Function '{node.func.id}' takes {arity} arguments.")
+            node.args = [self._check(arg, ranges, seen) for arg in node.args]
+            return node
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) \
+                and node.value.id in (BAND, COORDINATE):
+            band_range = self._band_range(node)
+            if band_range not in ranges:
+                ranges.append(band_range)
+            # Replaced with the index of the range for evaluation.
+            return ('range', ranges.index(band_range))
+        if isinstance(node, ast.Name) and node.id in self.named:
+            if node.id in seen:
+                raise ValueError(f"Named index '{node.id}' refers to itself, directly or through other indices.")
+            inlined, inlined_ranges = self.compile(self.named[node.id], seen + (node.id,))
+            return self._renumber(inlined, inlined_ranges, ranges)
+        try:
+            return ('number', float(_number(node)))
+        except ValueError:
+            pass
+        raise ValueError(f"Unsupported band math '{_source(node)}'. Use numbers, b[...], w[...], "
+                         f"{', '.join(sorted(self.named))}, + - * / **, and {', '.join(FUNCTIONS)}.")
+
+    def _renumber(self, node, own_ranges, ranges):
+        """Map range leaves of an inlined tree to the ranges of the including expression."""
+
+        if isinstance(node, tuple):
+            if node[0] == 'range':
+                band_range = own_ranges[node[1]]
+                if band_range not in ranges:
+                    ranges.append(band_range)
+                return ('range', ranges.index(band_range))
+            return node
+        if isinstance(node, ast.BinOp):
+            node.left = self._renumber(node.left, own_ranges, ranges)
+            node.right = self._renumber(node.right, own_ranges, ranges)
+        elif isinstance(node, ast.UnaryOp):
+            node.operand = self._renumber(node.operand, own_ranges, ranges)
+        elif isinstance(node, ast.Call):
+            node.args = [self._renumber(arg, own_ranges, ranges) for arg in node.args]
+        return node
+
+    def _range_means(self, ranges, lines:slice) -> list:
+        """Mean of each band range for the pixels of a block of scan lines."""
+
+        means = []
+        for start, stop in ranges:
+            if self.index is not None:
+                mean = self.index.region_sum(start, stop, (lines, slice(None))).astype(np.float64)
+            else:
+                mean = np.sum(self.values[lines, :, start:stop], axis=2, dtype=np.float64)
+            mean /= (stop - start)
+            means.append(mean)
+        return means
+
+    def _evaluate(self, node, leaves):
+        """Evaluate a checked tree. Returns (value, owned), where owned tells that
+        value is a temporary that may be overwritten."""
+
+        if isinstance(node, tuple):
+            if node[0] == 'number':
+                return node[1], False
+            return leaves[node[1]], False
+        if isinstance(node, ast.BinOp):
+            arguments = [self._evaluate(node.left, leaves), self._evaluate(node.right, leaves)]
+            ufunc = _BINARY[type(node.op)]
+        elif isinstance(node, ast.UnaryOp):
+            arguments = [self._evaluate(node.operand, leaves)]
+            ufunc = _UNARY[type(node.op)]
+        else:
+            arguments = [self._evaluate(arg, leaves) for arg in node.args]
+            ufunc = FUNCTIONS[node.func.id]
+
+        values = [value for value, _ in arguments]
+        if not any(isinstance(value, np.ndarray) for value in values):
+            return float(ufunc(*values)), False
+        # Reuse the buffer of a temporary argument for the result.
+        out = next((value for value, owned in arguments if owned and isinstance(value, np.ndarray)), None)
+        return ufunc(*values, out=out), True
+
+    def evaluate(self, expression:str, out=None, chunk_bytes=P.band_math_chunk_bytes) -> np.ndarray:
+        """Index image of an expression.
+
+        Parameters
+        ----------
+            expression : str
+                Band math expression or the name of a named index.
+            out : numpy array, optional
+                Preallocated (scan_index, y) array for the result.
+            chunk_bytes : int
+                Approximate memory used by the temporaries of one block of scan lines.
+
+        Returns
+        -------
+            numpy array
+                Index image (scan_index, y) in float32 unless out is given. Pixels where
+                the expression is undefined, e.g. zero divided by zero, are NaN.
+        """
+
+        if expression in self.named:
+            tree, ranges = self.compile(self.named[expression], (expression,))
+        else:
+            tree, ranges = self.compile(expression)
+        scans, h = self.accessor.shape[:2]
+        if out is None:
+            out = np.empty((scans, h), dtype=np.float32)
+
+        # Leaves and a couple of temporaries per range, in float64.
+        lines_per_block = max(1, chunk_bytes // max(1, 8 * h * (len(ranges) + 2)))
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for start in range(0, scans, lines_per_block):
+                lines = slice(start, min(scans, start + lines_per_block))
+                result, _ = self._evaluate(tree, self._range_means(ranges, lines))
+                out[lines] = result
+        logging.info(f"Evaluated band math '{expression}' over {len(ranges)} band ranges.")
+        return out
@@ -0,0 +1,291 @@
+"""
+
+Principal components (PCA) and minimum noise fraction (MNF) of cubes.
+
+Both transforms are fitted from the band covariance of the cube, which is
+accumulated in a single streaming pass over chunks of scan lines. Chunk
+covariances are merged with the pairwise update of Chan et al., so the
+memory use depends on the band count and the chunk size but not on the
+length of the scan. Eigenvectors of the (bands, bands) covariance are then
+cheap to solve exactly even for hundreds of bands, so randomized SVD is not
+needed.
+
+MNF orders components by signal to noise ratio instead of variance. The noise
+covariance is either given, e.g. per-band variances from the dark frame noise
+map with band_noise_from_map(), or estimated in the same pass from the
+differences of neighbouring pixels along y (the shift difference method).
+The data is whitened with respect to the noise and PCA is done on the
+whitened data.
+
+A second streaming pass projects the cube to a few components, and
+rgb_composite() stretches the first three of them into a false colour image.
+
+"""
+
+import logging
+import numpy as np
+
+from core import properties as P
+from analysis.cube_accessor import cube_values
+
+PCA = 'pca'
+MNF = 'mnf'
+
+
+def _lines_per_chunk(h:int, bands:int, chunk_bytes:int, step:int) -> int:
+    """Scan lines per chunk, a multiple of step, so that a float64 chunk fits in chunk_bytes."""
+
+    lines = max(1, chunk_bytes // max(1, 8 * h * bands))
+    return max(step, lines - lines % step)
+
+
+def _chunks(values, sf:slice, step:int, chunk_bytes:int):
+    """Yield float64 chunks (lines, y, bands) of every step'th scan line and pixel."""
+
+    scans, h, _ = values.shape
+    bands = len(range(*sf.indices(values.shape[2])))
+    lines = _lines_per_chunk(len(range(0, h, step)), bands, chunk_bytes, step)
+    for start in range(0, scans, lines):
+        # Always a copy, as chunks are centred in place.
+        yield start, np.array(values[start:min(scans, start + lines):step, ::step, sf], dtype=np.float64)
+
+
+def band_noise_from_map(noise_map, x_factor=1, gain=None) -> np.ndarray:
+    """Per-band noise variances from a per-pixel noise map of a reference frame.
+
+    Parameters
+    ----------
+        noise_map : DataArray or numpy array
+            Temporal standard deviation of each pixel with dimensions (y, x), e.g. the
+            dark frame noise map 'dark_noise.nc' of a session cropped like the scan.
+            Its x dimension, binned by x_factor, must match the bands of the cube it
+            is used with.
+        x_factor : int, default 1
+            Spectral binning factor of the cube. Variances of x_factor neighbouring
+            columns are averaged and trailing columns not filling a bin are dropped.
+            The variance of a binned band differs from this by a factor common to all
+            bands, which does not change the MNF components.
+        gain : DataArray or numpy array, optional
+            Per-pixel (y, x) divisor of the data the noise is wanted for, e.g. white
+            minus dark frame for a reflectance cube. Pixels with no positive gain
+            are ignored.
+
+    Returns
+    -------
+        numpy array
+            Mean noise variance over y for each band.
+    """
+
+    if hasattr(noise_map, 'dims'):
+        noise_map = noise_map.transpose(P.dim_y, P.dim_x).values
+    noise_map = np.asarray(noise_map, dtype=np.float64)
+    variances = noise_map * noise_map
+    if gain is not None:
+        if hasattr(gain, 'dims'):
+            gain = gain.transpose(P.dim_y, P.dim_x).values
+        gain = np.asarray(gain, dtype=np.float64)
+        variances = np.where(gain > 0, variances / np.where(gain > 0, gain * gain, 1.0), np.nan)
+    with np.errstate(invalid='ignore'):
+        # Columns without any valid pixel are NaN.
+        variances = np.nanmean(variances, axis=0) if gain is not None else np.mean(variances, axis=0)
+    bands = variances.shape[0] // x_factor
+    return variances[:bands * x_factor].reshape(bands, x_factor).mean(axis=1)
+
+
+class ComponentModel:
+    """Fitted PCA or MNF transform. Create with fit_components()."""
+
+    def __init__(self, mean, transform, eigenvalues, total, spectral_filter, method):
+        """
+        Parameters
+        ----------
+            mean : numpy array
+                Mean spectrum over spectral_filter.
+            transform : numpy array
+                (bands, components) matrix projecting centred spectra to components.
+            eigenvalues : numpy array
+                Variance (PCA) or signal to noise ratio (MNF) of each component.
+            total : float
+                Sum of the eigenvalues of all components, including those not kept.
+            spectral_filter : slice
+                Bands the model was fitted with.
+            method : str
+                PCA or MNF.
+        """
+
+        self.mean = mean
+        self.transform = transform
+        self.eigenvalues = eigenvalues
+        self.total = total
+        self.spectral_filter = spectral_filter
+        self.method = method
+
+    @property
+    def component_count(self) -> int:
+        return self.transform.shape[1]
+
+    @property
+    def explained_ratio(self) -> np.ndarray:
+        """Share of each component of the total variance (or SNR) of all components fitted from."""
+
+        return self.eigenvalues / self.total
+
+    def project(self, cube, viewable=None, step=1, chunk_bytes=P.components_chunk_bytes) -> np.ndarray:
+        """Project a cube to the components.
+
+        Parameters
+        ----------
+            cube : Dataset, DataArray, numpy array, or CubeAccessor
+                Cube with dimensions (scan_index, y, x), x being the band axis.
+            viewable : str, optional
+                Data variable to use if cube is a Dataset.
+            step : int, default 1
+                Use only every step'th pixel in both image dimensions for a quick
+                low-resolution preview.
+            chunk_bytes : int
+                Approximate memory used by one chunk of the cube.
+
+        Returns
+        -------
+            numpy array
+                Component cube (scan_index, y, component) in float32.
+        """
+
+        values = cube_values(cube, viewable)
+        scans, h, _ = values.shape
+        out = np.empty((len(range(0, scans, step)), len(range(0, h, step)), self.component_count),
+                       dtype=np.float32)
+        for start, chunk in _chunks(values, self.spectral_filter, step, chunk_bytes):
+            chunk -= self.mean
+            first = start // step
+            out[first:first + chunk.shape[0]] = chunk @ self.transform
+        return out
+
+
+def fit_components(cube, viewable=None, n_components=P.components_default_count, method=PCA, noise=None,
+                   spectral_filter=None, step=1, chunk_bytes=P.components_chunk_bytes) -> ComponentModel:
+    """Fit a PCA or MNF transform to a cube in one streaming pass.
+
+    Parameters
+    ----------
+        cube : Dataset, DataArray, numpy array, or CubeAccessor
+            Cube with dimensions (scan_index, y, x), x being the band axis.
+            See analysis.cube_accessor for other sources.
+        viewable : str, optional
+            Data variable to use if cube is a Dataset.
+        n_components : int
+            Count of components to keep, typically 3 to 10.
+        method : str, default PCA
+            PCA orders components by variance, MNF by signal to noise ratio.
+        noise : numpy array, optional
+            Noise of the bands for MNF, either variances (bands,) or a covariance
+            matrix (bands, bands), e.g. from band_noise_from_map(). Estimated from
+            differences of neighbouring pixels along y if not given.
+        spectral_filter : slice, optional
+            Bands to use. All by default.
+        step : int, default 1
+            Fit from every step'th pixel in both image dimensions only. Much
+            faster and usually good enough for a preview.
+        chunk_bytes : int
+            Approximate memory used by one chunk of the cube.
+
+    Returns
+    -------
+        ComponentModel
+            The fitted transform.
+    """
+
+    if method not in (PCA, MNF):
+        raise ValueError(f"Unknown method '{method}'. Use '{PCA}' or '{MNF}'.")
+    values = cube_values(cube, viewable)
+    band_count = values.shape[2]
+    sf = spectral_filter if spectral_filter is not None else slice(0, band_count)
+    sf = slice(*sf.indices(band_count))
+    bands = len(range(*sf.indices(band_count)))
+    n_components = int(np.clip(n_components, 1, bands))
+    estimate_noise = method == MNF and noise is None
+
+    count = 0
+    mean = np.zeros(bands)
+    m2 = np.zeros((bands, bands))
+    diff_count = 0
+    diff_m2 = np.zeros((bands, bands))
+    for _, chunk in _chunks(values, sf, step, chunk_bytes):
+        if estimate_noise and chunk.shape[1] > 1:
+            diff = (chunk[:, 1:] - chunk[:, :-1]).reshape(-1, bands)
+            diff_m2 += diff.T @ diff
+            diff_count += diff.shape[0]
+        pixels = chunk.reshape(-1, bands)
+        n = pixels.shape[0]
+        chunk_mean = pixels.mean(axis=0)
+        pixels -= chunk_mean
+        # Merge the chunk's mean and scatter matrix into the running ones.
+        delta = chunk_mean - mean
+        total = count + n
+        m2 += pixels.T @ pixels + np.outer(delta, delta) * (count * n / total)
+        mean += delta * (n / total)
+        count = total
+
+    if count < 2:
+        raise ValueError("Too few pixels to fit components.")
+    covariance = m2 / (count - 1)
+
+    if method == PCA:
+        whitening = np.eye(bands)
+    else:
+        if noise is not None:
+            noise = np.asarray(noise, dtype=np.float64)
+            noise_cov = np.diag(noise[sf]) if noise.ndim == 1 else noise[sf, sf]
+        elif diff_count > 0:
+            # Differences of neighbours have twice the noise variance of a single pixel.
+            noise_cov = diff_m2 / (2 * diff_count)
+        else:
+            raise ValueError("Cannot estimate noise from an image of a single pixel wide.")
+        # Regularize so that bands without noise do not blow up the whitening.
+        noise_cov = noise_cov + np.eye(bands) * (P.components_noise_regularization * np.trace(noise_cov) / bands)
+        s, u = np.linalg.eigh(noise_cov)
+        whitening = u / np.sqrt(np.maximum(s, np.finfo(np.float64).tiny))
+        covariance = whitening.T @ covariance @ whitening
+
+    eigenvalues, vectors = np.linalg.eigh(covariance)
+    order = np.argsort(eigenvalues)[::-1]
+    eigenvalues, vectors = eigenvalues[order], vectors[:, order]
+    transform = whitening @ vectors[:, :n_components]
+    # Eigenvectors have arbitrary signs. Make the largest loading positive for stable colours.
+    signs = np.sign(transform[np.argmax(np.abs(transform), axis=0), np.arange(n_components)])
+    transform *= np.where(signs == 0, 1.0, signs)
+
+    total = max(np.sum(np.maximum(eigenvalues, 0.0)), np.finfo(np.float64).tiny)
+    model = ComponentModel(mean, transform, eigenvalues[:n_components], total, sf, method)
+    logging.info(f"Fitted {n_components} {method.upper()} components of {bands} bands from {count} pixels. "
+                 f"Explained {np.sum(model.explained_ratio) * 100:.1f} %.")
+    return model
+
+
+def rgb_composite(components, percentiles=P.band_cache_percentiles) -> np.ndarray:
+    """False colour image of the first three components.
+
+    Parameters
+    ----------
+        components : numpy array
+            Component cube (scan_index, y, component) from ComponentModel.project().
+            Missing components are left black.
+        percentiles : pair of floats
+            Each component is stretched from its lower to upper percentile.
+
+    Returns
+    -------
+        numpy array
+            RGB image (scan_index, y, 3) in float32 with values in [0, 1]. The first
+            component is red.
+    """
+
+    scans, h, count = components.shape
+    rgb = np.zeros((scans, h, 3), dtype=np.float32)
+    flat = components.reshape(-1, count)
+    sample_step = max(1, -(-flat.shape[0] // P.band_cache_percentile_samples))
+    for c in range(min(3, count)):
+        low, high = np.percentile(flat[::sample_step, c], percentiles)
+        span = high - low if high > low else 1.0
+        rgb[:, :, c] = ((components[:, :, c] - low) / span).clip(0.0, 1.0)
+    return rgb
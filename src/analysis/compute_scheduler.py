@@ -0,0 +1,167 @@
+"""
+
+Background computation scheduler with cancellation for interactive views.
+
+A request consists of stages, e.g. a quick low-resolution preview and the
+full result, and each stage of tasks, e.g. one per cube. All tasks run in a
+thread pool. A new request supersedes the previous one: its pending tasks are
+cancelled and results of its running tasks are discarded. So rapid key
+presses only cost the computations that were already running.
+
+Results are never delivered from the worker threads. The GUI thread calls
+poll(), typically from a matplotlib timer, which calls the result callback
+of the current request once all tasks of a stage are done. A stage that
+finishes after a later stage of the same request is skipped, so a slow
+preview never overwrites the full result.
+
+"""
+
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ComputeScheduler:
+    """Runs staged computations in a thread pool, keeping only the latest request."""
+
+    def __init__(self, workers=None):
+        """Create a scheduler.
+
+        Parameters
+        ----------
+            workers : int, optional
+                Size of the thread pool. Defaults to the count of CPUs, at least 2
+                so that a preview can run while a full computation is running.
+        """
+
+        if workers is None:
+            workers = max(2, os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ComputeScheduler')
+        self._lock = threading.Lock()
+        self._request = 0
+        self._futures = []
+        self._pending = {}
+        self._delivered_stage = -1
+        self._on_result = None
+        self._done = queue.Queue()
+
+    @property
+    def busy(self) -> bool:
+        """True if the current request has stages that are not delivered yet."""
+
+        with self._lock:
+            return bool(self._pending)
+
+    def submit(self, stages, on_result) -> int:
+        """Start a new request and cancel the previous one.
+
+        Parameters
+        ----------
+            stages : list of lists of callables
+                Tasks of each stage, in order from the coarsest to the final result.
+                A task is called without arguments. Empty stages are skipped.
+            on_result : callable
+                Called in poll() as on_result(results, final) for each completed stage,
+                where results are the return values of the tasks in the same order
+                and final tells whether the stage was the last one.
+
+        Returns
+        -------
+            int
+                Id of the request.
+        """
+
+        with self._lock:
+            self._request += 1
+            request = self._request
+            for future in self._futures:
+                future.cancel()
+            self._futures = []
+            self._pending = {}
+            self._delivered_stage = -1
+            self._on_result = on_result
+            last = max((s for s, tasks in enumerate(stages) if tasks), default=-1)
+            for s, tasks in enumerate(stages):
+                if not tasks:
+                    continue
+                results = [None] * len(tasks)
+                self._pending[s] = [len(tasks), results, s == last]
+                for t, task in enumerate(tasks):
+                    future = self._executor.submit(self._run, request, s, t, task)
+                    self._futures.append(future)
+        return request
+
+    def _run(self, request, stage, index, task):
+        if request != self._request:
+            return
+        try:
+            result = task()
+        except Exception as e:
+            logging.error(f"Background computation failed: {e}")
+            result = e
+        with self._lock:
+            if request != self._request or stage not in self._pending:
+                return
+            entry = self._pending[stage]
+            entry[1][index] = result
+            entry[0] -= 1
+            if entry[0] == 0:
+                self._done.put((request, stage))
+
+    def cancel(self):
+        """Cancel the current request."""
+
+        self.submit([], None)
+
+    def poll(self) -> bool:
+        """Deliver completed stages of the current request. Call from the GUI thread.
+
+        Returns
+        -------
+            bool
+                True if a result was delivered.
+        """
+
+        delivered = False
+        while True:
+            try:
+                request, stage = self._done.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                if request != self._request or stage <= self._delivered_stage or stage not in self._pending:
+                    continue
+                _, results, final = self._pending.pop(stage)
+                # Coarser stages still running are no longer needed.
+                for s in [s for s in self._pending if s < stage]:
+                    del self._pending[s]
+                self._delivered_stage = stage
+                on_result = self._on_result
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors:
+                print(f"Computation failed: {errors[0]}")
+                continue
+            on_result(results, final)
+            delivered = True
+        return delivered
+
+    def wait(self, timeout=None) -> bool:
+        """Block until the current request is finished and delivered. Mainly for scripts and tests."""
+
+        futures = list(self._futures)
+        for future in futures:
+            if not future.cancelled():
+                try:
+                    future.result(timeout)
+                except Exception:
+                    pass
+        self.poll()
+        return not self.busy
+
+    def shutdown(self):
+        """Cancel pending work and stop the thread pool."""
+
+        self.cancel()
+        self._executor.shutdown(wait=False)
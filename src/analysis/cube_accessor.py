@@ -0,0 +1,372 @@
+"""
+
+Backend-agnostic access to spectral cubes.
+
+Cubes come as xarray Datasets (scanned cubes in (scan_index, y, x) order),
+as NumPy arrays, e.g. (height, width, bands) from scipy.io.loadmat, as memory
+mapped raw files in any interleave, and as HDF5 datasets such as MATLAB v7.3
+files, which store arrays transposed. A CubeAccessor hides these differences
+behind one canonical order (row, column, band), which is the same as
+(scan_index, y, x) of scanned cubes.
+
+The values attribute of an accessor can be sliced like a NumPy array in the
+canonical order. For in-memory sources it is a view of the original array
+(no copy). For lazy sources (HDF5, unloaded NetCDF) it reads only the sliced
+part. band(), spectrum() and window() are the usual ways to read it.
+
+Use open_cube() to get an accessor for any supported source.
+
+"""
+
+import os
+import numpy as np
+import xarray as xr
+from xarray import DataArray
+from xarray import Dataset
+
+from core import properties as P
+
+# Band axis positions of raw file interleaves. Rows, columns and bands in file order.
+_interleave_axes = {
+    'bip': (0, 1, 2),   # (rows, columns, bands)
+    'bil': (0, 2, 1),   # (rows, bands, columns)
+    'bsq': (1, 2, 0),   # (bands, rows, columns)
+}
+
+
+class _LazyCubeView:
+    """Read-on-slice view of a lazy source in canonical order.
+
+    Supports basic indexing with integers and slices, which is all the
+    analysis code uses. np.asarray() reads everything.
+    """
+
+    def __init__(self, shape, dtype, read):
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = 3
+        self._read = read
+
+    def _normalize(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        return key + (slice(None),) * (self.ndim - len(key))
+
+    def __getitem__(self, key):
+        return np.asarray(self._read(self._normalize(key)))
+
+    def __array__(self, dtype=None):
+        values = self[:, :, :]
+        return values if dtype is None else values.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class CubeAccessor:
+    """Canonical (row, column, band) access to a cube. Use a subclass or open_cube()."""
+
+    def __init__(self, values, band_coords=None):
+        """
+        Parameters
+        ----------
+            values : numpy array or array-like
+                Cube in canonical order supporting NumPy basic indexing.
+            band_coords : numpy array, optional
+                Coordinates of the bands, e.g. wavelengths. Band indices by default.
+        """
+
+        self.values = values
+        self._band_coords = band_coords
+
+    @property
+    def shape(self) -> tuple:
+        return tuple(self.values.shape)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def band_count(self) -> int:
+        return self.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    @property
+    def is_lazy(self) -> bool:
+        """True if values are read from a file on slicing rather than held in memory."""
+
+        return not isinstance(self.values, np.ndarray) or isinstance(self.values, np.memmap)
+
+    def band_coords(self) -> np.ndarray:
+        if self._band_coords is not None:
+            return np.asarray(self._band_coords)
+        return np.arange(self.band_count)
+
+    def band(self, index:int) -> np.ndarray:
+        """Image (row, column) of a band."""
+
+        return self.values[:, :, index]
+
+    def spectrum(self, row:int, column:int) -> np.ndarray:
+        """Spectrum of a pixel."""
+
+        return self.values[row, column, :]
+
+    def window(self, rows=slice(None), columns=slice(None), bands=slice(None)) -> np.ndarray:
+        """Sub-cube (row, column, band) of given slices."""
+
+        return self.values[rows, columns, bands]
+
+    def read(self) -> np.ndarray:
+        """Whole cube as a NumPy array. Reads lazy sources into memory."""
+
+        return np.asarray(self.values)
+
+    def close(self):
+        pass
+
+
+class NumpyCubeAccessor(CubeAccessor):
+    """Accessor of a NumPy array or memmap. Bands last by default."""
+
+    def __init__(self, array, axes=(0, 1, 2), band_coords=None):
+        """
+        Parameters
+        ----------
+            array : numpy array
+                Three-dimensional cube.
+            axes : tuple of three ints
+                Axes of the array holding rows, columns, and bands, in that order.
+        """
+
+        array = np.asarray(array) if not isinstance(array, np.ndarray) else array
+        if array.ndim != 3:
+            raise ValueError(f"Cube must have three dimensions, got shape {array.shape}.")
+        # A transposed view, never a copy.
+        super().__init__(np.transpose(array, axes), band_coords)
+
+
+class MemmapCubeAccessor(NumpyCubeAccessor):
+    """Accessor of a raw binary cube file read through a memory map."""
+
+    def __init__(self, path, shape, dtype, interleave='bip', offset=0, byte_order=None, band_coords=None):
+        """
+        Parameters
+        ----------
+            path : str
+                Path of the raw file.
+            shape : tuple of three ints
+                Cube shape as (rows, columns, bands).
+            dtype : numpy dtype
+                Type of the values.
+            interleave : str
+                'bip' (band interleaved by pixel), 'bil' (by line), or 'bsq' (band sequential).
+            offset : int
+                Size of a header before the data in bytes.
+            byte_order : str, optional
+                '<' or '>' if the file's byte order differs from the native one.
+        """
+
+        if interleave not in _interleave_axes:
+            raise ValueError(f"Unknown interleave '{interleave}'. Use one of {list(_interleave_axes)}.")
+        axes = _interleave_axes[interleave]
+        file_shape = [0, 0, 0]
+        for canonical, file_axis in enumerate(axes):
+            file_shape[file_axis] = shape[canonical]
+        dtype = np.dtype(dtype)
+        if byte_order is not None:
+            dtype = dtype.newbyteorder(byte_order)
+        array = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=tuple(file_shape))
+        super().__init__(array, axes, band_coords)
+
+
+class XarrayCubeAccessor(CubeAccessor):
+    """Accessor of an xarray cube with dimensions (scan_index, y, x)."""
+
+    def __init__(self, data, viewable=None):
+        """
+        Parameters
+        ----------
+            data : Dataset or DataArray
+                Cube with dimensions scan_index, y, and x in any order.
+            viewable : str, optional
+                Data variable of a Dataset. If not given, the Dataset must have exactly one
+                variable with the cube dimensions.
+        """
+
+        if isinstance(data, Dataset):
+            data = data[viewable if viewable is not None else _only_cube_variable(data)]
+        data = data.transpose(*P.dim_order_cube)
+        self.data = data
+        band_coords = data[P.dim_x].values if P.dim_x in data.coords else None
+        # Variable.data would load a lazy variable, so ask whether it is in memory already.
+        if getattr(data.variable, '_in_memory', True):
+            values = data.values
+        else:
+            # Not loaded yet (e.g. opened from NetCDF). Read only the sliced parts.
+            values = _LazyCubeView(data.shape, data.dtype, lambda key: data[key].values)
+        super().__init__(values, band_coords)
+
+    def close(self):
+        self.data.close()
+
+
+class HDF5CubeAccessor(CubeAccessor):
+    """Accessor of a three-dimensional HDF5 dataset, e.g. a MATLAB v7.3 variable."""
+
+    def __init__(self, source, key=None, axes=None, band_coords=None):
+        """
+        Parameters
+        ----------
+            source : str or h5py Dataset
+                Path of an HDF5 file or an open dataset.
+            key : str, optional
+                Name of the dataset in the file. If not given, the largest three-dimensional
+                dataset is used.
+            axes : tuple of three ints, optional
+                Axes of the dataset holding rows, columns, and bands. MATLAB stores arrays
+                transposed, so datasets with a MATLAB_class attribute default to (2, 1, 0),
+                and others to (0, 1, 2).
+        """
+
+        try:
+            import h5py
+        except ImportError as e:
+            raise ImportError("Reading HDF5 cubes requires h5py. Install it with 'pip install h5py'.") from e
+
+        self._file = None
+        if isinstance(source, h5py.Dataset):
+            dataset = source
+        else:
+            self._file = h5py.File(source, 'r')
+            if key is None:
+                key = largest_hdf5_cube(self._file)
+            dataset = self._file[key]
+        if dataset.ndim != 3:
+            raise ValueError(f"HDF5 dataset '{dataset.name}' is not three-dimensional.")
+        if axes is None:
+            axes = (2, 1, 0) if 'MATLAB_class' in dataset.attrs else (0, 1, 2)
+        self.dataset = dataset
+        self.axes = tuple(axes)
+        shape = tuple(dataset.shape[a] for a in self.axes)
+        super().__init__(_LazyCubeView(shape, dataset.dtype, self._read), band_coords)
+
+    def _read(self, key):
+        # Dataset key in file order and the canonical axes that remain after integer indexing.
+        file_key = [slice(None)] * 3
+        for canonical, file_axis in enumerate(self.axes):
+            file_key[file_axis] = key[canonical]
+        values = self.dataset[tuple(file_key)]
+        remaining = [a for a in self.axes if not isinstance(file_key[a], (int, np.integer))]
+        # Axes of the result are in file order. Reorder them to the canonical order.
+        file_order = sorted(remaining)
+        return np.transpose(values, [file_order.index(a) for a in remaining])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def largest_hdf5_cube(h5file) -> str:
+    """Name of the largest three-dimensional dataset in an open HDF5 file."""
+
+    import h5py
+
+    found = []
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.ndim == 3:
+            found.append((obj.size, name))
+    h5file.visititems(visit)
+    if not found:
+        raise ValueError(f"No three-dimensional datasets in '{h5file.filename}'.")
+    return max(found)[1]
+
+
+def _only_cube_variable(ds:Dataset) -> str:
+    names = [name for name, var in ds.data_vars.items() if set(P.dim_order_cube) <= set(var.dims)]
+    if len(names) != 1:
+        raise ValueError(f"Give the name of the cube variable. Candidates are {names}.")
+    return names[0]
+
+
+def _largest_mat_cube(variables:dict) -> np.ndarray:
+    cubes = [v for k, v in variables.items() if not k.startswith('__') and getattr(v, 'ndim', 0) == 3]
+    if not cubes:
+        raise ValueError("No three-dimensional arrays in the .mat file.")
+    return max(cubes, key=lambda v: v.size)
+
+
+def _is_hdf5(path) -> bool:
+    # HDF5 signature may be after a user block of 512 * 2**n bytes (MATLAB uses 512).
+    signature = b'\x89HDF\r\n\x1a\n'
+    with open(path, 'rb') as f:
+        for offset in (0, 512, 1024, 2048):
+            f.seek(offset)
+            if f.read(8) == signature:
+                return True
+    return False
+
+
+def open_cube(source, viewable=None, **kwargs) -> CubeAccessor:
+    """Accessor for a cube from any supported source.
+
+    Parameters
+    ----------
+        source :
+            CubeAccessor (returned as is), xarray Dataset or DataArray, NumPy array or
+            memmap (bands last), h5py Dataset, or a path. Paths are opened by extension:
+            '.nc' lazily with xarray, '.npy' memory mapped, '.mat' lazily if MATLAB v7.3
+            (HDF5) and with scipy.io.loadmat otherwise, '.h5' and '.hdf5' lazily, and
+            '.raw', '.bip', '.bil', '.bsq', and '.dat' memory mapped.
+        viewable : str, optional
+            Variable name in Datasets, .mat files, and HDF5 files. The largest cube is
+            used if not given.
+        kwargs :
+            Passed to the accessor, e.g. shape, dtype, interleave, and offset for raw files
+            or axes for arrays and HDF5 datasets.
+    """
+
+    if isinstance(source, CubeAccessor):
+        return source
+    if isinstance(source, (Dataset, DataArray)):
+        return XarrayCubeAccessor(source, viewable)
+    if isinstance(source, np.ndarray):
+        return NumpyCubeAccessor(source, **kwargs)
+    if type(source).__module__.startswith('h5py'):
+        return HDF5CubeAccessor(source, **kwargs)
+    if isinstance(source, (str, os.PathLike)):
+        path = os.path.abspath(str(source))
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.nc':
+            return XarrayCubeAccessor(xr.open_dataset(path), viewable)
+        if ext == '.npy':
+            return NumpyCubeAccessor(np.load(path, mmap_mode='r'), **kwargs)
+        if ext in ('.h5', '.hdf5'):
+            return HDF5CubeAccessor(path, key=viewable, **kwargs)
+        if ext == '.mat':
+            if _is_hdf5(path):
+                return HDF5CubeAccessor(path, key=viewable, **kwargs)
+            from scipy.io import loadmat
+            variables = loadmat(path)
+            array = variables[viewable] if viewable is not None else _largest_mat_cube(variables)
+            return NumpyCubeAccessor(array, **kwargs)
+        if ext in ('.raw', '.dat', '.bip', '.bil', '.bsq'):
+            if ext in ('.bip', '.bil', '.bsq'):
+                kwargs.setdefault('interleave', ext[1:])
+            return MemmapCubeAccessor(path, **kwargs)
+        raise ValueError(f"Unknown cube file type '{ext}'.")
+    raise TypeError(f"Cannot access a cube of type {type(source)}.")
+
+
+def cube_values(source, viewable=None):
+    """Canonical (row, column, band) values of a cube for sliced reading. See open_cube()."""
+
+    return open_cube(source, viewable).values
@@ -13,31 +13,46 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import matplotlib.cm as cm
 import logging
+import os
+import threading
 
 from core import properties as P
+from core import frame_manipulation as fm
 from utilities import file_handling as F
 from utilities.numeric import clamp
+from analysis.band_cache import BandMajorCache
+from analysis.band_index import PrefixSumIndex
+from analysis.spectral_similarity import SpectralSimilarity
+from analysis.compute_scheduler import ComputeScheduler
+from analysis.cube_accessor import open_cube
+from analysis import cube_pyramid
+from analysis import components
 
 
-def calculate_false_color_images(source_cube_list, viewable, spectral_blue, spectral_green, spectral_red):
+def calculate_false_color_images(source_cube_list, viewable, spectral_blue, spectral_green, spectral_red,
+                                 band_indices=None, step=1):
     """ Calculate false color images for original and smile corrected (with lookup table or intrepolation) cubes.
 
     Parameters
     ----------
-        org: xarray Dataset
-            Uncorrected hyperspectral image cube.
-        lut: xarray Dataset
-            Hyperspectral image cube smile corrected with lookup table method.
-        intr: xarray Dataset
-            Hyperspectral image cube smile corrected with interpolation method.
+        source_cube_list : list
+            Cubes as xarray Datasets or any other source accepted by
+            analysis.cube_accessor.open_cube(), e.g. uncorrected, LUT corrected,
+            and interpolation corrected cubes.
         viewable : str
             Viewable data dimension name in the dataset (defined in core.properties.py).
-        spectral_blue : nd.array
-            Indices of blue region in the cube.
+        spectral_blue : slice or nd.array
+            Band range or indices of blue region in the cube.
         spectral_green
-            Indices of green region in the cube.
+            Band range or indices of green region in the cube.
         spectral_red
-            Indices of red region in the cube.
+            Band range or indices of red region in the cube.
+        band_indices : list of PrefixSumIndex, optional
+            Prefix-sum indices of the cubes. If given, the means of band ranges
+            are taken from them, which is independent of the range widths.
+        step : int, default 1
+            Use only every step'th pixel in both image dimensions for a quick
+            low-resolution preview.
     Returns
     -------
         org_false: xarray Dataset
@@ -48,22 +63,30 @@ def calculate_false_color_images(source_cube_list, viewable, spectral_blue, spec
             False color image of the interpolation corrected cube.
     """
 
-    rgb = np.array([spectral_red, spectral_green, spectral_blue])
+    rgb = [spectral_red, spectral_green, spectral_blue]
+    use_index = band_indices is not None and all(isinstance(c, slice) for c in rgb)
     false_list = []
     for i,cube in enumerate(source_cube_list):
-        mean = np.mean(cube[viewable].values[:,:,rgb], axis=3).astype(np.float32)
-        false = (mean / np.max(mean, axis=(0,1))).clip(min=0.0)
+        if use_index:
+            mean = band_indices[i].band_means(rgb)[::step, ::step]
+        else:
+            values = open_cube(cube, viewable).values[::step, ::step]
+            mean = np.stack([np.mean(values[:,:,c], axis=2) for c in rgb], axis=-1)
+        channel_max = np.max(mean, axis=(0,1))
+        channel_max = np.where(channel_max > 0, channel_max, 1.0)
+        false = (mean / channel_max).clip(min=0.0).astype(np.float32)
         false_list.append(false)
     return false_list
 
 def calculate_sam(source_cube, sam_window_start, sam_window_end, sam_ref_x, viewable,
-                  use_radians=False, spectral_filter=None, use_scm=False):
+                  use_radians=False, spectral_filter=None, use_scm=False, engine=None, step=1):
     """Calculates spectral angle map of a single cube.
     
     Parameters
     ----------
         source_cube : xarray Dataset
-            Spectral cube from which to calculate the cosine angle.
+            Spectral cube from which to calculate the cosine angle. Any other source
+            accepted by analysis.cube_accessor.open_cube() works as well.
         sam_window_start : list of ints of lengts 2 (x,y)
             Starting coordinate of the window from where the cosine angle is calculated.
         sam_window_end : list of ints of lengts 2 (x,y)
@@ -80,59 +103,55 @@ def calculate_sam(source_cube, sam_window_start, sam_window_end, sam_ref_x, view
             calculations. Otherwise, the whole spectrum is used.
         use_scm : bool, optional default False
             SCM is advanced version of the basic SAM spectral angle.
+        engine : SpectralSimilarity, optional
+            Engine of the source cube with precomputed norm tables. Pass one when
+            calculating repeatedly from the same cube. 
+        step : int, default 1
+            Use only every step'th pixel of the window in both dimensions for a quick 
+            low-resolution preview. The result is scaled back to the size of the window.
     Returns 
     -------
         sam : numpy array
             Plottable spectral angle map image of the size of y,index dimensions of the source cube.
             Values outside of given window are filled with ones, if use_radians = True, and 
             zeros otherwise.
-        chunk : xarray DataArray
+        chunk : numpy array
             Calculated cosine angels the size of given sam window. This is a subset of sam.
     """
 
     x_slice = slice(sam_window_start[0], sam_window_end[0])
     y_slice = slice(sam_window_start[1], sam_window_end[1] )
 
+    accessor = open_cube(source_cube, viewable)
     if spectral_filter is not None:
         sf = spectral_filter
     else:
-        sf = slice(0, source_cube.reflectance.x.size - 1)
+        sf = slice(0, accessor.band_count - 1)
 
     cos_ref = np.clip(sam_ref_x, sam_window_start[0], sam_window_end[0]) 
 
-    # Reference spectrum as mean of a vertical line in the box.
-
-    a = source_cube[viewable].isel({P.dim_y: cos_ref, P.dim_scan: y_slice, P.dim_x:sf}).mean(dim=P.dim_scan).astype(np.float64)
-    # Reference spectrum as a single pixel spectrum
-    # a = sourceCube.reflectance.isel(y=cos_ref, index=int((sam_window_end[1]-sam_window_start[1])/2), x=sf)
-    # Reference point as a mean over the whole box area
-    # a = sourceCube.reflectance.isel(y=x_slice, index=y_slice, x=sf).mean(dim=('y','index'))
-    b = source_cube[viewable].isel({P.dim_y: x_slice, P.dim_scan: y_slice, P.dim_x:sf}).astype(np.float64)
+    if engine is None:
+        engine = SpectralSimilarity(accessor, use_index=False)
+    image_shape = accessor.shape[:2]
 
-    if not use_scm:
-        ###    SAM    ####
-        chunk = a.dot(b) / (np.linalg.norm(a) * np.linalg.norm(b, axis=2))
+    # Reference spectrum as mean of a vertical line in the box.
+    a = engine.reference_spectrum(y_slice, cos_ref, sf)
+    if step > 1:
+        low = engine.similarity(slice(y_slice.start, y_slice.stop, step), slice(x_slice.start, x_slice.stop, step),
+                                a, sf, use_scm=use_scm)
+        window_shape = (len(range(*y_slice.indices(image_shape[0]))), len(range(*x_slice.indices(image_shape[1]))))
+        chunk = np.repeat(np.repeat(low, step, axis=0), step, axis=1)[:window_shape[0], :window_shape[1]]
     else:
-        ###    SCM    ####
-        aMean = a.mean(dim=P.dim_x)
-        bMean = b.mean(dim=P.dim_x)
-        A = a - aMean
-        B = b - bMean
-        chunk = A.dot(B) / ((np.linalg.norm(A) * np.linalg.norm(B, axis=2)))
-        chunk = chunk / 2
-        chunk = chunk + 0.5
+        chunk = engine.similarity(y_slice, x_slice, a, sf, use_scm=use_scm)
 
     if use_radians:
         # Safeguard for arccos.
-        chunk = chunk.clip(min=0.0,max=1.0)
-        chunk = np.arccos(chunk)
-        chunk = chunk.rename('cosine angle')
+        chunk = np.arccos(chunk.clip(min=0.0,max=1.0))
         # Initialize cosmap image with zeros
-        sam = np.zeros_like(source_cube[viewable].isel({P.dim_x:0}).values).astype(np.float64)
+        sam = np.zeros(image_shape, dtype=np.float64)
     else:
-        chunk = chunk.rename('dot product')
         # Initialize cosmap image with ones
-        sam = np.ones_like(source_cube[viewable].isel({P.dim_x:0}).values).astype(np.float64)
+        sam = np.ones(image_shape, dtype=np.float64)
 
     sam[y_slice, x_slice] = chunk
 
@@ -146,7 +165,36 @@ class CubeInspector:
     CubeInspector is an interactive matplotlib-based inspector program with simple key and mouse commands.
     """
 
-    def __init__(self, org, lut, intr, viewable, session_name=None):
+    def __init__(self, org, lut, intr, viewable, session_name=None, band_cache=True, background_cache=True,
+                 asynchronous=True, pyramids=None):
+        """Create the inspector. Call show() to open it.
+
+        Parameters
+        ----------
+            org, lut, intr : xarray Dataset
+                Original cube and optional LUT and interpolation desmiled cubes. NumPy
+                arrays (scan_index, y, x), memory maps, HDF5 datasets, and cube files work
+                as well (see analysis.cube_accessor).
+            viewable : str
+                Name of the data variable to show. May be None for other than Datasets.
+            session_name : str, optional
+                Session whose control file is used.
+            band_cache : bool, default True
+                Make band-major copies of the cubes so that switching bands in mode 1
+                is a plain slice. Big cubes of a session are cached into memory mapped
+                files in the session directory.
+            background_cache : bool, default True
+                Build the band-major copies in a background thread.
+            asynchronous : bool, default True
+                Compute false color images and spectral angle maps in a thread pool
+                so that the window stays responsive. A low-resolution preview is
+                shown first if the full result needs precomputations that are not
+                done yet. Superseded computations are cancelled.
+            pyramids : list of lists of Datasets, optional
+                Overview pyramid levels (see analysis.cube_pyramid) of each cube. Band
+                images of mode 1 are taken from the coarsest level that still has a data
+                pixel for each screen pixel at the current zoom.
+        """
 
         # store the cubes in a list. Order is org, lut, intr if present
         self.cubes = []
@@ -179,6 +227,7 @@ class CubeInspector:
         # removed. For now the behaviour is optional and disabled by setting use_color_checker_rgb to False
         self.use_color_checker_rgb = False
 
+        self.session_name = session_name
         if session_name is not None:
             self.use_session_control = True
             self.path_control = P.path_rel_scan + session_name + '/' + P.fn_control
@@ -188,24 +237,44 @@ class CubeInspector:
         # Interpolative shift may cause very small negative values, which should be clipped. 
         # self.intr[self.viewable].values = self.intr[self.viewable].values.clip(min=0.0).astype(np.float32)
 
-        self.width_image = self.cubes[0][self.viewable][P.dim_y].size
-        self.height_image = self.cubes[0][self.viewable][P.dim_scan].size
+        # Canonical (scan_index, y, x) access to the cubes whatever their backend.
+        # The same cube given many times shares its accessor.
+        accessors = {}
+        for cube in self.cubes:
+            if id(cube) not in accessors:
+                accessors[id(cube)] = open_cube(cube, self.viewable)
+        self.accessors = [accessors[id(cube)] for cube in self.cubes]
+
+        self.height_image, self.width_image, band_count = self.accessors[0].shape
 
         # Selected pixel and band in CUBE's coordinates. show() deals with the 
         # transformation from plot coordinates.
-        self.idx = int(self.cubes[0][self.viewable][P.dim_scan].size / 2) # image y
-        self.y = int(self.cubes[0][self.viewable][P.dim_y].size / 2) # image x
-        self.x = int(self.cubes[0][self.viewable][P.dim_x].size / 2) # image band
+        self.idx = int(self.height_image / 2) # image y
+        self.y = int(self.width_image / 2) # image x
+        self.x = int(band_count / 2) # image band
         # Reference point for spectral angle. In same dimension as self.y.
         self.sam_ref_x = self.y
 
-        # Modes: 1 for reflectance image, 2 for false color image, 3 for spectral angle
+        # Modes: 1 for reflectance image, 2 for false color image, 3 for spectral angle,
+        # 4 for principal component composite
         self.mode = 1
 
         # Containers for false color images
         self.false_images = []
         # False color images calculated lazyly only once.
         self.false_color_calculated = False
+        # Composites of the first three PCA or MNF components for mode 4, calculated lazily.
+        self.component_method = components.PCA
+        self.component_images = []
+        self.components_calculated = False
+        # Prefix-sum indices and spectral similarity engines of the cubes for modes 2 and 3.
+        # Built lazily by _band_index() and _similarity_engine(), keyed by id of the cube.
+        self._band_indices = {}
+        self._similarity_engines = {}
+        self._index_locks = {id(cube): threading.Lock() for cube in self.accessors}
+        # Background computations of modes 2, 3, and 4.
+        self.scheduler = ComputeScheduler() if asynchronous else None
+        self.poll_timer = None
         # Toggle mode 3 between radians and dot product.
         self.toggle_radians = False
 
@@ -232,7 +301,7 @@ class CubeInspector:
 
         if self.use_color_checker_rgb:
             # Boundaries of RGB boxes used for reference with a color cheker image.
-            lins = np.linspace(0, self.height_image, num=13, dtype=np.int)
+            lins = np.linspace(0, self.height_image, num=13, dtype=int)
             self.rgb_horizontal_chunk = slice(int(self.width_image/10), self.width_image - int(self.width_image/10))
             self.rgb_vertical_chunks = [slice(lins[1], lins[3]), slice(lins[5], lins[7]), slice(lins[9], lins[11])]
         
@@ -244,10 +313,12 @@ class CubeInspector:
         self.sam_chunks_list = []
 
         # Filter out noisy ends of the spectrum in cosine maps.
-        self.spectral_filter_max = self.cubes[0][self.viewable][P.dim_x].size
+        self.spectral_filter_max = band_count
         self.reinit_spectral_filter()
         # Step size to use when user moves the spectral filter.
         self.spectral_filter_step = 100
+        # Step size to use when user widens or narrows false color band ranges.
+        self.false_color_resize_step = 10
 
         # Cosine boxes
         self.sam_window_start = \
@@ -257,13 +328,83 @@ class CubeInspector:
         self.sam_window_start_sug = [self.sam_window_start[0], self.sam_window_start[1]]
         self.sam_window_corner_given = False
 
-        # Image overlay decorations. Store handles for removing the objects.
-        self.decorations_selection = []
-        self.decorations_box = []
+        # Spectrogram lines and image overlay decorations. Created in init_plot().
+        self.spectrum_lines = []
+        self.band_line = None
+        self.rgb_lines = []
+        self.sam_mean_lines = []
+        self.selection_markers = []
+        self.sam_boxes = []
+        self.rgb_boxes = []
+        self._background = None
 
         self.connection_mouse  = None
         self.connection_button = None
 
+        # Overview levels of each cube and the level currently shown in mode 1.
+        self.pyramids = list(pyramids) if pyramids is not None else [[] for _ in self.cubes]
+        self.pyramids += [[] for _ in range(len(self.cubes) - len(self.pyramids))]
+        self.levels = [0 for _ in self.cubes]
+
+        # Use percentiles instead of minimum and maximum as colour limits in mode 1.
+        self.robust_limits = False
+        self.band_caches = []
+        if band_cache:
+            def make_cache(i, cube):
+                cache_path = None
+                if session_name is not None and cube.nbytes > P.band_cache_max_memory_bytes:
+                    cache_path = P.path_rel_scan + session_name + '/' + P.band_cache_file_prefix + f'{i}.npy'
+                cache = BandMajorCache(cube, path=cache_path)
+                if background_cache:
+                    cache.start()
+                else:
+                    cache.build()
+                return cache
+            self.band_caches = self._per_cube(make_cache)
+
+    def _per_cube(self, make) -> list:
+        """Call make(i, accessor) for each cube. The same cube given many times is made only once."""
+
+        made = {}
+        items = []
+        for i, cube in enumerate(self.accessors):
+            if id(cube) not in made:
+                made[id(cube)] = make(i, cube)
+            items.append(made[id(cube)])
+        return items
+
+    def _band_index(self, i) -> PrefixSumIndex:
+        """Prefix-sum index of the i'th cube. Built on first call. Thread safe."""
+
+        key = id(self.accessors[i])
+        with self._index_locks[key]:
+            if key not in self._band_indices:
+                self._band_indices[key] = PrefixSumIndex(self.accessors[i])
+            return self._band_indices[key]
+
+    def _similarity_engine(self, i) -> SpectralSimilarity:
+        """Spectral similarity engine of the i'th cube sharing the prefix-sum index. Thread safe."""
+
+        index = self._band_index(i)
+        key = id(self.accessors[i])
+        with self._index_locks[key]:
+            if key not in self._similarity_engines:
+                index.add_squares()
+                self._similarity_engines[key] = SpectralSimilarity(self.accessors[i], index=index)
+            return self._similarity_engines[key]
+
+    def _precomputed(self, engines=False) -> bool:
+        """True if indices (and similarity engines) of all cubes have been built."""
+
+        done = self._similarity_engines if engines else self._band_indices
+        return all(id(cube) in done for cube in self.accessors)
+
+    def _poll_results(self):
+        """Deliver finished background computations. Called by a timer of the figure."""
+
+        if self.scheduler is not None and self.scheduler.poll() and self.fig is not None:
+            self.fig.canvas.draw_idle()
+
     def reinit_false_color_spectra(self):
         """Call after reloading the control file.
 
@@ -275,18 +416,41 @@ class CubeInspector:
             b = self.control[P.ctrl_cube_inspector][P.ctrl_spectral_blue]
             g = self.control[P.ctrl_cube_inspector][P.ctrl_spectral_green]
             r = self.control[P.ctrl_cube_inspector][P.ctrl_spectral_red]
-            self.spectral_blue = np.arange(b[0], b[1], dtype=np.int)
-            self.spectral_green = np.arange(g[0], g[1], dtype=np.int)
-            self.spectral_red = np.arange(r[0], r[1], dtype=np.int)
-            # FIXME fix this shit
-            w = 200
-            self.spectral_blue = np.arange(b[0], b[0]+w)
-            self.spectral_green = np.arange(g[0], g[0]+w)
-            self.spectral_red = np.arange(r[0], r[0]+w)
         else:
-            self.spectral_blue = np.arange(300, 500)
-            self.spectral_green = np.arange(660, 860)
-            self.spectral_red = np.arange(1300, 1500)
+            b = P.false_color_default_blue
+            g = P.false_color_default_green
+            r = P.false_color_default_red
+        self.spectral_blue = self._band_range(b[0], b[1])
+        self.spectral_green = self._band_range(g[0], g[1])
+        self.spectral_red = self._band_range(r[0], r[1])
+        self.false_color_calculated = False
+
+    def _band_range(self, start, stop) -> slice:
+        """Band range as a slice clipped to the cube. Never empty."""
+
+        band_count = self.accessors[0].band_count
+        start = int(np.clip(start, 0, band_count - 1))
+        stop = int(np.clip(stop, start + 1, band_count))
+        return slice(start, stop)
+
+    def shift_false_color_spectra(self, step:int):
+        """Move all false color band ranges by step bands keeping their widths."""
+
+        band_count = self.accessors[0].band_count
+        ranges = [self.spectral_blue, self.spectral_green, self.spectral_red]
+        # Keep the ranges inside the cube without changing their widths.
+        step = int(np.clip(step, -min(r.start for r in ranges), band_count - max(r.stop for r in ranges)))
+        self.spectral_blue, self.spectral_green, self.spectral_red = \
+            [slice(r.start + step, r.stop + step) for r in ranges]
+        self.false_color_calculated = False
+
+    def resize_false_color_spectra(self, step:int):
+        """Widen (or narrow if step is negative) all false color band ranges by step bands on both sides."""
+
+        ranges = [self.spectral_blue, self.spectral_green, self.spectral_red]
+        self.spectral_blue, self.spectral_green, self.spectral_red = \
+            [self._band_range(r.start - step, max(r.stop + step, r.start - step + 1)) for r in ranges]
+        self.false_color_calculated = False
 
     def reload_control(self):
         """Reload control file.
@@ -303,7 +467,7 @@ class CubeInspector:
         The default filter filters one third from the middle of the spectrum if session control is not used.
         """
 
-        lin_spectr = np.linspace(0, self.spectral_filter_max, 4, dtype=np.int)
+        lin_spectr = np.linspace(0, self.spectral_filter_max, 4, dtype=int)
         if self.use_session_control:
             fil = self.control[P.ctrl_cube_inspector][P.ctrl_spectral_filter]
             self.spectral_filter = slice(clamp(fil[0], 0, self.spectral_filter_max),
@@ -334,15 +498,83 @@ class CubeInspector:
         self.connect_ui()
         for i,cube in enumerate(self.cubes):
             n,m = self.nth_image_as_index(i+1)
-            ax_image = self.ax[n,m].imshow(cube[self.viewable].isel({P.dim_x:self.x}), origin='lower')
+            ax_image = self.ax[n,m].imshow(self.accessors[i].band(self.x), origin='lower')
             self.images.append(ax_image)
+        self._init_artists()
+        if self.scheduler is not None:
+            self.poll_timer = self.fig.canvas.new_timer(interval=P.inspector_poll_interval_ms)
+            self.poll_timer.add_callback(self._poll_results)
+            self.poll_timer.start()
         self.plot_inited = True
 
+    def _init_artists(self):
+        """Create the lines and decorations that are updated in place on every update.
+
+        Everything that changes on pixel selection is animated, i.e., drawn by blitting
+        over a stored background instead of with the rest of the figure.
+        """
+
+        ax = self.ax[0,0]
+        self.spectrum_lines = []
+        for i,cube in enumerate(self.accessors):
+            bands = cube.band_coords()
+            line, = ax.plot(bands, np.zeros(len(bands)), color=self.colors_org_lut_intr[i], animated=True)
+            self.spectrum_lines.append(line)
+        ax.set_xlabel(P.dim_x)
+        self.band_line = ax.axvline(self.spectrum_lines[0].get_xdata()[self.x], color=self.color_pixel_selection, animated=True)
+
+        self.rgb_lines = []
+        self.rgb_boxes = []
+        if self.use_color_checker_rgb:
+            org = self.accessors[0]
+            bands = org.band_coords()
+            for i,rgbXChunk in enumerate(self.rgb_vertical_chunks):
+                # Reference color spectra
+                rgb_chunk = org.window(rgbXChunk, self.rgb_horizontal_chunk).mean(axis=(0, 1))
+                line, = ax.plot(bands, rgb_chunk, color=self.colors_rbg[i], animated=True)
+                self.rgb_lines.append(line)
+                bottomLeftCorner = (self.rgb_horizontal_chunk.start, rgbXChunk.start)
+                w = self.rgb_horizontal_chunk.stop - self.rgb_horizontal_chunk.start
+                h = rgbXChunk.stop-rgbXChunk.start
+                rgbBox = patches.Rectangle(bottomLeftCorner, w, h, edgecolor=self.colors_rbg[i],facecolor='none', linewidth=1)
+                self.ax[0,1].add_patch(rgbBox)
+                self.rgb_boxes.append(rgbBox)
+
+        self.sam_mean_lines = []
+        for i,_ in enumerate(self.cubes):
+            line, = ax.plot([], [], color=self.colors_org_lut_intr[i], animated=True)
+            self.sam_mean_lines.append(line)
+
+        self.sam_boxes = []
+        for _ in range(2):
+            box = patches.Rectangle((0, 0), 0, 0, edgecolor='white', facecolor='none', linewidth=1, animated=True)
+            self.ax[0,1].add_patch(box)
+            self.sam_boxes.append(box)
+
+        self.selection_markers = []
+        for i,_ in enumerate(self.cubes):
+            n,m = self.nth_image_as_index(i+1)
+            selection = self.ax[n,m].scatter([self.y], [self.idx], color=self.color_pixel_selection, animated=True)
+            self.selection_markers.append(selection)
+
+        self._background = None
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+        # Pick pyramid levels on zoom, pan, and resize.
+        for i,_ in enumerate(self.cubes):
+            n,m = self.nth_image_as_index(i+1)
+            self.ax[n,m].callbacks.connect('xlim_changed', self._on_view_changed)
+            self.ax[n,m].callbacks.connect('ylim_changed', self._on_view_changed)
+        self.fig.canvas.mpl_connect('resize_event', self._on_view_changed)
+        self.update_levels()
+
     def connect_ui(self):
         """Connect mouse and keyboard."""
 
         self.connection_mouse = self.fig.canvas.mpl_connect('button_press_event', self.onclick)
         self.connection_button = self.fig.canvas.mpl_connect('key_press_event', self.keypress)
+        # Memory mapped band caches are removed when the window is closed.
+        self.fig.canvas.mpl_connect('close_event', lambda event: self.close())
 
     def disconnect_ui(self):
         """Disconnect mouse and keyboard."""
@@ -364,7 +596,7 @@ class CubeInspector:
                 between these two will reset the selection.
             click on line plot area in mode 1
                 Select new band and trigger image update.
-            click on any image in modes 1 or 2
+            click on any image in modes 1, 2, or 4
                 Select new pixel to plot spectra for.
             click on any image in mode 3
                 Select new reference point for cosine angle calculations.
@@ -427,21 +659,52 @@ class CubeInspector:
                 Select false color image mode.
             numkey 3
                 Select cosine angle mode.
+            numkey 4
+                Select principal component composite mode.
             r
                 Toggle between dot product and cosine angle in mode 3.
+            c
+                Toggle colour limits between band minimum and maximum and percentiles in mode 1.
             a
                 If in mode 3, move spectral filter to the left
             d
                 If in mode 3, move spectral filter to the right
+            a, d
+                If in mode 2, move false color band ranges to the left or right.
+            +, -
+                If in mode 2, widen or narrow false color band ranges.
+            u
+                If in mode 2 or 3, reload the control file.
+            m
+                Toggle between PCA and MNF components in mode 4.
         """
 
         key = event.key
-        if key == '1' or key == '2' or key == '3':
+        if key == '1' or key == '2' or key == '3' or key == '4':
             self.mode = int(key)
             self.show(mode=self.mode)
         if key == 'r':
             self.toggle_radians = not self.toggle_radians
             self.show(force_update=True)
+        if key == 'c' and self.mode == 1:
+            self.robust_limits = not self.robust_limits
+            self.show(force_update=True)
+        if key == 'm' and self.mode == 4:
+            self.component_method = components.MNF if self.component_method == components.PCA else components.PCA
+            self.components_calculated = False
+            self.show(force_update=True)
+        if self.mode == 2:
+            if key == 'a' or key == 'd':
+                self.shift_false_color_spectra(self.spectral_filter_step if key == 'd' else -self.spectral_filter_step)
+                self.show(force_update=True)
+            if key == '+' or key == '-':
+                step = self.false_color_resize_step if key == '+' else -self.false_color_resize_step
+                self.resize_false_color_spectra(step)
+                self.show(force_update=True)
+            if key == 'u':
+                self.reload_control()
+                self.reinit_false_color_spectra()
+                self.show(force_update=True)
         if self.mode == 3:      # How much the spectral filter is moved to left or right.            
             if key == 'a':      
                 low = self.spectral_filter.start - self.spectral_filter_step
@@ -482,7 +745,7 @@ class CubeInspector:
             self.sam_ref_x = np.clip(sam_ref_x, self.sam_window_start[0], self.sam_window_end[0]) 
             cos_ref_x_changed = True
 
-        acceptedModes = [1,2,3]
+        acceptedModes = [1,2,3,4]
         if mode is not None:
             if mode in acceptedModes:
                 self.mode = mode
@@ -500,13 +763,15 @@ class CubeInspector:
             force_update = True      
 
         # No need to update images if only pixel selection or cosine reference is changed.
-        if band_changed or mode_changed or cos_ref_x_changed or force_update:
+        full_redraw = band_changed or mode_changed or cos_ref_x_changed or force_update
+        if full_redraw:
             self.update_images()
 
-        self.update_spectrograms()
+        limits_changed = self.update_spectrograms()
         self.update_image_overlay()
         plt.show()
-        plt.draw() #redraw
+        # Pixel selection only moves lines and markers, which are blitted.
+        self.redraw(full=full_redraw or limits_changed)
     
     def update_images(self):
         """Updates images depending on selected mode.
@@ -515,10 +780,19 @@ class CubeInspector:
         """
 
         if self.mode == 1:
-            for i,cube in enumerate(self.cubes):
-                image_data = cube[self.viewable].isel({P.dim_x: self.x})
+            for i,cube in enumerate(self.accessors):
+                if self.band_caches:
+                    image_data = self.band_caches[i].band(self.x)
+                    low, high = self.band_caches[i].band_limits(self.x, robust=self.robust_limits)
+                else:
+                    image_data = np.asarray(cube.band(self.x))
+                    low, high = image_data.min(), image_data.max()
+                if self.levels[i] > 0:
+                    # Overview of the same area. Colour limits stay those of the full resolution.
+                    level = self.pyramids[i][self.levels[i] - 1]
+                    image_data = open_cube(level, self.viewable).band(self.x)
                 self.images[i].set_data(image_data)
-                self.images[i].set_norm(cm.colors.Normalize(image_data.min(), image_data.max()))
+                self.images[i].set_norm(cm.colors.Normalize(low, high))
            
             self.ax[0,1].set_title(f'ORG, band={self.x}', color=self.colors_org_lut_intr[0])
             if self.row_count == 2:
@@ -526,16 +800,13 @@ class CubeInspector:
                 self.ax[1,0].set_title(f'INTR, band={self.x}', color=self.colors_org_lut_intr[2])
         elif self.mode == 2:
             if not self.false_color_calculated:
-                self.false_images = calculate_false_color_images(self.cubes, self.viewable,
-                    self.spectral_blue, self.spectral_green, self.spectral_red)
-                # self.org_false, self.lut_false, self.intr_false = calculate_false_color_images(
-                #     self.org, self.lut, self.intr, self.viewable,
-                #     self.spectral_blue, self.spectral_green, self.spectral_red)
-                self.false_color_calculated = True
-            for i,image in enumerate(self.false_images):
-                self.images[i].set_data(image)
-
-            self.ax[0,1].set_title(f'ORG false color picture', color=self.colors_org_lut_intr[0])
+                self.calculate_false_colors()
+            else:
+                self._set_false_images(self.false_images, True)
+
+            r, g, b = self.spectral_red, self.spectral_green, self.spectral_blue
+            self.ax[0,1].set_title(f'ORG false color picture, R {r.start}-{r.stop}, G {g.start}-{g.stop}, '
+                                   f'B {b.start}-{b.stop}', color=self.colors_org_lut_intr[0])
             if self.row_count == 2:
                 self.ax[1,1].set_title(f'LUT false color picture', color=self.colors_org_lut_intr[1])
                 self.ax[1,0].set_title(f'INTR false color picture', color=self.colors_org_lut_intr[2])
@@ -549,22 +820,48 @@ class CubeInspector:
             if self.row_count == 2:
                 self.ax[1,1].set_title(f'LUT {cosType}', color=self.colors_org_lut_intr[1])
                 self.ax[1,0].set_title(f'INTR {cosType}', color=self.colors_org_lut_intr[2])
+        elif self.mode == 4:
+            if not self.components_calculated:
+                self.calculate_components()
+            else:
+                self._set_component_images(self.component_images, True)
+
+            method = self.component_method.upper()
+            self.ax[0,1].set_title(f'ORG {method} components 1-3 as RGB', color=self.colors_org_lut_intr[0])
+            if self.row_count == 2:
+                self.ax[1,1].set_title(f'LUT {method} components', color=self.colors_org_lut_intr[1])
+                self.ax[1,0].set_title(f'INTR {method} components', color=self.colors_org_lut_intr[2])
 
     def update_spectrograms(self):
-        """Update spectrogram view (top left) and its overlays."""
+        """Update spectrogram view (top left) and its overlays.
 
-        self.ax[0,0].clear()
-        if self.mode == 1 or self.mode == 2:
-            for i,cube in enumerate(self.cubes):
-                cube[self.viewable].isel({P.dim_y:self.y, P.dim_scan:self.idx}).plot(ax=self.ax[0,0], color=self.colors_org_lut_intr[i])
+        The lines are created once in init_plot() and only their data is changed here.
 
-            if self.use_color_checker_rgb:
-                # Reference color spectra
-                for i,_ in enumerate(self.rgb_vertical_chunks):
-                    rgb_chunk = self.org[self.viewable].isel({P.dim_y:self.rgb_horizontal_chunk, P.dim_scan:self.rgb_vertical_chunks[i]}).mean(dim=(P.dim_scan, P.dim_y))
-                    rgb_chunk.plot(ax=self.ax[0,0], color=self.colors_rbg[i])
+        Returns
+        -------
+            bool
+                True if the limits of the spectrogram axes changed, which requires
+                a full redraw instead of blitting.
+        """
 
+        spectra_visible = self.mode in (1, 2, 4)
+        for i,cube in enumerate(self.accessors):
+            line = self.spectrum_lines[i]
+            line.set_visible(spectra_visible)
+            if spectra_visible:
+                line.set_ydata(cube.spectrum(self.idx, self.y))
+        for line in self.rgb_lines:
+            line.set_visible(spectra_visible)
+        self.band_line.set_visible(self.mode == 1)
+        if self.mode == 1:
+            band = self.spectrum_lines[0].get_xdata()[self.x]
+            self.band_line.set_xdata([band, band])
+        for i,line in enumerate(self.sam_mean_lines):
+            line.set_visible(self.mode == 3 and i < len(self.sam_chunks_list))
+
+        if spectra_visible:
             self.ax[0,0].set_title('Spectrograms')
+            self.ax[0,0].set_ylabel(self.viewable)
         else:
             if self.toggle_radians:
                 cosType = 'Mean cosine angle'
@@ -574,77 +871,286 @@ class CubeInspector:
                 yLabel = 'dot product'
             self.ax[0,0].set_title(f"{cosType}, bands {self.spectral_filter.start} - {self.spectral_filter.stop}")
             self.ax[0,0].set_ylabel(yLabel)
-
-        if self.mode == 1:
-            #Redraw band selection indicator
-            _,ylim = self.ax[0,0].get_ylim()
-            xd = np.ones(2)*self.x
-            yd = np.array([0, np.max(self.cubes[0][self.viewable].isel({P.dim_y: self.y, P.dim_scan: self.idx}))])
-            self.ax[0,0].plot(xd,yd,color=self.color_pixel_selection)
-        elif self.mode == 3:
-            # Draw mean of each cos box.
+            # Mean of each cos box.
             for i,chunk in enumerate(self.sam_chunks_list):
-                xx = np.arange(len(chunk.y))
-                yy = np.mean(chunk, axis=0)
-                self.ax[0,0].plot(xx, yy, color=self.colors_org_lut_intr[i])
+                self.sam_mean_lines[i].set_data(np.arange(chunk.shape[1]), np.mean(chunk, axis=0))
+
+        return self._rescale_spectrogram()
+
+    def _rescale_spectrogram(self) -> bool:
+        """Fit spectrogram axes limits to visible lines if they do not fit already.
+
+        Limits are not shrunk unless the data would use less than
+        P.inspector_spectrogram_shrink_fraction of them, so that moving the pixel
+        selection usually keeps the limits and can be blitted.
+        """
+
+        lines = [line for line in self.spectrum_lines + self.rgb_lines + self.sam_mean_lines
+                 if line.get_visible() and len(line.get_xdata()) > 0]
+        if not lines:
+            return False
+        x = np.concatenate([np.asarray(line.get_xdata(), dtype=np.float64) for line in lines])
+        y = np.concatenate([np.asarray(line.get_ydata(), dtype=np.float64) for line in lines])
+        if not np.any(np.isfinite(y)):
+            return False
+        x_lim = (np.nanmin(x), np.nanmax(x))
+        y_low, y_high = np.nanmin(y), np.nanmax(y)
+        margin = 0.05 * (y_high - y_low) if y_high > y_low else 0.5
+        y_lim = (y_low - margin, y_high + margin)
+
+        ax = self.ax[0,0]
+        changed = False
+        if tuple(ax.get_xlim()) != x_lim and x_lim[1] > x_lim[0]:
+            ax.set_xlim(x_lim)
+            changed = True
+        low, high = ax.get_ylim()
+        fits = low <= y_low and y_high <= high
+        if not fits or (y_high - y_low) < P.inspector_spectrogram_shrink_fraction * (high - low):
+            ax.set_ylim(y_lim)
+            changed = True
+        return changed
 
     def update_image_overlay(self):
-        """Update decorations drawn over the images."""
+        """Update decorations drawn over the images.
 
-        # Remove decoration boxes from the matplotlib images.
-        for i,_ in enumerate(self.decorations_box):
-            self.decorations_box[i].remove()
+        The decorations are created once in init_plot(). Here they are moved and
+        shown or hidden depending on the mode.
+        """
 
-        # And clear them from the storage as well.
-        self.decorations_box = []
+        for box in self.rgb_boxes:
+            box.set_visible(self.mode in (1, 2, 4))
 
-        if (self.mode == 1 or self.mode == 2) and self.use_color_checker_rgb:
-            for i,rgbXChunk in enumerate(self.rgb_vertical_chunks):
-                bottomLeftCorner = (self.rgb_horizontal_chunk.start, rgbXChunk.start)
-                w = self.rgb_horizontal_chunk.stop - self.rgb_horizontal_chunk.start
-                h = rgbXChunk.stop-rgbXChunk.start
-                rgbBox = patches.Rectangle(bottomLeftCorner, w, h, edgecolor=self.colors_rbg[i],facecolor='none', linewidth=1)
-                self.decorations_box.append(rgbBox)
-        elif self.mode == 3:            
+        for box in self.sam_boxes:
+            box.set_visible(self.mode == 3)
+        if self.mode == 3:
             cos_ref = np.clip(self.sam_ref_x, self.sam_window_start[0], self.sam_window_end[0]) 
-            halfBox1 = patches.Rectangle((self.sam_window_start[0], self.sam_window_start[1]), cos_ref-self.sam_window_start[0], self.sam_window_end[1]-self.sam_window_start[1], edgecolor='white',facecolor='none', linewidth=1)
-            halfBox2 = patches.Rectangle((cos_ref, self.sam_window_start[1]), self.sam_window_end[0]-cos_ref, self.sam_window_end[1]-self.sam_window_start[1], edgecolor='white',facecolor='none', linewidth=1)
-            self.decorations_box.append(halfBox1)
-            self.decorations_box.append(halfBox2)
+            height = self.sam_window_end[1]-self.sam_window_start[1]
+            self.sam_boxes[0].set_bounds(self.sam_window_start[0], self.sam_window_start[1], cos_ref-self.sam_window_start[0], height)
+            self.sam_boxes[1].set_bounds(cos_ref, self.sam_window_start[1], self.sam_window_end[0]-cos_ref, height)
+
+        # Pixel selection dot for modes 1, 2, and 4
+        for selection in self.selection_markers:
+            selection.set_visible(self.mode in (1, 2, 4))
+            selection.set_offsets([[self.y, self.idx]])
+
+    def update_levels(self) -> bool:
+        """Choose the pyramid level of each image from the visible area and the axes size.
+
+        Returns
+        -------
+            bool
+                True if the level of any image changed.
+        """
 
-        for i,box in enumerate(self.decorations_box):
-            self.ax[0,1].add_patch(box)
+        changed = False
+        for i,_ in enumerate(self.cubes):
+            if not self.pyramids[i]:
+                continue
+            n,m = self.nth_image_as_index(i+1)
+            ax = self.ax[n,m]
+            x_low, x_high = ax.get_xlim()
+            y_low, y_high = ax.get_ylim()
+            visible = (abs(y_high - y_low), abs(x_high - x_low))
+            screen = (ax.bbox.height, ax.bbox.width)
+            level = cube_pyramid.choose_level(visible, screen, len(self.pyramids[i]))
+            if level != self.levels[i]:
+                self.levels[i] = level
+                changed = True
+        return changed
+
+    def _on_view_changed(self, _):
+        if self.update_levels() and self.mode == 1:
+            self.update_images()
+            self.fig.canvas.draw_idle()
+
+    def _animated_artists(self) -> list:
+        return [self.band_line] + self.spectrum_lines + self.rgb_lines + self.sam_mean_lines \
+               + self.selection_markers + self.sam_boxes
+
+    def _on_draw(self, event):
+        """Store the background for blitting after each full redraw and draw animated artists on it."""
+
+        if self.fig is None:
+            return
+        self._background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self._animated_artists():
+            if artist.get_visible():
+                self.fig.draw_artist(artist)
+
+    def redraw(self, full=True):
+        """Redraw the figure.
+
+        Parameters
+        ----------
+            full : bool, default True
+                If False, only lines and overlays are redrawn over the stored
+                background with blitting, which is much faster than a full redraw.
+                Falls back to a full redraw if blitting is not possible.
+        """
 
-        for i,scat in enumerate(self.decorations_selection):
-            self.decorations_selection[i].remove()
-        self.decorations_selection = []
-
-        # Add pixel selection dot for modes 1 and 2
-        if self.mode == 1 or self.mode == 2:
-            for i in range(2):
-                for j in range(2):
-                    if i==0 and j==0:
-                        continue
-                    try:
-                        selection = self.ax[i,j].scatter([self.y], [self.idx], color=self.color_pixel_selection)
-                        self.decorations_selection.append(selection)
-                    except IndexError as ie:
-                        # Triggers if less than two rows
-                        continue
+        canvas = self.fig.canvas
+        if full or self._background is None or not canvas.supports_blit:
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self._background)
+        self._draw_animated()
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def close(self):
+        """Stop background computations, release band caches and overview files, and close the figure."""
+
+        if self.poll_timer is not None:
+            self.poll_timer.stop()
+            self.poll_timer = None
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+
+        for cache in set(self.band_caches):
+            cache.close()
+        self.band_caches = []
+        # Lazily opened overview levels keep their cube files open, which blocks writing them.
+        for level in {id(level): level for levels in self.pyramids for level in levels}.values():
+            level.close()
+        if self.fig is not None:
+            fig = self.fig
+            self.fig = None
+            self.plot_inited = False
+            plt.close(fig)
+
+    def _compute(self, full_tasks, preview_tasks, on_result):
+        """Run per-cube tasks in the background, or right away if not asynchronous.
+
+        Preview tasks are only run if the full result is not quick to compute.
+        """
+
+        if self.scheduler is None:
+            on_result([task() for task in full_tasks], True)
+        else:
+            self.scheduler.submit([preview_tasks, full_tasks], on_result)
+
+    def calculate_false_colors(self):
+        """Calculates false color images of all cubes and sets them to image list."""
+
+        b, g, r = self.spectral_blue, self.spectral_green, self.spectral_red
+
+        def full(i):
+            return calculate_false_color_images([self.accessors[i]], self.viewable, b, g, r,
+                                                band_indices=[self._band_index(i)])[0]
+
+        def preview(i):
+            return calculate_false_color_images([self.accessors[i]], self.viewable, b, g, r, step=P.inspector_preview_step)[0]
+
+        count = len(self.cubes)
+        preview_tasks = [] if self._precomputed() else [lambda i=i: preview(i) for i in range(count)]
+        self._compute([lambda i=i: full(i) for i in range(count)], preview_tasks, self._set_false_images)
+
+    def _set_false_images(self, images, final):
+        if self.mode != 2:
+            return
+        self.false_images = images
+        self.false_color_calculated = final
+        for i,image in enumerate(images):
+            self.images[i].set_data(image)
+
+    def calculate_components(self):
+        """Calculates RGB composites of the first principal (or MNF) components of all cubes.
+
+        Each cube is fitted and projected separately in two streaming passes, so a
+        preview fitted from every P.inspector_preview_step'th pixel is shown first.
+        """
+
+        method = self.component_method
+        noise = [self._band_noise(i) for i in range(len(self.cubes))] if method == components.MNF else None
+
+        def composite(i, step):
+            model = components.fit_components(self.accessors[i], method=method, step=step,
+                                              noise=noise[i] if noise is not None else None)
+            return components.rgb_composite(model.project(self.accessors[i], step=step))
+
+        count = len(self.cubes)
+        self._compute([lambda i=i: composite(i, 1) for i in range(count)],
+                      [lambda i=i: composite(i, P.inspector_preview_step) for i in range(count)],
+                      self._set_component_images)
+
+    def _band_noise(self, i):
+        """Band noise variances of cube i for MNF from the dark frame noise map of the session.
+
+        The map applies to raw cubes as such. For reflectance cubes, the noise of each
+        pixel is divided by the white minus dark frame like the data. Returns None, so
+        that noise is estimated from the cube itself, if there is no session or noise
+        map, if the cube is desmiled or of another kind, or if the map does not match
+        the bands of the cube.
+        """
+
+        if self.session_name is None or i > 0 or self.viewable not in (P.naming_cube_data, P.naming_reflectance):
+            return None
+        session_root = P.path_rel_scan + self.session_name + '/'
+        noise_path = session_root + P.ref_dark_name + P.noise_map_suffix
+        if not os.path.exists(noise_path + '.nc'):
+            logging.info(f"No dark frame noise map in session '{self.session_name}'. "
+                         f"MNF noise is estimated from the cube.")
+            return None
+        noise_map = fm.crop_to_size(F.load_frame(noise_path)[P.naming_frame_data], self.control)
+
+        gain = None
+        if self.viewable == P.naming_reflectance:
+            white_path = session_root + P.ref_white_name
+            dark_path = session_root + P.ref_dark_name
+            if not os.path.exists(white_path + '.nc') or not os.path.exists(dark_path + '.nc'):
+                logging.info(f"No white and dark frames in session '{self.session_name}' to scale the noise "
+                             f"map to reflectance. MNF noise is estimated from the cube.")
+                return None
+            white = fm.crop_to_size(F.load_frame(white_path)[P.naming_frame_data], self.control)
+            dark = fm.crop_to_size(F.load_frame(dark_path)[P.naming_frame_data], self.control)
+            gain = white - dark
+
+        x_factor = int(getattr(self.cubes[i], 'attrs', {}).get(P.meta_key_binning_x, 1))
+        noise = components.band_noise_from_map(noise_map, x_factor, gain)
+        if noise.shape[0] != self.accessors[i].band_count or not np.all(np.isfinite(noise)):
+            logging.warning(f"Dark frame noise map does not match the {self.accessors[i].band_count} bands "
+                            f"of the cube. MNF noise is estimated from the cube.")
+            return None
+        return noise
+
+    def _set_component_images(self, images, final):
+        if self.mode != 4:
+            return
+        self.component_images = images
+        self.components_calculated = final
+        for i,image in enumerate(images):
+            self.images[i].set_data(image)
 
     def calculate_sams(self):
         """Calculates and saves spectral angle maps for all three cubes and sets them to image list."""
 
-        sams = []
-        self.sam_chunks_list = []
-        for i,cube in enumerate(self.cubes):
-            sam, cosMapChunk = calculate_sam(cube, self.sam_window_start, self.sam_window_end,
-                                             self.sam_ref_x, self.viewable, self.toggle_radians, self.spectral_filter)
-            sams.append(sam)
-            self.sam_chunks_list.append(cosMapChunk)
+        args = (self.sam_window_start, self.sam_window_end, self.sam_ref_x, self.viewable,
+                self.toggle_radians, self.spectral_filter)
+
+        def full(i):
+            return calculate_sam(self.accessors[i], *args, engine=self._similarity_engine(i))
+
+        def preview(i):
+            return calculate_sam(self.accessors[i], *args, step=P.inspector_preview_step)
+
+        count = len(self.cubes)
+        preview_tasks = [] if self._precomputed(engines=True) else [lambda i=i: preview(i) for i in range(count)]
+        self._compute([lambda i=i: full(i) for i in range(count)], preview_tasks, self._set_sams)
+
+    def _set_sams(self, results, final):
+        if self.mode != 3:
+            return
+        sams = [sam for sam,_ in results]
+        self.sam_chunks_list = [chunk for _,chunk in results]
 
         maxVal = np.max(np.array(list(np.max(chunk) for chunk in self.sam_chunks_list)))
 
         for i,sam in enumerate(sams):
             self.images[i].set_data(sam)
             self.images[i].set_norm(cm.colors.Normalize(sam.min(), maxVal))
+        # Mean similarity plot depends on the maps.
+        if self.scheduler is not None:
+            self.update_spectrograms()
@@ -0,0 +1,166 @@
+"""
+
+Multi-resolution overview pyramids of cubes.
+
+Level k of a pyramid is the cube reduced spatially (scan_index and y) by a
+factor of 2**k with block means, each level being computed from the previous
+one. Bands are not reduced. Levels are stored as extra groups of the cube's
+NetCDF file (P.pyramid_group_prefix + level), so the full resolution cube
+stays untouched and readers unaware of pyramids see no difference.
+
+A viewer picks the coarsest level that still has at least one data pixel per
+screen pixel in the visible area with choose_level(). A full view of a long
+scan then only touches a small overview, while zooming in falls back to the
+full resolution data.
+
+"""
+
+import logging
+import math
+import os
+import numpy as np
+import xarray as xr
+from xarray import Dataset
+
+from core import properties as P
+
+
+def _halve(values:np.ndarray, axis:int) -> np.ndarray:
+    """Block means of two along an axis. An odd last sample is paired with itself."""
+
+    if values.shape[axis] % 2 == 1:
+        pad = [(0, 0)] * values.ndim
+        pad[axis] = (0, 1)
+        values = np.pad(values, pad, mode='edge')
+    shape = values.shape[:axis] + (values.shape[axis] // 2, 2) + values.shape[axis + 1:]
+    return values.reshape(shape).mean(axis=axis + 1, dtype=np.float64)
+
+
+def reduce_level(cube:Dataset, chunk_bytes=P.pyramid_chunk_bytes) -> Dataset:
+    """Cube reduced by two in scan_index and y dimensions with block means.
+
+    Variables without both dimensions are dropped. Reduced float variables keep
+    their type and others become float32. The cube is reduced in chunks of an
+    even count of scan lines accumulated in float64, so a lazily opened level
+    is read a chunk at a time and only the reduced level is kept in memory.
+
+    Parameters
+    ----------
+        cube : Dataset
+            Cube or a previous level with dimensions (scan_index, y, x).
+        chunk_bytes : int
+            Approximate memory used by the float64 temporaries of one chunk.
+    """
+
+    data_vars = {}
+    for name, var in cube.data_vars.items():
+        if P.dim_scan not in var.dims or P.dim_y not in var.dims:
+            continue
+        others = [d for d in var.dims if d not in (P.dim_scan, P.dim_y)]
+        var = var.transpose(P.dim_scan, P.dim_y, *others)
+        scans, h = var.shape[:2]
+        dtype = var.dtype if np.issubdtype(var.dtype, np.floating) else np.float32
+        values = np.empty(((scans + 1) // 2, (h + 1) // 2) + var.shape[2:], dtype=dtype)
+        line_bytes = 8 * h * int(np.prod(var.shape[2:], dtype=np.int64))
+        lines = max(2, chunk_bytes // max(1, line_bytes))
+        lines -= lines % 2
+        for start in range(0, scans, lines):
+            block = np.asarray(var[start:min(scans, start + lines)].values)
+            values[start // 2:(start + block.shape[0] + 1) // 2] = _halve(_halve(block, 0), 1)
+        data_vars[name] = (var.dims, values, var.attrs)
+
+    coords = {}
+    for dim in (P.dim_scan, P.dim_y):
+        coords[dim] = _halve(np.asarray(cube[dim].values, dtype=np.float64), 0)
+    for name, coord in cube.coords.items():
+        if name not in coords and P.dim_scan not in coord.dims and P.dim_y not in coord.dims:
+            coords[name] = coord
+    return xr.Dataset(data_vars=data_vars, coords=coords, attrs=dict(cube.attrs))
+
+
+def build_pyramid(cube:Dataset, min_size=P.pyramid_min_size) -> list:
+    """Overview levels of a cube.
+
+    Parameters
+    ----------
+        cube : Dataset
+            Cube with dimensions (scan_index, y, x).
+        min_size : int
+            Levels are built until both spatial dimensions are at most this big.
+
+    Returns
+    -------
+        list of Datasets
+            Levels 1, 2, ... (the cube itself is level 0). Empty if the cube is small already.
+    """
+
+    levels = []
+    level = cube
+    while max(level[P.dim_scan].size, level[P.dim_y].size) > min_size:
+        level = reduce_level(level)
+        factor = 2 ** (len(levels) + 1)
+        level.attrs[P.meta_key_pyramid_factor] = factor
+        levels.append(level)
+    if levels:
+        logging.info(f"Built {len(levels)} overview levels down to a factor of {2 ** len(levels)}.")
+    return levels
+
+
+def _nc_path(path) -> str:
+    path_s = str(path)
+    if not path_s.endswith('.nc'):
+        path_s = path_s + '.nc'
+    return os.path.abspath(path_s)
+
+
+def save_pyramid(levels:list, path):
+    """Append overview levels as groups to an existing cube file."""
+
+    abs_path = _nc_path(path)
+    for k, level in enumerate(levels, start=1):
+        level.to_netcdf(abs_path, mode='a', group=f"{P.pyramid_group_prefix}{k}")
+
+
+def load_pyramid(path) -> list:
+    """Overview levels stored in a cube file. Empty if there are none.
+
+    The levels are opened lazily, so only the parts that are shown are read. They
+    keep the file open, so close them when done, e.g. before writing the file again.
+    """
+
+    abs_path = _nc_path(path)
+    levels = []
+    while True:
+        group = f"{P.pyramid_group_prefix}{len(levels) + 1}"
+        try:
+            levels.append(xr.open_dataset(abs_path, group=group))
+        except (OSError, KeyError):
+            break
+    return levels
+
+
+def choose_level(visible_size, screen_size, level_count:int) -> int:
+    """Coarsest level with at least one data pixel per screen pixel.
+
+    Parameters
+    ----------
+        visible_size : tuple of two floats
+            Visible area in full resolution data pixels (height, width).
+        screen_size : tuple of two floats
+            Size of the area on screen in pixels (height, width).
+        level_count : int
+            Count of available overview levels (excluding the full resolution).
+
+    Returns
+    -------
+        int
+            Pyramid level, 0 being the full resolution.
+    """
+
+    factors = [v / s for v, s in zip(visible_size, screen_size) if s > 0]
+    if not factors:
+        return 0
+    factor = min(factors)
+    if factor < 2:
+        return 0
+    return int(min(level_count, math.floor(math.log2(factor))))
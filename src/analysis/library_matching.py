@@ -0,0 +1,152 @@
+"""
+
+Classification of whole cubes against a spectral library.
+
+Every pixel spectrum of a cube is compared to every reference spectrum of a
+library with the spectral angle (SAM) or spectral correlation (SCM). The
+library is normalized once (mean centred for SCM) into a (bands, references)
+matrix. The cube is processed in chunks of scan lines. Each chunk is gathered
+into a contiguous (pixels, bands) float32 block and normalized, and its scores
+against all references are a single BLAS matrix product. Only the best score
+and its reference index are kept for each pixel, so memory stays bounded by the
+chunk size no matter how large the cube or the library is.
+
+Chunks are independent and NumPy releases the GIL in matrix products, so they
+are spread over a thread pool. If NumPy's BLAS is multithreaded itself, a
+couple of workers are usually enough.
+
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from core import properties as P
+from analysis.cube_accessor import cube_values
+
+
+def normalize_spectra(spectra, use_scm=False) -> np.ndarray:
+    """Spectra scaled to unit length, mean centred first for SCM.
+
+    Parameters
+    ----------
+        spectra : numpy array
+            Spectra as rows of a (count, bands) array.
+        use_scm : bool, default False
+            Centre each spectrum to zero mean before normalizing.
+
+    Returns
+    -------
+        numpy array
+            Normalized float32 spectra. Spectra of zero length stay zero.
+    """
+
+    spectra = np.array(spectra, dtype=np.float32)
+    if use_scm:
+        spectra -= spectra.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(spectra, axis=-1, keepdims=True)
+    np.divide(spectra, norm, out=spectra, where=norm > 0)
+    return spectra
+
+
+def _library_values(library) -> np.ndarray:
+    """Library as a (references, bands) numpy array."""
+
+    if hasattr(library, 'dims'):
+        # Band dimension last, whatever the reference dimension is called.
+        library = library.transpose(..., P.dim_x).values
+    library = np.asarray(library)
+    if library.ndim == 1:
+        library = library[np.newaxis, :]
+    return library
+
+
+def match_library(cube, library, viewable=None, use_scm=False, spectral_filter=None, min_score=None,
+                  use_radians=False, chunk_bytes=P.library_match_chunk_bytes, workers=None):
+    """Find the most similar library spectrum for each pixel of a cube.
+
+    Parameters
+    ----------
+        cube : Dataset, DataArray, numpy array, or CubeAccessor
+            Cube with dimensions (scan_index, y, x), x being the band axis.
+            See analysis.cube_accessor for other sources.
+        library : DataArray or numpy array
+            Reference spectra as a (references, bands) array. A DataArray may have
+            any name for the reference dimension as long as bands are along x.
+        viewable : str, optional
+            Data variable to use if cube is a Dataset.
+        use_scm : bool, default False
+            Use spectral correlation instead of spectral angle. Scores are mapped
+            from [-1, 1] to [0, 1] as in CubeInspector.
+        spectral_filter : slice, optional
+            Bands to use. Library spectra must either cover all bands of the cube or
+            exactly the filtered bands.
+        min_score : float, optional
+            Pixels whose best score is below this are marked with
+            P.library_match_unclassified in the class map.
+        use_radians : bool, default False
+            Return best scores as angles in radians instead of cosines.
+        chunk_bytes : int
+            Approximate memory used by one chunk of pixels and its scores.
+        workers : int, optional
+            Size of the thread pool. Defaults to the count of CPUs.
+
+    Returns
+    -------
+        class_map : numpy array
+            Index of the best matching reference of each pixel as a (scan_index, y) array.
+        score_map : numpy array
+            Best score of each pixel as a (scan_index, y) float32 array.
+    """
+
+    values = cube_values(cube, viewable)
+    scans, h, w = values.shape
+    sf = spectral_filter if spectral_filter is not None else slice(0, w)
+    band_count = len(range(*sf.indices(w)))
+
+    library = _library_values(library)
+    if library.shape[1] == w and band_count != w:
+        library = library[:, sf]
+    if library.shape[1] != band_count:
+        raise ValueError(f"Library spectra have {library.shape[1]} bands but {band_count} bands "
+                         f"of the cube are compared.")
+    # Normalized once and transposed so that scores = pixels @ references.
+    references = np.ascontiguousarray(normalize_spectra(library, use_scm).T)
+    reference_count = references.shape[1]
+
+    # Each pixel of a chunk needs its spectrum in float32 and a score for each reference.
+    pixel_bytes = 4 * (band_count + reference_count)
+    lines_per_chunk = max(1, chunk_bytes // max(1, h * pixel_bytes))
+
+    class_map = np.empty((scans, h), dtype=np.int32)
+    score_map = np.empty((scans, h), dtype=np.float32)
+
+    def match_chunk(start):
+        stop = min(scans, start + lines_per_chunk)
+        pixels = normalize_spectra(values[start:stop, :, sf].reshape(-1, band_count), use_scm)
+        scores = pixels @ references
+        best = np.argmax(scores, axis=1)
+        class_map[start:stop] = best.reshape(stop - start, h)
+        score_map[start:stop] = np.take_along_axis(scores, best[:, np.newaxis], axis=1).reshape(stop - start, h)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    starts = range(0, scans, lines_per_chunk)
+    if workers <= 1 or len(starts) == 1:
+        for start in starts:
+            match_chunk(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() re-raises exceptions of the workers.
+            list(executor.map(match_chunk, starts))
+    logging.info(f"Matched {scans * h} pixels against {reference_count} reference spectra "
+                 f"in {len(starts)} chunks.")
+
+    if use_scm:
+        score_map = score_map / 2 + 0.5
+    if min_score is not None:
+        class_map[score_map < min_score] = P.library_match_unclassified
+    if use_radians:
+        score_map = np.arccos(score_map.clip(min=-1.0, max=1.0))
+    return class_map, score_map
@@ -0,0 +1,138 @@
+"""
+
+Spectral similarity maps (SAM and SCM) with precomputed norms.
+
+The spectral angle between a reference spectrum a and a pixel spectrum b is
+a.b / (|a| |b|) and the spectral correlation (SCM) is the same for mean
+centred spectra. The dot products are computed as one batched BLAS
+matrix-vector product over the pixel-major cube. The pixel norms and means of
+any band range come from prefix sums of values and squared values along the
+band axis (see PrefixSumIndex), so moving the spectral filter or the
+reference does not require any other pass over the data.
+
+For SCM, the centred dot product is A.B = (a - mean(a)).b, because the centred
+reference sums to zero, and |B|^2 = sum(b^2) - sum(b)^2 / n. Thus SCM costs
+the same as SAM. The subtraction cancels most of the digits of the sums, so
+it is only used with an index stored in float64. Otherwise the centred norms
+are computed from the block of values that is read for the dot products anyway.
+
+"""
+
+import numpy as np
+
+from analysis.band_index import PrefixSumIndex
+from analysis.cube_accessor import cube_values
+
+
+class SpectralSimilarity:
+    """Computes SAM and SCM maps of a cube."""
+
+    def __init__(self, data, index:PrefixSumIndex=None, use_index=True):
+        """Create an engine for a cube.
+
+        Parameters
+        ----------
+            data : DataArray, numpy array, or CubeAccessor
+                Cube with dimensions (scan_index, y, x), x being the band axis.
+                See analysis.cube_accessor for other sources.
+            index : PrefixSumIndex, optional
+                Prefix-sum index of the same cube, e.g., one already built for false
+                color images. Sums of squares are added to it when needed.
+            use_index : bool, default True
+                If False and index is not given, norms are computed directly from the
+                data. This is cheaper for a single map, as nothing is precomputed.
+        """
+
+        self.values = cube_values(data)
+        if index is None and use_index:
+            index = PrefixSumIndex(self.values)
+        self.index = index
+
+    def spectral_range(self, spectral_filter:slice) -> slice:
+        """Spectral filter clipped to the bands of the cube. Never empty."""
+
+        band_count = self.values.shape[2]
+        start = int(np.clip(spectral_filter.start or 0, 0, band_count - 1))
+        stop = band_count if spectral_filter.stop is None else spectral_filter.stop
+        return slice(start, int(np.clip(stop, start + 1, band_count)))
+
+    def reference_spectrum(self, scan_slice:slice, y:int, spectral_filter:slice) -> np.ndarray:
+        """Mean spectrum of a vertical line (along scan_index) at y."""
+
+        spectral_filter = self.spectral_range(spectral_filter)
+        return self.values[scan_slice, y, spectral_filter].mean(axis=0, dtype=np.float64)
+
+    def _dot(self, block:np.ndarray, reference:np.ndarray) -> np.ndarray:
+        """Batched dot products of the spectra of block with reference."""
+
+        if np.issubdtype(block.dtype, np.floating):
+            # Stacked matrix-vector products run in BLAS on the strided view without copying.
+            return np.matmul(block, reference.astype(block.dtype)).astype(np.float64)
+        return np.matmul(block.astype(np.float64), reference)
+
+    def _sums(self, region, spectral_filter, block):
+        """Per-pixel sums of values and squares over spectral_filter."""
+
+        if self.index is not None:
+            start, stop = spectral_filter.start, spectral_filter.stop
+            return (self.index.region_sum(start, stop, region).astype(np.float64),
+                    self.index.square_sum(start, stop, region).astype(np.float64))
+        b = block.astype(np.float64)
+        return b.sum(axis=2), np.einsum('ijk,ijk->ij', b, b)
+
+    def _centred_terms(self, region, spectral_filter, block, centred):
+        """Per-pixel dot products with the centred reference and sums of squares of
+        mean centred values over spectral_filter."""
+
+        if self.index is not None and np.dtype(self.index.dtype) == np.float64:
+            value_sum, square_sum = self._sums(region, spectral_filter, block)
+            return (self._dot(block, centred),
+                    np.maximum(square_sum - value_sum * value_sum / block.shape[2], 0.0))
+        # Float32 sums would lose most of their precision in the subtraction above.
+        b = block.astype(np.float64)
+        b -= b.mean(axis=2, keepdims=True)
+        return np.matmul(b, centred), np.einsum('ijk,ijk->ij', b, b)
+
+    def similarity(self, scan_slice:slice, y_slice:slice, reference:np.ndarray, spectral_filter:slice,
+                   use_scm=False) -> np.ndarray:
+        """Similarity of each pixel in a window to a reference spectrum.
+
+        Parameters
+        ----------
+            scan_slice, y_slice : slice
+                Window in scan_index and y dimensions.
+            reference : numpy array
+                Reference spectrum over spectral_filter, e.g. from reference_spectrum().
+            spectral_filter : slice
+                Bands to use.
+            use_scm : bool, default False
+                Use spectral correlation instead of spectral angle. SCM is mapped from
+                [-1, 1] to [0, 1].
+
+        Returns
+        -------
+            numpy array
+                Normalized dot products of shape (scan_index, y) of the window.
+        """
+
+        spectral_filter = self.spectral_range(spectral_filter)
+        region = (scan_slice, y_slice)
+        block = self.values[scan_slice, y_slice, spectral_filter]
+        reference = np.asarray(reference, dtype=np.float64)
+
+        if not use_scm:
+            _, square_sum = self._sums(region, spectral_filter, block)
+            dot = self._dot(block, reference)
+            norm_ref = np.linalg.norm(reference)
+            norm_pix = np.sqrt(np.maximum(square_sum, 0.0))
+        else:
+            centred = reference - reference.mean()
+            dot, square_sum = self._centred_terms(region, spectral_filter, block, centred)
+            norm_ref = np.linalg.norm(centred)
+            norm_pix = np.sqrt(square_sum)
+
+        denominator = norm_ref * norm_pix
+        chunk = np.divide(dot, denominator, out=np.zeros_like(dot), where=denominator > 0)
+        if use_scm:
+            chunk = chunk / 2 + 0.5
+        return chunk
@@ -0,0 +1,228 @@
+"""
+
+Linear unmixing of whole cubes into endmember abundances.
+
+Each pixel spectrum x is modelled as a mix E a of endmember spectra, the
+columns of E, with non-negative abundances a (NNLS), which additionally sum
+to one in the fully constrained case (FCLS). The least squares objective
+only depends on the data through E^T x, so the Gram matrix G = E^T E is
+computed once, and a chunk of pixels is reduced to a single (pixels,
+endmembers) matrix product before solving.
+
+All pixels of a chunk are solved together with accelerated projected
+gradient (FISTA) on that small problem. The projection is a clip to zero for
+NNLS and an exact projection onto the probability simplex for FCLS, both
+vectorized over pixels. Momentum is restarted per pixel when it stops
+decreasing the objective, which keeps convergence fast with similar
+endmembers. Residuals are obtained from the same quantities without
+reconstructing the spectra.
+
+Chunks of scan lines are independent and can be solved in a thread pool or,
+where NumPy's elementwise operations limit the speed-up of threads, in a
+process pool. Only a bounded amount of chunks is in flight at a time, so
+memory stays independent of the cube size.
+
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+from core import properties as P
+from analysis.cube_accessor import cube_values
+from analysis.library_matching import _library_values
+
+NNLS = 'nnls'
+FCLS = 'fcls'
+
+
+def project_simplex(values:np.ndarray) -> np.ndarray:
+    """Project each row onto the probability simplex (non-negative, sums to one).
+
+    Uses the sort based algorithm of Duchi et al. (2008) for all rows at once.
+    """
+
+    count = values.shape[1]
+    ordered = -np.sort(-values, axis=1)
+    cumulative = np.cumsum(ordered, axis=1) - 1.0
+    positions = np.arange(1, count + 1)
+    # Last position where the sorted value stays above the threshold.
+    rho = count - 1 - np.argmax((ordered - cumulative / positions > 0)[:, ::-1], axis=1)
+    theta = cumulative[np.arange(values.shape[0]), rho] / (rho + 1)
+    return np.maximum(values - theta[:, np.newaxis], 0.0)
+
+
+def solve_abundances(gram:np.ndarray, correlations:np.ndarray, sum_to_one=False,
+                     max_iterations=P.unmixing_max_iterations, tolerance=P.unmixing_tolerance):
+    """Solve constrained least squares for a batch of pixels.
+
+    Parameters
+    ----------
+        gram : numpy array
+            Gram matrix E^T E (endmembers, endmembers) of the endmembers E.
+        correlations : numpy array
+            E^T x of each pixel as a (pixels, endmembers) array.
+        sum_to_one : bool, default False
+            Constrain abundances to sum to one (FCLS) in addition to being non-negative.
+        max_iterations : int
+            Maximum amount of iterations.
+        tolerance : float
+            Stop when no abundance changes more than this in an iteration.
+
+    Returns
+    -------
+        abundances : numpy array
+            (pixels, endmembers) array of abundances.
+        iterations : int
+            Amount of iterations used.
+    """
+
+    project = project_simplex if sum_to_one else (lambda a: np.maximum(a, 0.0))
+    # Step from the largest eigenvalue, i.e., the Lipschitz constant of the gradient.
+    step = 1.0 / max(np.linalg.eigvalsh(gram)[-1], np.finfo(np.float64).tiny)
+
+    # Unconstrained solution, projected, is a good start.
+    abundances = project(correlations @ np.linalg.pinv(gram))
+    momentum = abundances.copy()
+    t = np.ones(correlations.shape[0])
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        gradient = momentum @ gram - correlations
+        updated = project(momentum - step * gradient)
+        change = updated - abundances
+        t_next = (1.0 + np.sqrt(1.0 + 4.0 * t * t)) / 2.0
+        # Restart momentum of pixels whose update points uphill.
+        restart = np.einsum('ij,ij->i', momentum - updated, change) > 0
+        t_next[restart] = 1.0
+        momentum = updated + ((t - 1.0) / t_next)[:, np.newaxis] * change
+        momentum[restart] = updated[restart]
+        abundances = updated
+        t = t_next
+        if np.max(np.abs(change), initial=0.0) <= tolerance:
+            break
+    return abundances, iterations
+
+
+def _unmix_chunk(pixels, endmembers, gram, sum_to_one, max_iterations, tolerance):
+    """Abundances, residual RMS, and iterations of a (lines, y, bands) chunk.
+
+    Module level so that it can be run in a process pool.
+    """
+
+    lines, h, bands = pixels.shape
+    pixels = pixels.reshape(-1, bands).astype(np.float64)
+    correlations = pixels @ endmembers
+    abundances, iterations = solve_abundances(gram, correlations, sum_to_one, max_iterations, tolerance)
+    # |x - E a|^2 = |x|^2 - 2 a.E^T x + a.G a
+    squared = np.einsum('ij,ij->i', pixels, pixels) - 2.0 * np.einsum('ij,ij->i', abundances, correlations) \
+              + np.einsum('ij,ij->i', abundances @ gram, abundances)
+    residual = np.sqrt(np.maximum(squared, 0.0) / bands)
+    return (abundances.reshape(lines, h, -1).astype(np.float32), residual.reshape(lines, h).astype(np.float32),
+            iterations)
+
+
+def unmix(cube, endmembers, viewable=None, method=FCLS, spectral_filter=None,
+          max_iterations=P.unmixing_max_iterations, tolerance=P.unmixing_tolerance,
+          chunk_bytes=P.unmixing_chunk_bytes, workers=None, processes=False):
+    """Estimate endmember abundances of every pixel of a cube.
+
+    Parameters
+    ----------
+        cube : Dataset, DataArray, numpy array, or CubeAccessor
+            Cube with dimensions (scan_index, y, x), x being the band axis.
+            See analysis.cube_accessor for other sources.
+        endmembers : DataArray or numpy array
+            Endmember spectra as a (endmembers, bands) array. A DataArray may have
+            any name for the endmember dimension as long as bands are along x.
+        viewable : str, optional
+            Data variable to use if cube is a Dataset.
+        method : str, default FCLS
+            FCLS for non-negative abundances summing to one, NNLS for only non-negative.
+        spectral_filter : slice, optional
+            Bands to use. Endmembers must either cover all bands of the cube or exactly
+            the filtered bands.
+        max_iterations : int
+            Maximum amount of solver iterations per chunk.
+        tolerance : float
+            Solver stops when no abundance changes more than this in an iteration.
+        chunk_bytes : int
+            Approximate memory used by one chunk of pixels.
+        workers : int, optional
+            Size of the pool. Defaults to the count of CPUs.
+        processes : bool, default False
+            Use a process pool instead of a thread pool. Chunks are then copied to
+            the worker processes. On platforms that spawn processes, call this only
+            under an if __name__ == '__main__' guard.
+
+    Returns
+    -------
+        abundances : numpy array
+            (scan_index, y, endmember) float32 array of abundances.
+        residual : numpy array
+            (scan_index, y) float32 array of root mean square residuals over the bands.
+    """
+
+    if method not in (NNLS, FCLS):
+        raise ValueError(f"Unknown method '{method}'. Use '{NNLS}' or '{FCLS}'.")
+    values = cube_values(cube, viewable)
+    scans, h, w = values.shape
+    sf = spectral_filter if spectral_filter is not None else slice(0, w)
+    band_count = len(range(*sf.indices(w)))
+
+    endmembers = np.asarray(_library_values(endmembers), dtype=np.float64)
+    if endmembers.shape[1] == w and band_count != w:
+        endmembers = endmembers[:, sf]
+    if endmembers.shape[1] != band_count:
+        raise ValueError(f"Endmembers have {endmembers.shape[1]} bands but {band_count} bands "
+                         f"of the cube are unmixed.")
+    # (bands, endmembers) so that correlations = pixels @ endmembers.
+    endmembers = np.ascontiguousarray(endmembers.T)
+    gram = endmembers.T @ endmembers
+    count = endmembers.shape[1]
+
+    # Float64 copy of the chunk and a few (pixels, endmembers) solver arrays.
+    pixel_bytes = 8 * (band_count + 6 * count)
+    lines_per_chunk = max(1, chunk_bytes // max(1, h * pixel_bytes))
+    abundances = np.empty((scans, h, count), dtype=np.float32)
+    residual = np.empty((scans, h), dtype=np.float32)
+    sum_to_one = method == FCLS
+    starts = range(0, scans, lines_per_chunk)
+    max_used = 0
+
+    def read(start):
+        return np.asarray(values[start:min(scans, start + lines_per_chunk), :, sf])
+
+    def store(start, result):
+        nonlocal max_used
+        chunk_abundances, chunk_residual, iterations = result
+        stop = start + chunk_abundances.shape[0]
+        abundances[start:stop] = chunk_abundances
+        residual[start:stop] = chunk_residual
+        max_used = max(max_used, iterations)
+
+    args = (endmembers, gram, sum_to_one, max_iterations, tolerance)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(starts) == 1:
+        for start in starts:
+            store(start, _unmix_chunk(read(start), *args))
+    else:
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor_class(max_workers=workers) as executor:
+            # Keep only a couple of chunks per worker in flight to bound memory.
+            pending = []
+            for start in starts:
+                pending.append((start, executor.submit(_unmix_chunk, read(start), *args)))
+                if len(pending) >= 2 * workers:
+                    done_start, future = pending.pop(0)
+                    store(done_start, future.result())
+            for done_start, future in pending:
+                store(done_start, future.result())
+
+    if max_used >= max_iterations:
+        logging.warning(f"Unmixing did not converge to tolerance {tolerance} in {max_iterations} iterations "
+                        f"in all chunks.")
+    logging.info(f"Unmixed {scans * h} pixels into {count} endmembers with {method.upper()} "
+                 f"in {len(starts)} chunks.")
+    return abundances, residual
@@ -0,0 +1,261 @@
+"""
+
+Camera interface for GenICam cameras through camazing.
+
+camazing is imported only when the camera is created. Frames provided by camazing
+are already DataArrays with x and y dimensions, so they are returned as they are.
+
+"""
+
+import logging
+from xarray import DataArray
+
+from core import properties as P
+from core import camera_backends
+from core import running_statistics
+
+
+class CamazingCameraInterface:
+    """Camera interface for the GenICam camera used with the imager."""
+
+    def __init__(self, camera_settings_path=None):
+        """Initialize the first camera found.
+
+        Parameters
+        ----------
+            camera_settings_path : str, optional
+                Camera settings file to be loaded after initialization.
+
+        Raises
+        ------
+            RuntimeError
+                if no camera is found.
+        """
+
+        from camazing import CameraList
+
+        logging.debug("Initializing camera interface")
+        cameras = CameraList()
+        if len(cameras) < 1:
+            raise RuntimeError(f"Could not find any camera.")
+        self._cam = cameras[0]
+        self._cam.initialize()
+        logging.info(f"Camera '{self._cam}' initialized successfully")
+        if camera_settings_path is not None:
+            self.load_camera_settings(camera_settings_path)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Stop acquisition and release the camera."""
+
+        if getattr(self, '_cam', None) is not None:
+            self.turn_off()
+            self._cam = None
+
+    def turn_on(self):
+        """Start acquisition."""
+
+        if not self._cam.is_acquiring():
+            logging.debug("Turning camera on.")
+            self._cam.start_acquisition()
+
+    def turn_off(self):
+        """Stop acquisition."""
+
+        if self._cam.is_acquiring():
+            logging.debug("Turning camera off.")
+            self._cam.stop_acquisition()
+
+    def get_frame(self) -> DataArray:
+        """Acquire a single frame. Camera state (acquiring or not) will be preserved."""
+
+        camera_was_acquiring = self._cam.is_acquiring()
+        if not camera_was_acquiring:
+            self._cam.start_acquisition()
+        frame = self._cam.get_frame()
+        if not camera_was_acquiring:
+            self._cam.stop_acquisition()
+        return frame
+
+    def stream(self, count=None):
+        """Stream frames while keeping the acquisition running.
+
+        Frames carry the 'timestamp' of the camera and a 'frame_counter' coordinate.
+        Close the generator (or exhaust it) to stop streaming.
+
+        Parameters
+        ----------
+        count : int, optional
+            Amount of frames to stream. If None, streams until the generator is closed.
+
+        Yields
+        ------
+        frame : DataArray
+            Streamed frame.
+        """
+
+        camera_was_acquiring = self._cam.is_acquiring()
+        if not camera_was_acquiring:
+            self._cam.start_acquisition()
+        n = 0
+        try:
+            while count is None or n < count:
+                frame = self._cam.get_frame()
+                if 'frame_counter' not in frame.coords:
+                    frame.coords['frame_counter'] = n
+                yield frame
+                n += 1
+        finally:
+            if not camera_was_acquiring:
+                self._cam.stop_acquisition()
+
+    def run_stream(self, callback, count=None):
+        """Stream frames to a callback until it returns False or count frames are done."""
+
+        return camera_backends.run_stream(self, callback, count)
+
+    def frame_rate(self, value=None):
+        """Set or return the acquisition frame rate."""
+
+        if value is None:
+            return self._cam[P.cam_frame_rate].value
+        self._set_camera_feature(P.cam_frame_rate, value)
+
+    def get_frame_opt(self, count=1, method='mean', return_statistics=False) -> DataArray:
+        """Acquire a frame which is a mean or median of several frames.
+
+        Camera state (acquiring or not) will be preserved.
+
+        Parameters
+        ----------
+        count : int, default=1
+            If given, the mean of 'mean' consecutive frames is returned. If count == 1
+            this is the same as get_frame().
+        method: str, default = 'mean'
+            Either 'mean' or 'median' of count consecutive frames.
+        return_statistics : bool, default False
+            If True, the running statistics of the frames are returned as well.
+            Use its noise_map() for quality control of the frame.
+
+        Returns
+        -------
+        frame : DataArray
+            The shot frame.
+        statistics : RunningStatistics
+            Only if return_statistics is True.
+        """
+
+        stats = running_statistics.accumulate(self.stream(count), count, method)
+        frame = stats.frame(method)
+        if return_statistics:
+            return frame, stats
+        return frame
+
+    def exposure(self, value=None):
+        """Set or return exposure in microseconds."""
+
+        if value is None:
+            return self._cam[P.cam_exposure_time].value
+        self._set_camera_feature(P.cam_exposure_time, value)
+
+    def width(self) -> int:
+        """Current frame width in pixels."""
+
+        return self._cam[P.cam_width].value
+
+    def height(self) -> int:
+        """Current frame height in pixels."""
+
+        return self._cam[P.cam_height].value
+
+    def _set_camera_feature(self, name, val):
+        """Change camera settings.
+
+        Acquisition is stopped for the change and restarted if it was running.
+
+        Parameters
+        ----------
+        name : string
+            Name of the feature e.g. 'ExposureTime'
+        val :
+            Value to be set. Depending on the feature this might
+            be int, string, bool etc.
+        """
+
+        camera_was_acquiring = self._cam.is_acquiring()
+        if camera_was_acquiring:
+            self._cam.stop_acquisition()
+        try:
+            self._cam[name].value = val
+        except Exception as e:
+            logging.error(f"Could not set the feature {name}. Error: {e}")
+        finally:
+            if camera_was_acquiring:
+                self._cam.start_acquisition()
+
+    def crop(self, width=None, width_offset=None, height=None, height_offset=None, full=False):
+        """Crop the frame in sensor pixels.
+
+        Parameters
+        ----------
+            width, width_offset, height, height_offset : int, optional
+                New crop. None keeps the old value.
+            full : bool, default False
+                If True, the full sensor is used and other parameters are ignored.
+
+        Returns
+        -------
+            old : tuple
+                Crop before the call as (width, width_offset, height, height_offset).
+            new : tuple
+                Crop after the call in the same format.
+        """
+
+        old = self._crop_tuple()
+        if full:
+            # Offsets first so that maximum width and height are available.
+            self._set_camera_feature(P.cam_offset_x, 0)
+            self._set_camera_feature(P.cam_offset_y, 0)
+            self._set_camera_feature(P.cam_width, self._cam[P.cam_width].max)
+            self._set_camera_feature(P.cam_height, self._cam[P.cam_height].max)
+        else:
+            # Shrink before moving so that the crop stays inside the sensor.
+            if width is not None:
+                self._set_camera_feature(P.cam_width, int(width))
+            if height is not None:
+                self._set_camera_feature(P.cam_height, int(height))
+            if width_offset is not None:
+                self._set_camera_feature(P.cam_offset_x, int(width_offset))
+            if height_offset is not None:
+                self._set_camera_feature(P.cam_offset_y, int(height_offset))
+        return old, self._crop_tuple()
+
+    def _crop(self, width=None, width_offset=None, height=None, height_offset=None, full=False):
+        return self.crop(width, width_offset, height, height_offset, full)
+
+    def _crop_tuple(self):
+        return (self._cam[P.cam_width].value, self._cam[P.cam_offset_x].value,
+                self._cam[P.cam_height].value, self._cam[P.cam_offset_y].value)
+
+    def get_crop_meta_dict(self) -> dict:
+        """Current crop as a dictionary using camera feature names."""
+
+        w, wo, h, ho = self._crop_tuple()
+        return {P.cam_width: w, P.cam_offset_x: wo, P.cam_height: h, P.cam_offset_y: ho}
+
+    def load_camera_settings(self, path):
+        """Load and apply camera settings from a file."""
+
+        camera_was_acquiring = self._cam.is_acquiring()
+        if camera_was_acquiring:
+            self._cam.stop_acquisition()
+        self._cam.load_config_from_file(path)
+        if camera_was_acquiring:
+            self._cam.start_acquisition()
+
+    def save_camera_settings(self, path):
+        """Save current camera settings to a file."""
+
+        self._cam.save_config_to_file(path, overwrite=True)
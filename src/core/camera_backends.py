@@ -0,0 +1,132 @@
+"""
+
+Registry of camera backends.
+
+A backend is registered with the module and class names of its camera interface, so the
+driver (picamera, camazing, etc.) is imported only when a camera of that backend is
+actually created. Importing the rest of the program does not require any camera driver.
+
+The backend is selected in the following order:
+1. backend argument of create_camera_interface()
+2. environment variable named in core.properties (env_camera_backend)
+3. 'backend' key of the camera settings file
+4. default backend defined in core.properties
+
+"""
+
+import importlib
+import logging
+import os
+import toml
+from toml import TomlDecodeError
+
+from core import properties as P
+
+# Backend name -> (module name, class name)
+_backends = {}
+
+
+def register_backend(name:str, module_name:str, class_name:str):
+    """Register a camera backend.
+
+    Parameters
+    ----------
+        name : str
+            Name used to select the backend.
+        module_name : str
+            Module containing the camera interface class. Not imported until needed.
+        class_name : str
+            Name of the camera interface class in the module.
+    """
+
+    _backends[name] = (module_name, class_name)
+
+
+def available_backends() -> list:
+    """Names of registered backends."""
+
+    return list(_backends.keys())
+
+
+def get_backend_class(name:str):
+    """Imports the module of the named backend and returns its camera interface class.
+
+    Raises
+    ------
+        ValueError
+            if no backend with given name is registered.
+    """
+
+    if name not in _backends:
+        raise ValueError(f"Unknown camera backend '{name}'. Available backends are {available_backends()}.")
+    module_name, class_name = _backends[name]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+def resolve_backend_name(camera_settings_path=None, backend=None) -> str:
+    """Decide which backend to use. See module documentation for the order."""
+
+    if backend is not None:
+        return backend
+
+    env_backend = os.environ.get(P.env_camera_backend)
+    if env_backend:
+        return env_backend
+
+    if camera_settings_path is not None and os.path.exists(camera_settings_path):
+        try:
+            with open(camera_settings_path, 'r') as file:
+                settings = toml.load(file)
+            if P.cam_key_backend in settings:
+                return settings[P.cam_key_backend]
+        except TomlDecodeError as tde:
+            logging.error(tde)
+
+    return P.default_camera_backend
+
+
+def create_camera_interface(camera_settings_path=None, backend=None, **kwargs):
+    """Create a camera interface of the selected backend.
+
+    Parameters
+    ----------
+        camera_settings_path : str, optional
+            Camera settings file passed on to the camera interface. Also used to select the backend.
+        backend : str, optional
+            Name of the backend. Overrides other means of selection.
+        kwargs
+            Passed on to the constructor of the camera interface.
+
+    Returns
+    -------
+        Camera interface object of the selected backend.
+    """
+
+    name = resolve_backend_name(camera_settings_path, backend)
+    logging.info(f"Using camera backend '{name}'.")
+    cls = get_backend_class(name)
+    return cls(camera_settings_path, **kwargs)
+
+
+def run_stream(cami, callback, count=None):
+    """Feed frames of cami.stream() to callback until it returns False.
+
+    Shared by all camera backends. Returns the amount of streamed frames.
+    """
+    n = 0
+    stream = cami.stream(count)
+    try:
+        for frame in stream:
+            n += 1
+            if callback(frame) is False:
+                break
+    finally:
+        stream.close()
+    return n
+
+
+register_backend(P.backend_picamera, 'core.camera_interface', 'CameraInterface')
+register_backend(P.backend_camazing, 'core.camazing_camera', 'CamazingCameraInterface')
+register_backend(P.backend_simulated, 'core.simulated_camera', 'SimulatedCameraInterface')
+register_backend(P.backend_replay, 'core.simulated_camera', 'ReplayCameraInterface')
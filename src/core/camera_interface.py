@@ -1,26 +1,53 @@
 
 
 import logging
-import xarray as xr
-from xarray import DataArray
 import os
+import toml
+from xarray import DataArray
 
 from core import properties as P
-from utilities import numeric as N
-from PIL import Image
+from core import camera_backends
+from core import running_statistics
 from io import BytesIO
 import numpy as np
-from xarray import DataArray
 from time import sleep
-from picamera import PiCamera
-from picamera import PiCameraError
-
 
+# picamera and PIL are imported only when a camera is created, so that the rest
+# of the program can be used without them. See core.camera_backends.
 
 _camera=None
+
+
 class CameraInterface:
-    def __init__(self):
-        """Initialize the Raspberry Pi Camera."""
+    def __init__(self, camera_settings_path=None, capture_format=P.default_capture_format, zero_copy=False):
+        """Initialize the Raspberry Pi Camera.
+
+        Parameters
+        ----------
+        camera_settings_path : str, optional
+            Camera settings file. Used for backend selection and for the capture
+            format, which overrides capture_format parameter if found.
+        capture_format : str, default 'yuv'
+            Either 'yuv' for raw unencoded capture of which the luminance plane is
+            used, or 'jpeg' for the old JPEG encoded capture. JPEG compression
+            corrupts the radiometry and takes time to decode, so use it only if needed.
+        zero_copy : bool, default False
+            If True and capture format is 'yuv', get_frame() returns a DataArray that wraps
+            the capture buffer without copying. The data is overwritten by the next capture,
+            so copy the frame if you want to keep it.
+        """
+        from picamera import PiCamera
+        from picamera import PiCameraError
+
+        self._camera = None
+        self.capture_format = capture_format
+        self.zero_copy = zero_copy
+        # Preallocated buffer for raw captures and the resolution it was made for.
+        self._raw_buffer = None
+        self._raw_resolution = None
+        if camera_settings_path is not None and os.path.exists(camera_settings_path):
+            with open(camera_settings_path, 'r') as file:
+                self.capture_format = toml.load(file).get(P.cam_key_capture_format, capture_format)
         try:
             logging.debug("Initializing camera interface")
             self._camera = PiCamera()
@@ -30,11 +57,10 @@ class CameraInterface:
             logging.error(f"Unable to initialize the camera: {e}")
             self._camera = None
 
+    def __del__(self):
+        self.close()
 
-def __del__(self):
-    self.close()
- 
-def close(self):
+    def close(self):
         """Stop preview """
         if self._camera is not None:
             try:
@@ -44,7 +70,7 @@ def close(self):
             except Exception as e:
                 logging.error(f"An error occurred while closing the camera: {e}")
 
-def turn_on(self):
+    def turn_on(self):
         """Start camera preview."""
         if self._camera is not None:
             try:
@@ -52,97 +78,197 @@ def turn_on(self):
                 self._camera.start_preview()
             except Exception as e:
                 logging.error(f"Failed to start camera preview: {e}")
-                
-def turn_off(self):
+
+    def turn_off(self):
         """Stop camera preview."""
         if self._camera is not None:
             try:
                 logging.debug("Turning camera off.")
                 self._camera.stop_preview()
             except Exception as e:
-                logging.error(f"Failed to stop camera preview: {e}") 
+                logging.error(f"Failed to stop camera preview: {e}")
 
+    def _raw_luminance_view(self) -> np.ndarray:
+        """Returns a (height, width) view to the luminance plane of the raw capture buffer.
 
-def get_frame(self) -> DataArray:
-    """Capture a frame using the PiCamera library and return it as a DataArray."""
-    if self._camera is not None:
-        try:
-            logging.debug("Capturing image")
-            
-            # Capture an image using PiCamera
+        The buffer is allocated once per resolution. YUV420 frames are padded by the
+        camera to multiples of 32 (width) and 16 (height) pixels.
+        """
+        resolution = tuple(self._camera.resolution)
+        if self._raw_buffer is None or self._raw_resolution != resolution:
+            width, height = resolution
+            padded_w = (width + 31) // 32 * 32
+            padded_h = (height + 15) // 16 * 16
+            self._raw_buffer = np.empty((padded_w * padded_h * 3 // 2,), dtype=np.uint8)
+            self._raw_luminance = self._raw_buffer[:padded_w * padded_h].reshape((padded_h, padded_w))[:height, :width]
+            self._raw_resolution = resolution
+        return self._raw_luminance
+
+    def _capture_array(self) -> np.ndarray:
+        """Capture a frame into a numpy array.
+
+        For raw captures the returned array is a view to the capture buffer.
+        """
+        if self.capture_format == 'jpeg':
+            from PIL import Image
             stream = BytesIO()
             self._camera.capture(stream, format='jpeg')
             stream.seek(0)
-            
-            # Convert the captured image to a DataArray
-            image = Image.open(stream)
-            image_array = np.array(image)
-            data_array = DataArray(image_array)
-            
-            logging.info("Image captured successfully")
-            return data_array
-        except Exception as e:
-            logging.error(f"Failed to capture image: {e}")
-    
-    return None 
-
-
-def get_frame_opt(self, count=1, method='mean') -> DataArray:
-    """Acquire a frame which is a mean or median of several frames.
-    
-    Camera state (acquiring or not) will be preserved.
-
-    Parameters
-    ----------
-    count : int, default=1
-        If given, the mean of 'mean' consecutive frames is returned. If count == 1
-        this is the same as get_frame().
-    method: str, default = 'mean'
-        Either 'mean' or 'median' of count consecutive frames.
-
-    Returns
-    -------
-    frame : DataArray
-        The shot frame.
-    """
-    
-    if self._camera is not None:
+            return np.array(Image.open(stream))
+
+        luminance = self._raw_luminance_view()
+        # picamera writes unencoded data straight into objects supporting the buffer protocol.
+        self._camera.capture(self._raw_buffer, format='yuv')
+        return luminance
+
+    def _to_data_array(self, image_array) -> DataArray:
+        """Wraps a 2D image array as a frame DataArray."""
+        if image_array.ndim != 2:
+            return DataArray(image_array)
+        coords = {
+            P.dim_x: (P.dim_x, np.arange(0, image_array.shape[1]) + 0.5),
+            P.dim_y: (P.dim_y, np.arange(0, image_array.shape[0]) + 0.5),
+        }
+        return DataArray(image_array, name=P.naming_frame_data, dims=P.dim_order_frame, coords=coords)
+
+    def get_frame(self) -> DataArray:
+        """Capture a frame using the PiCamera library and return it as a DataArray."""
+        if self._camera is not None:
+            try:
+                logging.debug("Capturing image")
+                image_array = self._capture_array()
+                if self.capture_format != 'jpeg' and not self.zero_copy:
+                    image_array = image_array.copy()
+                return self._to_data_array(image_array)
+            except Exception as e:
+                logging.error(f"Failed to capture image: {e}")
+
+        return None
+
+    def get_frame_opt(self, count=1, method='mean', return_statistics=False) -> DataArray:
+        """Acquire a frame which is a mean or median of several frames.
+
+        Camera state (acquiring or not) will be preserved.
+
+        Parameters
+        ----------
+        count : int, default=1
+            If given, the mean of 'mean' consecutive frames is returned. If count == 1
+            this is the same as get_frame().
+        method: str, default = 'mean'
+            Either 'mean' or 'median' of count consecutive frames.
+        return_statistics : bool, default False
+            If True, the running statistics of the frames are returned as well.
+            Use its noise_map() for quality control of the frame.
+
+        Returns
+        -------
+        frame : DataArray
+            The shot frame. None if the frames could not be acquired.
+        statistics : RunningStatistics
+            Only if return_statistics is True. None if the frames could not be acquired.
+        """
+
+        if self._camera is not None:
+            try:
+                # Check if the camera is currently previewing
+                camera_was_acquiring = self._camera.previewing
+                if not camera_was_acquiring:
+                    self._camera.start_preview()
+
+                # Frames are accumulated one by one straight from the capture buffer.
+                stats = running_statistics.accumulate(self.stream(count), count, method)
+                frame = stats.frame(method)
+
+                # Stop the preview if it wasn't previewing before the function call
+                if not camera_was_acquiring:
+                    self._camera.stop_preview()
+
+                if return_statistics:
+                    return frame, stats
+                return frame
+            except Exception as e:
+                logging.error(f"Failed to acquire frames: {e}")
+
+        if return_statistics:
+            return None, None
+        return None
+
+    def stream(self, count=None):
+        """Stream frames continuously through the video port.
+
+        The sensor keeps running between frames, so frames arrive at the rate set
+        with frame_rate(). Frames carry the hardware timestamp (seconds) and frame
+        counter of the camera as 'timestamp' and 'frame_counter' coordinates.
+        Close the generator (or exhaust it) to stop streaming.
+
+        Parameters
+        ----------
+        count : int, optional
+            Amount of frames to stream. If None, streams until the generator is closed.
+
+        Yields
+        ------
+        frame : DataArray
+            Streamed frame. With zero_copy, the data is overwritten by the next frame.
+        """
+        if self._camera is None:
+            return
+
+        if self.capture_format == 'jpeg':
+            from PIL import Image
+            output = BytesIO()
+        else:
+            luminance = self._raw_luminance_view()
+            output = self._raw_buffer
+
+        n = 0
+        frames = self._camera.capture_continuous(output, format=self.capture_format, use_video_port=True)
         try:
-            # Check if the camera is currently previewing
-            camera_was_acquiring = self._camera.previewing
-            if not camera_was_acquiring:
-                self._camera.start_preview()
-            
-            frames = []
-            for _ in range(count):
-                stream = BytesIO()
-                self._camera.capture(stream, format='jpeg')
-                stream.seek(0)
-                image = Image.open(stream)
-                image_array = np.array(image)
-                frames.append(DataArray(image_array))
-            
-            frame = xr.concat(frames, dim='timestamp')
-            
-            if method == 'mean':
-                frame = frame.mean(dim='timestamp')
-            elif method == 'median':
-                frame = frame.median(dim='timestamp')
-            else:
-                logging.error(f"Shooting method '{method}' not recognized. Use either 'mean' or 'median'.")
-            
-            # Stop the preview if it wasn't previewing before the function call
-            if not camera_was_acquiring:
-                self._camera.stop_preview()
-            
-            return frame
-        except Exception as e:
-            logging.error(f"Failed to acquire frames: {e}")
-    
-    return None
+            for _ in frames:
+                if self.capture_format == 'jpeg':
+                    output.seek(0)
+                    image_array = np.array(Image.open(output))
+                    output.seek(0)
+                    output.truncate()
+                elif self.zero_copy:
+                    image_array = luminance
+                else:
+                    image_array = luminance.copy()
+
+                frame = self._to_data_array(image_array)
+                frame_info = self._camera.frame
+                if frame_info is not None:
+                    if frame_info.timestamp is not None:
+                        frame.coords['timestamp'] = frame_info.timestamp * 1e-6
+                    frame.coords['frame_counter'] = frame_info.index
+                yield frame
+
+                n += 1
+                if count is not None and n >= count:
+                    break
+        finally:
+            frames.close()
+
+    def run_stream(self, callback, count=None):
+        """Stream frames to a callback until it returns False or count frames are done.
+
+        Parameters
+        ----------
+        callback : callable
+            Called with each streamed frame.
+        count : int, optional
+            Amount of frames to stream. If None, streams until callback returns False.
+        """
+        return camera_backends.run_stream(self, callback, count)
 
+    def frame_rate(self, value=None):
+        """Set or return the frame rate of the video port streaming."""
+        if value is None:
+            return float(self._camera.framerate)
+        self._camera.framerate = value
 
-def exposure(self, value=None):
+    def exposure(self, value=None):
         """Set or print exposure"""
         if value is None:
             return self._camera.exposure_speed
@@ -150,9 +276,8 @@ def exposure(self, value=None):
             self._camera.exposure_mode = 'off'  # Disable automatic exposure
             self._camera.shutter_speed = value  # Set the exposure time in microseconds
 
-
-def _set_camera_feature(self, name, val):
- """Change camera settings.
+    def _set_camera_feature(self, name, val):
+        """Change camera settings.
 
         Note: OutOfRangeException related to features with certain increment
         (e.g. height, width) throws an exception which cannot be handle here.
@@ -164,46 +289,40 @@ def _set_camera_feature(self, name, val):
         val :
             Value to be set. Depending on the feature this might
             be int, string, bool etc.
-    """
- if name in self._camera:
-        camera_was_acquiring = self._camera.recording  # Check if the camera is currently recording
-        try:
-            # Try to set the value even if live feed is running.
-            setattr(self._camera, name, val)
-            print(f"Feature '{name}' was successfully set to {val}.")
-        except Exception as e:
-            logging.error(f"Could not set the feature {name}. Error: {e}")
-        finally:
-            # If the camera was recording, restart the recording
-            if camera_was_acquiring:
-                self._camera.start_recording()
-
- else:
-        logging.warning(f"Feature '{name}' is not available in PiCamera.")
- 
- 
- 
- 
-            
-def crop(self, x=0.0, y=0.0, width=1.0, height=1.0):
-    """Set camera zoom to simulate cropping.
-
-    Parameters
-    ----------
-    x : float
-        The horizontal position of the zoom area (0.0 to 1.0)
-    y : float
-        The vertical position of the zoom area (0.0 to 1.0)
-    width : float
-        The width of the zoom area (0.0 to 1.0)
-    height : float
-        The height of the zoom area (0.0 to 1.0)
-    """
-    if self._camera is not None:
-        try:
-            self._camera.zoom = (x, y, width, height)
-            logging.info(f"Zoom area set to {(x, y, width, height)}")
-        except Exception as e:
-            logging.error(f"Failed to set zoom area: {e}")                                     
-                             
-        
\ No newline at end of file
+        """
+        if name in self._camera:
+            camera_was_acquiring = self._camera.recording  # Check if the camera is currently recording
+            try:
+                # Try to set the value even if live feed is running.
+                setattr(self._camera, name, val)
+                print(f"Feature '{name}' was successfully set to {val}.")
+            except Exception as e:
+                logging.error(f"Could not set the feature {name}. Error: {e}")
+            finally:
+                # If the camera was recording, restart the recording
+                if camera_was_acquiring:
+                    self._camera.start_recording()
+
+        else:
+            logging.warning(f"Feature '{name}' is not available in PiCamera.")
+
+    def crop(self, x=0.0, y=0.0, width=1.0, height=1.0):
+        """Set camera zoom to simulate cropping.
+
+        Parameters
+        ----------
+        x : float
+            The horizontal position of the zoom area (0.0 to 1.0)
+        y : float
+            The vertical position of the zoom area (0.0 to 1.0)
+        width : float
+            The width of the zoom area (0.0 to 1.0)
+        height : float
+            The height of the zoom area (0.0 to 1.0)
+        """
+        if self._camera is not None:
+            try:
+                self._camera.zoom = (x, y, width, height)
+                logging.info(f"Zoom area set to {(x, y, width, height)}")
+            except Exception as e:
+                logging.error(f"Failed to set zoom area: {e}")
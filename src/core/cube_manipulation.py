@@ -14,9 +14,13 @@ import logging
 import core.properties as P
 import core.frame_manipulation as fm
 
-def make_reflectance_cube(raw_cube, dark_frame, white_frame, control) -> Dataset:
+def make_reflectance_cube(raw_cube, dark_frame, white_frame, control, x_factor=1, y_factor=1, method='mean') -> Dataset:
     """ Makes a reflectance cube out of a raw cube.
 
+    Dark and white frames are cropped and binned to match the raw cube. The raw cube
+    may be binned during acquisition or here with x_factor and y_factor, which makes
+    the rest of the processing faster.
+
     Parameters
     ----------
         raw_cube: xarray Dataset
@@ -27,6 +31,12 @@ def make_reflectance_cube(raw_cube, dark_frame, white_frame, control) -> Dataset
             White reference frame for reflectance calculation.
         control: dict
             Control file content as dict.
+        x_factor: int, default 1
+            Additional spectral binning of the raw cube.
+        y_factor: int, default 1
+            Additional spatial binning of the raw cube.
+        method: str, default 'mean'
+            Binning method, either 'mean' or 'sum'.
 
     Returns
     -------
@@ -45,11 +55,12 @@ def make_reflectance_cube(raw_cube, dark_frame, white_frame, control) -> Dataset
 
     rfl = raw_cube.copy(deep=True)
     raw_cube.close()
+    rfl = bin_cube(rfl, x_factor, y_factor, method)
 
     if dark_frame is not None:
         df_ds = dark_frame
         df_da = df_ds[P.naming_frame_data]
-        dark_frame = fm.crop_to_size(df_da, control)
+        dark_frame = bin_like(fm.crop_to_size(df_da, control), rfl)
         print(f"Subtracting dark frame...", end=' ')
         rfl[P.naming_dark_corrected] = (P.dim_order_cube,
                                          (rfl[P.naming_cube_data].values > dark_frame.values)
@@ -64,7 +75,7 @@ def make_reflectance_cube(raw_cube, dark_frame, white_frame, control) -> Dataset
 
     print(f"Dividing by white frame...", end=' ')
     white = fm.crop_to_size(white_frame, control)
-    white = white[P.naming_frame_data]
+    white = bin_like(white[P.naming_frame_data], rfl)
 
     # rfl = rfl.transpose(*P.dim_order_cube)
     # # Uncomment to drop lowest pixel values to zero
@@ -75,4 +86,162 @@ def make_reflectance_cube(raw_cube, dark_frame, white_frame, control) -> Dataset
     rfl = rfl.drop(old_data_name)
     print(f"done")
 
-    return rfl
\ No newline at end of file
+    return rfl
+
+
+def _bin_values(values:np.ndarray, y_axis:int, x_axis:int, y_factor:int, x_factor:int, method:str) -> np.ndarray:
+    """Bin y and x axes of an array by reshaping each into (size // factor, factor) and reducing.
+
+    Trailing pixels that do not fill a whole bin are dropped.
+    """
+
+    new_h = values.shape[y_axis] // y_factor
+    new_w = values.shape[x_axis] // x_factor
+    trim = [slice(None)] * values.ndim
+    trim[y_axis] = slice(0, new_h * y_factor)
+    trim[x_axis] = slice(0, new_w * x_factor)
+    values = values[tuple(trim)]
+
+    # Split each binned axis into (bins, factor). Axes are handled from last to first
+    # so that the earlier axis index stays valid.
+    shape = list(values.shape)
+    for axis, bins, factor in sorted([(y_axis, new_h, y_factor), (x_axis, new_w, x_factor)], reverse=True):
+        shape[axis:axis + 1] = [bins, factor]
+    values = values.reshape(shape)
+    first, second = sorted([y_axis, x_axis])
+    reduce_axes = (first + 1, second + 2)
+
+    if method == 'sum':
+        # Sum in a wide enough type so that 8 and 16 bit data does not overflow.
+        if np.issubdtype(values.dtype, np.floating):
+            dtype = values.dtype
+        else:
+            dtype = np.int32 if values.dtype.itemsize <= 2 else np.int64
+        return values.sum(axis=reduce_axes, dtype=dtype)
+    elif method == 'mean':
+        return values.mean(axis=reduce_axes, dtype=np.float64).astype(np.float32)
+    else:
+        raise ValueError(f"Binning method '{method}' not recognized. Use either 'sum' or 'mean'.")
+
+
+def bin_cube(data, x_factor=1, y_factor=1, method='mean'):
+    """Bin a cube or a frame spectrally (x) and spatially (y).
+
+    Binning is done with vectorized reshape-based reductions. The coordinates of
+    the binned dimensions are the mean coordinates of the bins, so for coordinates
+    of the form 0.5, 1.5, ... the bins keep their positions in original pixel units.
+    Binning factors and the scale binning has caused to the values are stored into
+    attributes (multiplied with any earlier binning), so that reference frames can
+    be binned to match the cube later, even if the cube was binned several times
+    with different methods.
+
+    Parameters
+    ----------
+        data : Dataset or DataArray
+            Cube or frame having 'x' and 'y' dimensions. For Datasets, every variable
+            with both dimensions is binned and other variables are dropped.
+        x_factor : int, default 1
+            Amount of neighbouring bands binned together.
+        y_factor : int, default 1
+            Amount of neighbouring spatial pixels binned together.
+        method : str, default 'mean'
+            Either 'sum' or 'mean'. Sum improves SNR without scaling the data to
+            float, mean keeps the values comparable with unbinned data.
+
+    Returns
+    -------
+        Binned Dataset or DataArray.
+
+    Raises
+    ------
+        ValueError
+            if method is not recognized or a factor is smaller than 1.
+    """
+
+    x_factor = int(x_factor)
+    y_factor = int(y_factor)
+    if x_factor < 1 or y_factor < 1:
+        raise ValueError(f"Binning factors must be positive integers. Got x {x_factor} and y {y_factor}.")
+    if x_factor == 1 and y_factor == 1:
+        return data
+
+    if isinstance(data, Dataset):
+        binned_vars = {}
+        for name, var in data.data_vars.items():
+            if P.dim_x in var.dims and P.dim_y in var.dims:
+                binned_vars[name] = bin_cube(var, x_factor, y_factor, method)
+            else:
+                logging.info(f"Variable '{name}' has no '{P.dim_x}' and '{P.dim_y}' dimensions. Dropped in binning.")
+        binned = xr.Dataset(data_vars=binned_vars, attrs=dict(data.attrs))
+    else:
+        y_axis = data.dims.index(P.dim_y)
+        x_axis = data.dims.index(P.dim_x)
+        values = _bin_values(data.values, y_axis, x_axis, y_factor, x_factor, method)
+        coords = {}
+        for name, coord in data.coords.items():
+            if name == P.dim_x or name == P.dim_y:
+                factor = x_factor if name == P.dim_x else y_factor
+                bins = values.shape[x_axis if name == P.dim_x else y_axis]
+                coords[name] = (name, coord.values[:bins * factor].reshape(bins, factor).mean(axis=1))
+            elif P.dim_x not in coord.dims and P.dim_y not in coord.dims:
+                coords[name] = coord
+        binned = DataArray(values, name=data.name, dims=data.dims, coords=coords, attrs=dict(data.attrs))
+
+    binned.attrs[P.meta_key_binning_x] = int(data.attrs.get(P.meta_key_binning_x, 1)) * x_factor
+    binned.attrs[P.meta_key_binning_y] = int(data.attrs.get(P.meta_key_binning_y, 1)) * y_factor
+    binned.attrs[P.meta_key_binning_method] = method
+    scale = x_factor * y_factor if method == 'sum' else 1
+    binned.attrs[P.meta_key_binning_scale] = binning_scale_of(data) * scale
+    return binned
+
+
+def binning_of(data):
+    """Binning factors (x, y) and method stored in attributes of a cube or a frame.
+
+    The method is the one of the latest binning. Use binning_scale_of() to find
+    out how earlier binnings have scaled the values.
+    """
+
+    return (int(data.attrs.get(P.meta_key_binning_x, 1)),
+            int(data.attrs.get(P.meta_key_binning_y, 1)),
+            data.attrs.get(P.meta_key_binning_method, 'mean'))
+
+
+def binning_scale_of(data):
+    """Factor by which all binnings of a cube or a frame have scaled its values."""
+
+    if P.meta_key_binning_scale in data.attrs:
+        return int(data.attrs[P.meta_key_binning_scale])
+    # Data saved before the scale was stored has been binned only once.
+    x_factor, y_factor, method = binning_of(data)
+    return x_factor * y_factor if method == 'sum' else 1
+
+
+def bin_like(data, target):
+    """Bin data (e.g. a reference frame) with the binning of target cube.
+
+    The bins of data are averaged and scaled like the values of target, so the
+    result matches target even if target was binned in several passes with
+    different methods, e.g. summed in acquisition and averaged afterwards.
+
+    Raises
+    ------
+        ValueError
+            if the binning of target is not a multiple of the binning already
+            applied to data.
+    """
+
+    x_factor, y_factor, _ = binning_of(target)
+    done_x, done_y, _ = binning_of(data)
+    if x_factor % done_x != 0 or y_factor % done_y != 0:
+        raise ValueError(f"Cannot bin data binned by x {done_x} and y {done_y} to match binning "
+                         f"x {x_factor} and y {y_factor}. Factors must be multiples of the applied ones.")
+    scale = binning_scale_of(target) / binning_scale_of(data)
+    binned = bin_cube(data, x_factor // done_x, y_factor // done_y, 'mean')
+    if scale == 1:
+        return binned
+    scaled = binned * scale
+    scaled.attrs = dict(binned.attrs)
+    scaled.attrs[P.meta_key_binning_method] = binning_of(target)[2]
+    scaled.attrs[P.meta_key_binning_scale] = binning_scale_of(target)
+    return scaled
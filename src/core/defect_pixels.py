@@ -0,0 +1,284 @@
+"""
+
+Defective pixel map and correction.
+
+Hot, dead, and noisy pixels are found statistically from dark and white
+reference frames in one vectorized pass over the frames. The map is stored
+as flat pixel indices (and a bit flag of the defect kind per pixel), which
+keeps it compact even for full sensor frames.
+
+Correction replaces each defective pixel with the mean of its valid 8-neighbours.
+The neighbour indices and weights are computed once when the map is created, so
+correcting a frame, or a whole cube at once, is a single gather and a weighted
+sum over the defective pixels only.
+
+Defect maps are made for full sensor frames. Use crop() or crop_to_control()
+to get a map matching the cropped frames of a scan.
+
+"""
+
+import logging
+import os
+import numpy as np
+import xarray as xr
+from xarray import DataArray
+from xarray import Dataset
+
+from core import properties as P
+
+# Defect kinds as bit flags. A pixel may have several.
+DEFECT_HOT = 1
+DEFECT_DEAD = 2
+DEFECT_NOISY = 4
+
+# Row and column offsets of the 8-neighbourhood.
+_neighbour_dy = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+_neighbour_dx = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+
+class DefectMap:
+    """Defective pixels of a frame with precomputed neighbour-average correction."""
+
+    def __init__(self, shape, flat_index, kind):
+        """Create a defect map.
+
+        Parameters
+        ----------
+            shape : tuple
+                Frame shape (height, width) the indices refer to.
+            flat_index : array-like
+                Flat (row-major) indices of defective pixels.
+            kind : array-like
+                Defect kind bit flags (DEFECT_HOT, DEFECT_DEAD, DEFECT_NOISY) of each pixel.
+        """
+
+        self.shape = (int(shape[0]), int(shape[1]))
+        order = np.argsort(flat_index)
+        self.flat_index = np.asarray(flat_index, dtype=np.int64)[order]
+        self.kind = np.asarray(kind, dtype=np.uint8)[order]
+        self._build_gathers()
+
+    def __len__(self):
+        return len(self.flat_index)
+
+    def _build_gathers(self):
+        """Precompute neighbour indices and weights for the correction.
+
+        Neighbours outside the frame and neighbours that are defective themselves
+        get zero weight. A pixel without any valid neighbour is left as it is.
+        """
+
+        h, w = self.shape
+        rows, cols = np.unravel_index(self.flat_index, self.shape)
+        n_rows = rows[:, None] + _neighbour_dy
+        n_cols = cols[:, None] + _neighbour_dx
+        inside = (n_rows >= 0) & (n_rows < h) & (n_cols >= 0) & (n_cols < w)
+        n_rows = np.clip(n_rows, 0, h - 1)
+        n_cols = np.clip(n_cols, 0, w - 1)
+        neighbours = np.ravel_multi_index((n_rows, n_cols), self.shape)
+        valid = inside & ~np.isin(neighbours, self.flat_index)
+
+        valid_count = valid.sum(axis=1)
+        lonely = valid_count == 0
+        if np.any(lonely):
+            logging.warning(f"{np.count_nonzero(lonely)} defective pixels have no valid neighbours "
+                            f"and will not be corrected.")
+            neighbours[lonely, 0] = self.flat_index[lonely]
+            valid[lonely, 0] = True
+            valid_count[lonely] = 1
+
+        self._neighbours = neighbours
+        self._weights = (valid / valid_count[:, None]).astype(np.float32)
+
+    def mask(self) -> np.ndarray:
+        """Boolean mask of the defective pixels."""
+
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.flat_index] = True
+        return mask
+
+    def summary(self) -> dict:
+        """Counts of defective pixels by kind."""
+
+        return {
+            'total': len(self),
+            'hot': int(np.count_nonzero(self.kind & DEFECT_HOT)),
+            'dead': int(np.count_nonzero(self.kind & DEFECT_DEAD)),
+            'noisy': int(np.count_nonzero(self.kind & DEFECT_NOISY)),
+        }
+
+    def fraction(self) -> float:
+        """Fraction of defective pixels in the frame."""
+
+        return len(self) / (self.shape[0] * self.shape[1])
+
+    def print_summary(self):
+        s = self.summary()
+        print(f"Defective pixels: {s['total']} ({self.fraction() * 100:.4f} %), hot {s['hot']}, "
+              f"dead {s['dead']}, noisy {s['noisy']}.")
+
+    def crop(self, width, width_offset, height, height_offset):
+        """Defect map of a cropped frame. Arguments as in the control file."""
+
+        rows, cols = np.unravel_index(self.flat_index, self.shape)
+        keep = ((rows >= height_offset) & (rows < height_offset + height)
+                & (cols >= width_offset) & (cols < width_offset + width))
+        flat_index = np.ravel_multi_index((rows[keep] - height_offset, cols[keep] - width_offset), (height, width))
+        return DefectMap((height, width), flat_index, self.kind[keep])
+
+    def crop_to_control(self, control):
+        """Defect map matching frames cropped as dictated by given control dictionary."""
+
+        width = control[P.ctrl_scan_settings][P.ctrl_width]
+        width_offset = control[P.ctrl_scan_settings][P.ctrl_width_offset]
+        height = control[P.ctrl_scan_settings][P.ctrl_height]
+        height_offset = control[P.ctrl_scan_settings][P.ctrl_height_offset]
+        return self.crop(width, width_offset, height, height_offset)
+
+    def correct_array(self, values:np.ndarray) -> np.ndarray:
+        """Correct defective pixels in place.
+
+        Parameters
+        ----------
+            values : numpy array
+                A frame or a stack of frames, e.g. a cube, whose last two dimensions
+                are (y, x) and match the shape of the map.
+
+        Returns
+        -------
+            numpy array
+                The corrected array (same object as values).
+        """
+
+        if values.shape[-2:] != self.shape:
+            raise ValueError(f"Defect map of shape {self.shape} does not match data of shape {values.shape}.")
+        if len(self) == 0:
+            return values
+
+        flat = values.reshape(values.shape[:-2] + (-1,))
+        replacement = np.einsum('...nk,nk->...n', flat[..., self._neighbours], self._weights)
+        if np.issubdtype(values.dtype, np.integer):
+            replacement = np.rint(replacement)
+        flat[..., self.flat_index] = replacement
+        if not np.shares_memory(flat, values):
+            values[...] = flat.reshape(values.shape)
+        return values
+
+    def correct(self, data):
+        """Return a corrected copy of a frame or a cube.
+
+        Parameters
+        ----------
+            data : DataArray, Dataset or numpy array
+                For DataArrays and Datasets, each variable having both 'y' and 'x'
+                dimensions is corrected.
+        """
+
+        if isinstance(data, Dataset):
+            corrected = data.copy()
+            for name, var in data.data_vars.items():
+                if P.dim_x in var.dims and P.dim_y in var.dims:
+                    corrected[name] = self.correct(var)
+            return corrected
+        if isinstance(data, DataArray):
+            dims = data.dims
+            corrected = data.transpose(..., P.dim_y, P.dim_x).copy(deep=True)
+            self.correct_array(corrected.values)
+            return corrected.transpose(*dims)
+        return self.correct_array(np.array(data))
+
+    def to_dataset(self) -> Dataset:
+        ds = xr.Dataset(
+            data_vars={
+                P.naming_defect_index: (P.dim_defect, self.flat_index),
+                P.naming_defect_kind: (P.dim_defect, self.kind),
+            },
+            attrs={'height': self.shape[0], 'width': self.shape[1]},
+        )
+        return ds
+
+    @classmethod
+    def from_dataset(cls, ds:Dataset):
+        return cls((ds.attrs['height'], ds.attrs['width']),
+                   ds[P.naming_defect_index].values, ds[P.naming_defect_kind].values)
+
+    def save(self, path):
+        path_s = str(path)
+        if not path_s.endswith('.nc'):
+            path_s = path_s + '.nc'
+        self.to_dataset().to_netcdf(os.path.abspath(path_s))
+
+
+def load_defect_map(path) -> DefectMap:
+    """Load a defect map saved with DefectMap.save()."""
+
+    path_s = str(path)
+    if not path_s.endswith('.nc'):
+        path_s = path_s + '.nc'
+    ds = xr.open_dataset(os.path.abspath(path_s))
+    ds.load()
+    ds.close()
+    return DefectMap.from_dataset(ds)
+
+
+def _frame_values(frame) -> np.ndarray:
+    """2D float array (y, x) of a frame given as Dataset, DataArray or numpy array."""
+
+    if isinstance(frame, Dataset):
+        frame = frame[P.naming_frame_data]
+    if isinstance(frame, DataArray):
+        frame = frame.transpose(P.dim_y, P.dim_x).values
+    return np.asarray(frame, dtype=np.float64)
+
+
+def find_defects(dark, dark_noise=None, white=None,
+                 hot_sigma=P.hot_pixel_sigma, noisy_factor=P.noisy_pixel_factor,
+                 dead_ratio=P.dead_pixel_ratio) -> DefectMap:
+    """Find hot, noisy, and dead pixels from reference frames.
+
+    Parameters
+    ----------
+        dark : Dataset, DataArray or numpy array
+            Mean dark frame. Pixels brighter than the median by hot_sigma robust
+            standard deviations (from median absolute deviation) are hot.
+        dark_noise : optional
+            Per-pixel temporal standard deviation of the dark frames (noise map).
+            Pixels noisier than noisy_factor times the median noise are noisy.
+        white : optional
+            Mean white frame. Pixels darker than dead_ratio times the median of their
+            neighbourhood are dead. Only pixels whose neighbourhood has signal are
+            inspected, as the slit and the spectrum do not cover the whole sensor.
+
+    Returns
+    -------
+        DefectMap
+            Defects of the frame.
+    """
+
+    dark = _frame_values(dark)
+    kind = np.zeros(dark.shape, dtype=np.uint8)
+
+    median = np.median(dark)
+    scale = 1.4826 * np.median(np.abs(dark - median))
+    if scale == 0:
+        # Quantized dark frames may have zero MAD. One count is the smallest meaningful step.
+        scale = max(dark.std(), 1.0)
+    kind |= (dark > median + hot_sigma * scale).astype(np.uint8) * DEFECT_HOT
+
+    if dark_noise is not None:
+        noise = _frame_values(dark_noise)
+        median_noise = np.median(noise)
+        if median_noise > 0:
+            kind |= (noise > noisy_factor * median_noise).astype(np.uint8) * DEFECT_NOISY
+
+    if white is not None:
+        white = _frame_values(white)
+        # A local reference, as unlit rows outside the slit would make column medians
+        # meaningless. Single dead pixels do not affect the median of their neighbourhood.
+        from scipy import ndimage
+        local_median = ndimage.median_filter(white, size=P.dead_pixel_window, mode='nearest')
+        lit = local_median > P.defect_lit_fraction * local_median.max()
+        kind |= ((white < dead_ratio * local_median) & lit).astype(np.uint8) * DEFECT_DEAD
+
+    flat_index = np.flatnonzero(kind)
+    return DefectMap(dark.shape, flat_index, kind.ravel()[flat_index])
@@ -0,0 +1,117 @@
+"""
+
+Fast localisation of bright spectral emission lines in a frame.
+
+Spectral lines lie roughly along the y-axis, so they show up as peaks in the
+mean of the frame's columns. The profile is computed from a sub-sample of rows
+and decimated along x by block means, which makes the search take a small
+fraction of a millisecond even for full sensor frames. Peaks are found with
+vectorized comparisons to the neighbours and refined with a parabola fit
+before scaling back to full resolution x-coordinates.
+
+Use find_lines() for frames and format_positions() to get the positions
+in the format of the control file.
+
+"""
+
+import numpy as np
+
+from core import properties as P
+
+
+def column_profile(values:np.ndarray, rows=P.line_locator_rows, decimation=P.line_locator_decimation) -> np.ndarray:
+    """Decimated column-mean profile of a frame.
+
+    Parameters
+    ----------
+        values : numpy array
+            Frame as a 2D (y, x) array.
+        rows : int
+            Approximate count of evenly spaced rows used for the mean.
+        decimation : int
+            Block size of the block mean along x.
+
+    Returns
+    -------
+        numpy array
+            Profile of length width // decimation.
+    """
+
+    row_step = max(1, values.shape[0] // rows)
+    profile = values[::row_step].mean(axis=0, dtype=np.float64)
+    n = len(profile) // decimation
+    return profile[:n * decimation].reshape(n, decimation).mean(axis=1)
+
+
+def find_peaks(profile:np.ndarray, count:int, min_separation:int, threshold_sigma:float) -> np.ndarray:
+    """Sub-sample positions of the brightest peaks of a profile, brightest first.
+
+    A peak is a local maximum that exceeds the median of the profile by threshold_sigma
+    robust standard deviations. Of peaks closer than min_separation samples, only the
+    brightest is kept.
+    """
+
+    if len(profile) < 3:
+        return np.array([])
+    median = np.median(profile)
+    sigma = 1.4826 * np.median(np.abs(profile - median))
+    centre = profile[1:-1]
+    is_peak = (centre > profile[:-2]) & (centre >= profile[2:]) & (centre > median + threshold_sigma * sigma)
+    candidates = np.flatnonzero(is_peak) + 1
+    candidates = candidates[np.argsort(profile[candidates])[::-1]]
+
+    chosen = []
+    for c in candidates:
+        if all(abs(c - other) >= min_separation for other in chosen):
+            chosen.append(c)
+            if len(chosen) == count:
+                break
+    chosen = np.array(chosen, dtype=int)
+    if len(chosen) == 0:
+        return chosen.astype(float)
+
+    # Parabola through the peak and its neighbours gives sub-sample accuracy.
+    left = profile[chosen - 1]
+    mid = profile[chosen]
+    right = profile[chosen + 1]
+    denominator = left - 2 * mid + right
+    offset = np.where(denominator != 0, 0.5 * (left - right) / np.where(denominator != 0, denominator, 1), 0.0)
+    return chosen + offset
+
+
+def find_lines(values:np.ndarray, count=P.line_locator_count, min_separation=P.line_locator_min_separation,
+               threshold_sigma=P.line_locator_threshold, decimation=P.line_locator_decimation) -> np.ndarray:
+    """Find the brightest spectral lines of a frame.
+
+    Parameters
+    ----------
+        values : numpy array
+            Frame as a 2D (y, x) array.
+        count : int
+            Maximum amount of lines to return.
+        min_separation : int
+            Minimum distance of returned lines in pixels.
+        threshold_sigma : float
+            Lines must exceed the median of the column profile by this many robust
+            standard deviations.
+        decimation : int
+            Decimation of the column profile. Bigger is faster but less accurate.
+
+    Returns
+    -------
+        numpy array
+            Integer x-coordinates (pixel indices) of found lines, brightest first.
+    """
+
+    profile = column_profile(values, decimation=decimation)
+    peaks = find_peaks(profile, count, max(1, min_separation // decimation), threshold_sigma)
+    # Centre of block i is at pixel i * decimation + (decimation - 1) / 2.
+    positions = np.rint(peaks * decimation + (decimation - 1) / 2).astype(int)
+    return np.clip(positions, 0, values.shape[1] - 1)
+
+
+def format_positions(positions, offset_x=0) -> str:
+    """Positions as a control file line. Add offset_x if the frame was cropped."""
+
+    full = sorted(int(p) + int(offset_x) for p in positions)
+    return f"{P.ctrl_positions} = {full}"
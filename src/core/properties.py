@@ -26,6 +26,9 @@ cube_raw_name = 'raw'
 cube_reflectance_name = 'rfl'
 cube_desmiled_lut = 'desmiled_lut'
 cube_desmiled_intr = 'desmiled_intr'
+telemetry_name = cube_raw_name + '_telemetry'
+defect_map_name = 'defects'
+abundances_name = 'abundances'
 example_scan_name = 'example_scan'
 
 freeform_session_name = 'freeform'
@@ -34,18 +37,47 @@ freeform_session_name = 'freeform'
 dwl_default_count = 10
 # Default reduction method (mean or median) for dark, white, and peak light frames.
 dwl_default_method = 'mean'
+# Largest stack of frames (in bytes) kept in memory for exact median of reference frames.
+# Larger stacks use an approximate streaming median.
+running_median_max_stack_bytes = 2**30
+# Pixels whose temporal std is this many times the median std are counted as noisy.
+noisy_pixel_factor = 5.0
+# Per-pixel noise map of a reference frame is saved with this suffix, e.g. 'dark_noise.nc'.
+noise_map_suffix = '_noise'
+
+# Defective pixel detection. Hot pixels exceed the median of the dark frame by this many
+# robust standard deviations.
+hot_pixel_sigma = 8.0
+# Dead pixels are darker than this fraction of the median of their neighbourhood in the white frame.
+dead_pixel_ratio = 0.5
+# Side length of the square neighbourhood dead pixels are compared with. Clusters of dead pixels
+# covering half of the neighbourhood or more are not found.
+dead_pixel_window = 5
+# Pixels of the white frame whose neighbourhood is dimmer than this fraction of the brightest
+# neighbourhood are not inspected for dead pixels, as the slit does not light the whole sensor.
+defect_lit_fraction = 0.1
+# A defect map marking more than this fraction of the pixels defective is not used. Most likely
+# the dark or white frame was not shot properly.
+max_defect_fraction = 0.01
 
 # A single frame dataset uses this name to save the frame.
 naming_frame_data = 'frame'
 naming_cube_data = 'dn'
 naming_dark_corrected = 'dark_corrected'
 naming_reflectance = 'reflectance'
+naming_defect_index = 'defect_index'
+naming_defect_kind = 'defect_kind'
+naming_abundance = 'abundance'
+naming_residual = 'residual'
 
 ########### Dimension names #############
 
 dim_x = 'x'
 dim_y = 'y'
 dim_scan = 'scan_index'
+dim_frame = 'frame'
+dim_defect = 'defect'
+dim_endmember = 'endmember'
 
 dim_order_frame = dim_y,dim_x
 dim_order_cube = dim_scan,dim_y,dim_x
@@ -58,6 +90,147 @@ meta_key_tilt = 'tilt'
 meta_key_curvature = 'curvatures'
 meta_key_sl_X = 'sl_X'
 meta_key_sl_Y = 'sl_Y'
+# Count of defective pixels per frame corrected in a cube.
+meta_key_defects_corrected = 'defects_corrected'
+# Binning factors along x (bands) and y (space) and the binning method of a cube or frame.
+meta_key_binning_x = 'binning_x'
+meta_key_binning_y = 'binning_y'
+meta_key_binning_method = 'binning_method'
+# Factor by which binning has scaled the values, i.e., the product of the factors of all sum binnings.
+meta_key_binning_scale = 'binning_scale'
+# Spatial reduction factor of an overview pyramid level.
+meta_key_pyramid_factor = 'pyramid_factor'
+
+########### Camera feature names #############
+
+cam_width = 'Width'
+cam_height = 'Height'
+cam_offset_x = 'OffsetX'
+cam_offset_y = 'OffsetY'
+cam_exposure_time = 'ExposureTime'
+cam_frame_rate = 'AcquisitionFrameRate'
+
+########### Camera backends #############
+
+backend_picamera = 'picamera'
+backend_camazing = 'camazing'
+backend_simulated = 'simulated'
+backend_replay = 'replay'
+default_camera_backend = backend_picamera
+# Environment variable that overrides the backend given in camera settings file.
+env_camera_backend = 'DESMILER_CAMERA_BACKEND'
+# Keys in camera settings file that are not camera features.
+cam_key_backend = 'backend'
+cam_key_replay_source = 'replay_source'
+cam_key_capture_format = 'capture_format'
+# Default capture format of the Raspberry Pi camera. Either 'yuv' (raw) or 'jpeg'.
+default_capture_format = 'yuv'
+
+########### Simulated camera #############
+
+# Default exposure time in microseconds.
+sim_default_exposure = 20000.0
+# Readout time of a single sensor row in microseconds.
+sim_default_readout_time = 5.0
+# Standard deviation of frame latency jitter in microseconds.
+sim_default_jitter = 200.0
+# Extra rows in the noise field used to vary the noise between frames.
+sim_noise_rows = 64
+# Maximum of uniform additive noise relative to the brightest source pixel.
+sim_noise_fac = 0.07
+
+########### Preview #############
+
+# Longer side of the decimated image shown in the preview in blitting mode.
+preview_max_display_size = 1024
+# Colour limits of the preview image are running estimates of these percentiles.
+preview_clim_percentiles = (1.0, 99.0)
+# Weight of the newest frame in the running colour limit estimate.
+preview_clim_smoothing = 0.2
+# Colour limits and plot axes are updated only if they change more than this
+# fraction of the current range.
+preview_rescale_threshold = 0.1
+# Plot axes are shrunk if the data covers less than this fraction of the current range.
+preview_rescale_shrink = 0.5
+
+# Focus metrics are computed in a region of interest around the selected rows and columns
+# padded by this many pixels.
+focus_roi_margin = 64
+# The region of interest is sub-sampled to at most this many pixels per side.
+focus_roi_max_size = 256
+# Samples to both sides of the steepest point searched for the edge width metric.
+focus_edge_window = 16
+
+########### Spectral line locator #############
+
+# Approximate count of rows averaged into the column profile.
+line_locator_rows = 32
+# Block size of the column profile decimation along x.
+line_locator_decimation = 4
+# Maximum amount of located lines.
+line_locator_count = 4
+# Minimum distance of located lines in pixels.
+line_locator_min_separation = 40
+# Lines must exceed the median of the profile by this many robust standard deviations.
+line_locator_threshold = 6.0
+
+########### Cube inspector #############
+
+# Lower and upper percentiles of each band computed by the band-major cache.
+band_cache_percentiles = (1.0, 99.0)
+# Amount of samples per band used for the percentiles.
+band_cache_percentile_samples = 10000
+# Size of chunks copied at a time when building the band-major cache.
+band_cache_chunk_bytes = 64 * 2**20
+# Cubes bigger than this are cached into a memory mapped file in the session directory
+# instead of memory.
+band_cache_max_memory_bytes = 2**30
+# Memory mapped band cache files are named with this prefix and the index of the cube.
+band_cache_file_prefix = '.band_cache_'
+# Pixel step of low-resolution previews shown while full results are computed in background.
+inspector_preview_step = 4
+# Interval of checking for finished background computations in milliseconds.
+inspector_poll_interval_ms = 50
+# Spectrogram limits of CubeInspector are shrunk only if the data uses less than this fraction of them.
+inspector_spectrogram_shrink_fraction = 0.25
+# Overview pyramid levels are built until both spatial dimensions of the cube are at most this big.
+pyramid_min_size = 1024
+# Overview levels are stored in cube files as groups named with this prefix and the level.
+pyramid_group_prefix = 'overview_'
+# Approximate memory used by the float64 temporaries of one chunk of scan lines when reducing
+# a cube to an overview level.
+pyramid_chunk_bytes = 64 * 2**20
+# Approximate memory used by one chunk of pixels when matching cubes against a spectral library.
+library_match_chunk_bytes = 64 * 2**20
+# Class of pixels whose best library match is too poor.
+library_match_unclassified = -1
+# Band ranges (start, stop) of false colour channels when the session control file is not used.
+false_color_default_blue = (300, 500)
+false_color_default_green = (660, 860)
+false_color_default_red = (1300, 1500)
+# Approximate memory used by one chunk of scan lines when fitting and projecting PCA and MNF components.
+components_chunk_bytes = 64 * 2**20
+# Count of PCA or MNF components computed by default, e.g. for the component composite of CubeInspector.
+components_default_count = 3
+# Noise covariance of MNF is regularized with this fraction of its mean variance.
+components_noise_regularization = 1e-6
+# Approximate memory used by the temporaries of one block of scan lines when evaluating band math.
+band_math_chunk_bytes = 64 * 2**20
+# Band index images of a session are saved with this prefix and the name of the index, e.g. 'index_ndvi.nc'.
+band_math_file_prefix = 'index_'
+# Approximate memory used by one chunk of pixels when unmixing cubes into endmember abundances.
+unmixing_chunk_bytes = 64 * 2**20
+# Maximum iterations of the abundance solver and the change of abundances at which it stops.
+unmixing_max_iterations = 1000
+unmixing_tolerance = 1e-6
+
+########### Scan telemetry fields #############
+
+tel_capture_latency = 'capture_latency'
+tel_wait_time = 'wait_time'
+tel_deadline_error = 'deadline_error'
+tel_bytes_written = 'bytes_written'
+tel_dropped = 'dropped'
 
 ########### Control file keys #############
 
@@ -67,6 +240,8 @@ ctrl_spectral_blue = 'spectral_blue'
 ctrl_spectral_green = 'spectral_green'
 ctrl_spectral_red = 'spectral_red'
 
+ctrl_band_indices = 'band_indices'
+
 ctrl_scan_settings = 'scan_settings'
 ctrl_is_mock_scan = 'is_mock_scan'
 ctrl_scanning_speed_value   = 'scanning_speed_value'
@@ -74,6 +249,14 @@ ctrl_scanning_speed_unit    = 'scanning_speed_unit'
 ctrl_scanning_length_value  = 'scanning_length_value'
 ctrl_exporure_time_s  = 'exposure_time_s'
 ctrl_acquisition_overhead = 'acquisition_overhead'
+ctrl_streaming_capture = 'streaming_capture'
+ctrl_reference_count = 'reference_frame_count'
+ctrl_reference_method = 'reference_frame_method'
+ctrl_correct_defects = 'correct_defects'
+ctrl_binning_x = 'binning_x'
+ctrl_binning_y = 'binning_y'
+ctrl_binning_method = 'binning_method'
+ctrl_build_pyramids = 'build_pyramids'
 
 ctrl_width = 'width'
 ctrl_width_offset = 'width_offset'
@@ -102,6 +285,13 @@ f"""
     {ctrl_spectral_green}       = [660, 860]
     {ctrl_spectral_red}         = [1300, 1500]
 
+# Named spectral indices computed with ScanningSession.make_index_images(). b[start:stop] is the
+# mean of bands [start, stop) and w[low:high] the mean of bands with x coordinates between low and
+# high. Numbers, + - * / **, parentheses, abs, sqrt, log, exp, min, max, and other named indices can
+# be used.
+[{ctrl_band_indices}]
+    # normalized_difference = "(b[800:820] - b[660:680]) / (b[800:820] + b[660:680])"
+
 # Settings related to the scan. 
 [{ctrl_scan_settings}]
 
@@ -124,6 +314,31 @@ f"""
     # mock = False.  
     {ctrl_acquisition_overhead}   = 0.10
 
+    # Use continuous streaming from the camera instead of acquiring frames one by one. The sensor
+    # keeps running and frames are timestamped by the camera, which allows higher frame rates.
+    # Values 0 = False, 1 = True.
+    {ctrl_streaming_capture}      = 0
+
+    # Amount of frames averaged for dark, white, and light reference frames, and the reduction
+    # method ('mean' or 'median'). Hundreds of frames can be used for low-noise references.
+    {ctrl_reference_count}   = {dwl_default_count}
+    {ctrl_reference_method}  = '{dwl_default_method}'
+
+    # Replace defective (hot, dead, and noisy) pixels with the mean of their neighbours.
+    # The defect map is built from dark and white frames. Values 0 = False, 1 = True.
+    {ctrl_correct_defects}         = 1
+
+    # Bin the scanned cube spectrally (x, bands) and spatially (y) by integer factors to reduce
+    # the size of the cube and downstream processing time, e.g., for survey scans. Method is
+    # either 'mean' or 'sum'. Factors of 1 keep the full resolution.
+    {ctrl_binning_x}               = 1
+    {ctrl_binning_y}               = 1
+    {ctrl_binning_method}          = 'mean'
+
+    # Store spatially downsampled overviews of big cubes in the cube files for faster
+    # viewing in the cube inspector. Values 0 = False, 1 = True.
+    {ctrl_build_pyramids}          = 1
+
     # Rest of the settings are for cropping the acquired frames. Note that the camera can provide 
     # frames more rapidly if it does not have to pass on full sensor sized frames (less data is 
     # transferred), which means that you can run scans at higher speeds.
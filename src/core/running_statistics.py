@@ -0,0 +1,224 @@
+"""
+
+Running per-pixel statistics of a stream of frames.
+
+Mean and variance are updated one frame at a time with Welford's algorithm
+in float64 buffers, so the memory use does not depend on the amount of frames.
+This allows averaging hundreds of frames for low-noise dark and white references.
+
+Median is either exact, computed with np.partition from a stack that is allocated
+once for the expected amount of frames, or approximated with a stochastic
+(Robbins-Monro) estimator when the stack would not fit in memory. The standard
+deviation of the frames is a by-product, which serves as a per-pixel noise map
+for quality control.
+
+"""
+
+import logging
+import math
+import numpy as np
+from xarray import DataArray
+
+from core import properties as P
+
+
+class RunningStatistics:
+    """Per-pixel running mean, variance and median of a stream of frames."""
+
+    def __init__(self, count=None, keep_median=False, max_stack_bytes=P.running_median_max_stack_bytes):
+        """Initialize an empty accumulator.
+
+        Buffers are allocated on the first update, when the frame shape is known.
+
+        Parameters
+        ----------
+        count : int, optional
+            Expected amount of frames. Needed for the exact median stack.
+        keep_median : bool, default False
+            If True, the median is tracked. It is exact if the stack of count frames
+            fits in max_stack_bytes and approximated otherwise.
+        max_stack_bytes : int
+            Maximum size of the median stack in bytes.
+        """
+
+        self.count = 0
+        self.expected_count = count
+        self.keep_median = keep_median
+        self.max_stack_bytes = max_stack_bytes
+        self._mean = None
+        self._m2 = None
+        self._delta = None
+        self._stack = None
+        self._median_estimate = None
+        self._template = None
+
+    @property
+    def exact_median(self) -> bool:
+        """True if the median is computed from the stored stack of frames."""
+
+        return self._stack is not None
+
+    def _allocate(self, values:np.ndarray):
+        shape = values.shape
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+        self._delta = np.empty(shape, dtype=np.float64)
+        if self.keep_median:
+            stack_bytes = values.nbytes * (self.expected_count or 0)
+            if self.expected_count is not None and stack_bytes <= self.max_stack_bytes:
+                self._stack = np.empty((self.expected_count,) + shape, dtype=values.dtype)
+            else:
+                logging.info(f"Median stack of {stack_bytes / 1e6:.0f} MB does not fit in "
+                             f"{self.max_stack_bytes / 1e6:.0f} MB. Using approximate median.")
+                self._median_estimate = np.empty(shape, dtype=np.float64)
+
+    def update(self, frame):
+        """Add a frame (DataArray or numpy array) to the statistics."""
+
+        if isinstance(frame, DataArray):
+            if self._template is None:
+                self._template = frame
+            values = frame.values
+        else:
+            values = np.asarray(frame)
+
+        if self._mean is None:
+            self._allocate(values)
+        elif values.shape != self._mean.shape:
+            raise ValueError(f"Frame shape {values.shape} does not match the shape of "
+                             f"earlier frames {self._mean.shape}.")
+
+        if self._stack is not None and self.count >= len(self._stack):
+            raise ValueError(f"Got more than the expected {len(self._stack)} frames.")
+
+        self.count += 1
+        # Welford's update: mean += delta / n; m2 += delta * (x - mean_new)
+        np.subtract(values, self._mean, out=self._delta)
+        self._mean += self._delta / self.count
+        self._delta *= values - self._mean
+        self._m2 += self._delta
+
+        if self._stack is not None:
+            self._stack[self.count - 1] = values
+        elif self._median_estimate is not None:
+            self._update_median_estimate(values)
+
+    def _update_median_estimate(self, values:np.ndarray):
+        """Robbins-Monro step towards the median.
+
+        The step length 1 / (n * f(m)) uses the density of a normal distribution
+        at its median, f(m) = 1 / (sqrt(2 pi) * std), with the running std.
+        """
+
+        if self.count == 1:
+            self._median_estimate[:] = values
+            return
+        std = np.sqrt(self._m2 / (self.count - 1))
+        # Discrete data (e.g. 8 bit) may have zero std in places. Keep moving anyway.
+        np.maximum(std, 0.5, out=std)
+        step = std * (math.sqrt(2 * math.pi) / self.count)
+        self._median_estimate += step * np.sign(values - self._median_estimate)
+
+    def mean(self) -> np.ndarray:
+        return self._mean.copy()
+
+    def variance(self, ddof=1) -> np.ndarray:
+        """Per-pixel variance. ddof=1 for sample variance."""
+
+        if self.count - ddof <= 0:
+            return np.zeros_like(self._m2)
+        return self._m2 / (self.count - ddof)
+
+    def std(self, ddof=1) -> np.ndarray:
+        return np.sqrt(self.variance(ddof))
+
+    def standard_error(self) -> np.ndarray:
+        """Per-pixel standard error of the mean, i.e., the noise left in the averaged frame."""
+
+        return self.std() / math.sqrt(max(self.count, 1))
+
+    def median(self) -> np.ndarray:
+        """Per-pixel median. Exact if the stack was kept, approximate otherwise."""
+
+        if self._stack is not None:
+            stack = self._stack[:self.count]
+            k = self.count // 2
+            if self.count % 2 == 1:
+                return np.partition(stack, k, axis=0)[k].astype(np.float64)
+            part = np.partition(stack, (k - 1, k), axis=0)
+            return (part[k - 1].astype(np.float64) + part[k]) / 2
+        if self._median_estimate is not None:
+            return self._median_estimate.copy()
+        raise RuntimeError("Median was not tracked. Create the accumulator with keep_median=True.")
+
+    def reduced(self, method='mean') -> np.ndarray:
+        """Mean or median of the frames."""
+
+        if method == 'mean':
+            return self.mean()
+        elif method == 'median':
+            return self.median()
+        else:
+            logging.error(f"Shooting method '{method}' not recognized. Use either 'mean' or 'median'.")
+            return self.mean()
+
+    def _wrap(self, values:np.ndarray, name:str) -> DataArray:
+        """Wrap values as a DataArray using the coordinates of the first frame if available."""
+
+        if self._template is not None:
+            coords = {d: self._template.coords[d] for d in self._template.dims if d in self._template.coords}
+            return DataArray(values, name=name, dims=self._template.dims, coords=coords)
+        if values.ndim == 2:
+            coords = {
+                P.dim_x: (P.dim_x, np.arange(0, values.shape[1]) + 0.5),
+                P.dim_y: (P.dim_y, np.arange(0, values.shape[0]) + 0.5),
+            }
+            return DataArray(values, name=name, dims=P.dim_order_frame, coords=coords)
+        return DataArray(values, name=name)
+
+    def frame(self, method='mean') -> DataArray:
+        """Reduced frame as a DataArray."""
+
+        return self._wrap(self.reduced(method), P.naming_frame_data)
+
+    def noise_map(self) -> DataArray:
+        """Per-pixel standard deviation of the frames as a DataArray."""
+
+        return self._wrap(self.std(), P.naming_frame_data)
+
+    def summary(self) -> dict:
+        """Frame-wide noise figures for quality control."""
+
+        std = self.std()
+        median_std = float(np.median(std))
+        return {
+            'frames': self.count,
+            'mean_std': float(std.mean()),
+            'median_std': median_std,
+            'max_std': float(std.max()),
+            'noisy_fraction': float(np.mean(std > P.noisy_pixel_factor * median_std)) if median_std > 0 else 0.0,
+        }
+
+
+def accumulate(frames, count=None, method='mean') -> RunningStatistics:
+    """Accumulate statistics over an iterable of frames (e.g. a camera stream).
+
+    Parameters
+    ----------
+    frames : iterable
+        Frames as DataArrays or numpy arrays.
+    count : int, optional
+        Amount of frames expected. Needed for exact median.
+    method : str, default 'mean'
+        If 'median', the median is tracked as well.
+
+    Returns
+    -------
+    RunningStatistics
+        Statistics of the frames.
+    """
+
+    stats = RunningStatistics(count=count, keep_median=(method == 'median'))
+    for frame in frames:
+        stats.update(frame)
+    return stats
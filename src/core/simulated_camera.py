@@ -0,0 +1,406 @@
+"""
+
+This file contains a simulated camera that serves frames from the synthetic data generator
+or from a recorded cube. It offers the same methods as the CameraInterface, so scanning
+sessions, the preview and reference frame shooting can be run and benchmarked on a machine
+without the camera or its driver.
+
+Frame latency is modelled as exposure time plus a per-row readout time plus normally
+distributed jitter. Setting realtime=False skips the waiting altogether, so the frame rate
+is limited only by the copying of the frame data.
+
+"""
+
+import logging
+import os
+import time
+import datetime as dt
+import numpy as np
+import xarray as xr
+from xarray import DataArray
+import toml
+
+from core import properties as P
+from core import camera_backends
+from core import running_statistics
+
+
+class SimulatedCameraInterface:
+    """Simulated camera with configurable resolution, crop, latency and jitter.
+
+    Frames are float32 DataArrays with dimensions (y, x) and coordinates running
+    from 0.5 to size - 0.5 as the frames of the real camera.
+    """
+
+    def __init__(self, camera_settings_path=None, source=None, width=None, height=None,
+                 exposure=P.sim_default_exposure, readout_time=P.sim_default_readout_time,
+                 jitter=P.sim_default_jitter, realtime=True, noise_rows=P.sim_noise_rows, seed=None):
+        """Initialize the simulated camera.
+
+        Parameters
+        ----------
+            camera_settings_path : str, optional
+                Camera settings file to load crop and exposure from.
+            source : str or Dataset or DataArray, optional
+                Frame source. If None, an undistorted frame is generated with synthetic_data.
+                A path or an object holding a single frame ('frame' variable) is served as is with
+                noise added. A cube (a variable with scan_index dimension) is replayed frame by
+                frame without added noise.
+            width : int, optional
+                Sensor width. Source frames are cropped or zero padded to this width.
+            height : int, optional
+                Sensor height. Source frames are cropped or zero padded to this height.
+            exposure : float
+                Exposure time in microseconds.
+            readout_time : float
+                Readout time per sensor row in microseconds.
+            jitter : float
+                Standard deviation of frame latency jitter in microseconds.
+            realtime : bool, default True
+                If False, get_frame() returns immediately without simulating the latency.
+            noise_rows : int
+                Extra rows in the noise field. Each frame uses a randomly offset window of it,
+                so consecutive frames do not share the same noise.
+            seed : int, optional
+                Seed for the random generator.
+        """
+
+        logging.debug("Initializing simulated camera interface")
+        self._rng = np.random.default_rng(seed)
+        self._sensor, self._cube = self._load_source(source)
+        if width is not None or height is not None:
+            self._sensor = self._resize(self._sensor, height, width)
+            if self._cube is not None:
+                self._cube = np.stack([self._resize(f, height, width) for f in self._cube])
+
+        self._sensor_height, self._sensor_width = self._sensor.shape
+        self._width = self._sensor_width
+        self._height = self._sensor_height
+        self._offset_x = 0
+        self._offset_y = 0
+
+        self._exposure = float(exposure)
+        # Intensity of the source corresponds to this exposure time.
+        self._reference_exposure = float(exposure)
+        self._readout_time = float(readout_time)
+        self._jitter = float(jitter)
+        self.realtime = realtime
+
+        if self._cube is None:
+            max_val = float(np.max(self._sensor))
+            self._noise = self._rng.uniform(0, P.sim_noise_fac * max_val,
+                                            size=(self._sensor_height + noise_rows, self._sensor_width))
+            self._noise = self._noise.astype(np.float32)
+        else:
+            self._noise = None
+
+        self._frame_counter = 0
+        self._last_frame_time = None
+        self.is_acquiring = False
+
+        if camera_settings_path is not None:
+            self.load_camera_settings(camera_settings_path)
+        logging.info("Simulated camera initialized successfully")
+
+    def _load_source(self, source):
+        """Returns sensor frame and possible cube (or None) as float32 numpy arrays."""
+
+        if source is None:
+            # Imported here as synthetic_data pulls in most of the program.
+            import synthetic_data
+            frame, _ = synthetic_data.generate_undistorted_frame(add_noise=False)
+            return frame.values.astype(np.float32), None
+
+        if isinstance(source, str):
+            source = xr.open_dataset(os.path.abspath(source))
+            source.load()
+            source.close()
+
+        if isinstance(source, xr.Dataset):
+            if P.naming_frame_data in source:
+                source = source[P.naming_frame_data]
+            else:
+                source = source[list(source.data_vars)[0]]
+
+        if P.dim_scan in source.dims:
+            cube = source.transpose(*P.dim_order_cube).values.astype(np.float32)
+            cube = np.nan_to_num(cube)
+            return cube[0], cube
+        frame = np.nan_to_num(source.transpose(*P.dim_order_frame).values.astype(np.float32))
+        return frame, None
+
+    @staticmethod
+    def _resize(frame, height, width):
+        """Crops or zero pads frame to given size. None keeps the size."""
+
+        h = frame.shape[0] if height is None else height
+        w = frame.shape[1] if width is None else width
+        out = np.zeros((h, w), dtype=np.float32)
+        hh = min(h, frame.shape[0])
+        ww = min(w, frame.shape[1])
+        out[:hh, :ww] = frame[:hh, :ww]
+        return out
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Nothing to release, but kept for API compatibility."""
+
+        self.is_acquiring = False
+
+    def turn_on(self):
+        """Start acquisition."""
+
+        logging.debug("Turning simulated camera on.")
+        self.is_acquiring = True
+
+    def turn_off(self):
+        """Stop acquisition."""
+
+        logging.debug("Turning simulated camera off.")
+        self.is_acquiring = False
+        self._last_frame_time = None
+
+    def frame_latency(self) -> float:
+        """Simulated latency of the next frame in seconds."""
+
+        latency = self._exposure + self._readout_time * self._height
+        if self._jitter > 0:
+            latency += self._rng.normal(0, self._jitter)
+        return max(latency, 0.0) * 1e-6
+
+    def _wait_for_frame(self):
+        """Sleep until the simulated frame is ready."""
+
+        latency = self.frame_latency()
+        now = time.perf_counter()
+        if self._last_frame_time is None or not self.is_acquiring or latency <= 0:
+            ready = now + latency
+        else:
+            # Free running sensor: next frame is ready at the next frame boundary.
+            periods = max(np.ceil((now - self._last_frame_time) / latency), 1)
+            ready = self._last_frame_time + periods * latency
+        if ready > now:
+            time.sleep(ready - now)
+        self._last_frame_time = ready
+
+    def _next_frame_data(self) -> np.ndarray:
+        """Frame data of current crop as a new numpy array."""
+
+        y = slice(self._offset_y, self._offset_y + self._height)
+        x = slice(self._offset_x, self._offset_x + self._width)
+        if self._cube is not None:
+            data = self._cube[self._frame_counter % self._cube.shape[0], y, x].copy()
+        else:
+            k = self._rng.integers(0, self._noise.shape[0] - self._sensor_height + 1)
+            noise = self._noise[k + self._offset_y:k + self._offset_y + self._height, x]
+            data = np.add(self._sensor[y, x], noise)
+        gain = self._exposure / self._reference_exposure
+        if gain != 1.0:
+            data *= gain
+        return data
+
+    def get_frame(self) -> DataArray:
+        """Acquire a single frame.
+
+        Returns
+        -------
+        frame : DataArray
+            The simulated frame.
+        """
+
+        if self.realtime:
+            self._wait_for_frame()
+        data = self._next_frame_data()
+        self._frame_counter += 1
+
+        coords = {
+            P.dim_x: (P.dim_x, np.arange(0, self._width) + 0.5),
+            P.dim_y: (P.dim_y, np.arange(0, self._height) + 0.5),
+            "timestamp": dt.datetime.today().timestamp(),
+            "frame_counter": self._frame_counter - 1,
+        }
+        return DataArray(data, name=P.naming_frame_data, dims=P.dim_order_frame, coords=coords)
+
+    def stream(self, count=None):
+        """Stream frames continuously as a free running sensor would.
+
+        Frames carry 'timestamp' and 'frame_counter' coordinates. Close the generator
+        (or exhaust it) to stop streaming.
+
+        Parameters
+        ----------
+        count : int, optional
+            Amount of frames to stream. If None, streams until the generator is closed.
+
+        Yields
+        ------
+        frame : DataArray
+            Streamed frame.
+        """
+
+        camera_was_acquiring = self.is_acquiring
+        if not camera_was_acquiring:
+            self.turn_on()
+        n = 0
+        try:
+            while count is None or n < count:
+                yield self.get_frame()
+                n += 1
+        finally:
+            if not camera_was_acquiring:
+                self.turn_off()
+
+    def run_stream(self, callback, count=None):
+        """Stream frames to a callback until it returns False or count frames are done."""
+
+        return camera_backends.run_stream(self, callback, count)
+
+    def frame_rate(self, value=None):
+        """Set or return the frame rate. Setting adjusts the simulated row readout time."""
+
+        if value is None:
+            latency = (self._exposure + self._readout_time * self._height) * 1e-6
+            return 1.0 / latency if latency > 0 else float('inf')
+        frame_time = 1e6 / value
+        self._readout_time = max(frame_time - self._exposure, 0.0) / self._height
+
+    def get_frame_opt(self, count=1, method='mean', return_statistics=False) -> DataArray:
+        """Acquire a frame which is a mean or median of several frames.
+
+        Camera state (acquiring or not) will be preserved.
+
+        Parameters
+        ----------
+        count : int, default=1
+            If given, the mean of 'mean' consecutive frames is returned. If count == 1
+            this is the same as get_frame().
+        method: str, default = 'mean'
+            Either 'mean' or 'median' of count consecutive frames.
+        return_statistics : bool, default False
+            If True, the running statistics of the frames are returned as well.
+            Use its noise_map() for quality control of the frame.
+
+        Returns
+        -------
+        frame : DataArray
+            The shot frame.
+        statistics : RunningStatistics
+            Only if return_statistics is True.
+        """
+
+        stats = running_statistics.accumulate(self.stream(count), count, method)
+        frame = stats.frame(method)
+        if return_statistics:
+            return frame, stats
+        return frame
+
+    def exposure(self, value=None):
+        """Set or return exposure in microseconds."""
+
+        if value is None:
+            return self._exposure
+        self._exposure = float(value)
+
+    def width(self) -> int:
+        """Current frame width in pixels."""
+
+        return self._width
+
+    def height(self) -> int:
+        """Current frame height in pixels."""
+
+        return self._height
+
+    def crop(self, width=None, width_offset=None, height=None, height_offset=None, full=False):
+        """Crop the frame in sensor pixels.
+
+        Parameters
+        ----------
+            width, width_offset, height, height_offset : int, optional
+                New crop. None keeps the old value.
+            full : bool, default False
+                If True, the full sensor is used and other parameters are ignored.
+
+        Returns
+        -------
+            old : tuple
+                Crop before the call as (width, width_offset, height, height_offset).
+            new : tuple
+                Crop after the call in the same format.
+        """
+
+        old = (self._width, self._offset_x, self._height, self._offset_y)
+        if full:
+            self._width, self._offset_x = self._sensor_width, 0
+            self._height, self._offset_y = self._sensor_height, 0
+        else:
+            if width_offset is not None:
+                self._offset_x = int(np.clip(width_offset, 0, self._sensor_width - 1))
+            if height_offset is not None:
+                self._offset_y = int(np.clip(height_offset, 0, self._sensor_height - 1))
+            if width is not None:
+                self._width = int(width)
+            if height is not None:
+                self._height = int(height)
+            self._width = int(np.clip(self._width, 1, self._sensor_width - self._offset_x))
+            self._height = int(np.clip(self._height, 1, self._sensor_height - self._offset_y))
+        new = (self._width, self._offset_x, self._height, self._offset_y)
+        logging.debug(f"Simulated crop set to {new}")
+        return old, new
+
+    def _crop(self, width=None, width_offset=None, height=None, height_offset=None, full=False):
+        return self.crop(width, width_offset, height, height_offset, full)
+
+    def get_crop_meta_dict(self) -> dict:
+        """Current crop as a dictionary using camera feature names."""
+
+        return {
+            P.cam_width: self._width,
+            P.cam_offset_x: self._offset_x,
+            P.cam_height: self._height,
+            P.cam_offset_y: self._offset_y,
+        }
+
+    def load_camera_settings(self, path):
+        """Apply crop and exposure from a camera settings file. Other features are ignored."""
+
+        with open(path, 'r') as file:
+            settings = toml.load(file)
+        self.crop(settings.get(P.cam_width), settings.get(P.cam_offset_x),
+                  settings.get(P.cam_height), settings.get(P.cam_offset_y))
+        if P.cam_exposure_time in settings:
+            self.exposure(settings[P.cam_exposure_time])
+
+    def save_camera_settings(self, path):
+        """Save crop and exposure into a camera settings file.
+
+        Other features of an existing file are preserved.
+        """
+
+        settings = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                settings = toml.load(file)
+        settings.update(self.get_crop_meta_dict())
+        settings[P.cam_exposure_time] = self._exposure
+        with open(path, 'w') as file:
+            toml.dump(settings, file)
+
+
+class ReplayCameraInterface(SimulatedCameraInterface):
+    """Simulated camera that replays a recorded cube or frame file.
+
+    The file is given either as source argument or with 'replay_source' key in
+    the camera settings file.
+    """
+
+    def __init__(self, camera_settings_path=None, source=None, **kwargs):
+        if source is None and camera_settings_path is not None and os.path.exists(camera_settings_path):
+            with open(camera_settings_path, 'r') as file:
+                source = toml.load(file).get(P.cam_key_replay_source)
+        if source is None:
+            raise ValueError(f"Replay camera needs a source file. Give it as an argument or as "
+                             f"'{P.cam_key_replay_source}' in the camera settings file.")
+        super().__init__(camera_settings_path, source=source, **kwargs)
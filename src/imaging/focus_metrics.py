@@ -0,0 +1,184 @@
+"""
+
+Focus metrics for live camera frames.
+
+The metrics are computed with NumPy only on the selected columns of the frame
+and on a sub-sampled region of interest (ROI), so they are cheap enough to be
+computed for every frame of a live feed. Histories are kept in fixed-size ring
+buffers. Nothing here depends on matplotlib, so the metrics can be used headless,
+e.g., in a script that turns a focusing screw until the metric peaks.
+
+Available metrics (bigger is sharper except for edge width):
+- column_variance   Variance along y of each selected column.
+- edge_width        10-90 % width in pixels of the steepest edge along y of each selected column.
+- tenengrad         Mean squared Sobel gradient magnitude in the ROI.
+- laplacian_energy  Mean squared Laplacian in the ROI.
+
+"""
+
+import math
+import numpy as np
+
+from core import properties as P
+
+metric_column_variance = 'column_variance'
+metric_edge_width = 'edge_width'
+metric_tenengrad = 'tenengrad'
+metric_laplacian_energy = 'laplacian_energy'
+metric_names = (metric_column_variance, metric_edge_width, metric_tenengrad, metric_laplacian_energy)
+
+
+class RingBuffer:
+    """Fixed-size history of vectors.
+
+    Each value is written twice, at i and i + size, so that the chronologically
+    ordered history is always a contiguous view without copying or rolling.
+    """
+
+    def __init__(self, size:int, channels:int=1):
+        self.size = size
+        self._data = np.zeros((2 * size, channels), dtype=np.float64)
+        self._next = 0
+        self.count = 0
+
+    def append(self, value):
+        self._data[self._next] = value
+        self._data[self._next + self.size] = value
+        self._next = (self._next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def view(self) -> np.ndarray:
+        """History as a (size, channels) view. Oldest first, newest last."""
+
+        return self._data[self._next:self._next + self.size]
+
+    def latest(self) -> np.ndarray:
+        return self._data[self._next + self.size - 1]
+
+
+def column_variance(values:np.ndarray, columns) -> np.ndarray:
+    """Variance along y of the given columns."""
+
+    return values[:, columns].var(axis=0)
+
+
+def edge_width(profiles:np.ndarray, low=0.1, high=0.9) -> np.ndarray:
+    """Width of the steepest edge of each profile (columns of profiles) in samples.
+
+    The width is the count of samples between low and high fractions of the
+    value range around the steepest point of the profile. The window around the
+    edge is P.focus_edge_window samples to both sides.
+    """
+
+    profiles = np.asarray(profiles, dtype=np.float64)
+    n = profiles.shape[0]
+    steepest = np.argmax(np.abs(np.diff(profiles, axis=0)), axis=0)
+    half = P.focus_edge_window
+    offsets = np.arange(-half, half + 1)
+    rows = np.clip(steepest[None, :] + offsets[:, None], 0, n - 1)
+    window = np.take_along_axis(profiles, rows, axis=0)
+    w_min = window.min(axis=0)
+    w_max = window.max(axis=0)
+    span = np.where(w_max > w_min, w_max - w_min, 1.0)
+    level = (window - w_min) / span
+    return np.count_nonzero((level > low) & (level < high), axis=0).astype(np.float64)
+
+
+def tenengrad(region:np.ndarray) -> float:
+    """Mean squared Sobel gradient magnitude of a 2D region."""
+
+    r = np.asarray(region, dtype=np.float64)
+    # Sobel kernels written out as sums of shifted slices.
+    gx = (r[:-2, 2:] + 2 * r[1:-1, 2:] + r[2:, 2:]) - (r[:-2, :-2] + 2 * r[1:-1, :-2] + r[2:, :-2])
+    gy = (r[2:, :-2] + 2 * r[2:, 1:-1] + r[2:, 2:]) - (r[:-2, :-2] + 2 * r[:-2, 1:-1] + r[:-2, 2:])
+    return float(np.mean(gx * gx + gy * gy))
+
+
+def laplacian_energy(region:np.ndarray) -> float:
+    """Mean squared 4-neighbour Laplacian of a 2D region."""
+
+    r = np.asarray(region, dtype=np.float64)
+    lap = r[:-2, 1:-1] + r[2:, 1:-1] + r[1:-1, :-2] + r[1:-1, 2:] - 4 * r[1:-1, 1:-1]
+    return float(np.mean(lap * lap))
+
+
+class FocusMetrics:
+    """Computes focus metrics for each frame and keeps their histories."""
+
+    def __init__(self, frame_shape, columns, rows=None, roi=None, history=1000):
+        """Initialize metrics for frames of given shape.
+
+        Parameters
+        ----------
+            frame_shape : tuple
+                Shape (height, width) of the frames.
+            columns : array-like
+                Columns (x indices) for column variance and edge width.
+            rows : array-like, optional
+                Rows (y indices). Together with columns these define the default ROI.
+            roi : tuple, optional
+                Region of interest as (y_start, y_stop, x_start, x_stop). If not given,
+                the bounding box of selected rows and columns padded with
+                P.focus_roi_margin pixels is used.
+            history : int, default 1000
+                Length of metric histories.
+        """
+
+        h, w = frame_shape
+        self.columns = np.asarray(columns, dtype=int)
+        self.rows = np.asarray(rows if rows is not None else [h // 2], dtype=int)
+        if roi is None:
+            m = P.focus_roi_margin
+            roi = (max(0, self.rows.min() - m), min(h, self.rows.max() + m + 1),
+                   max(0, self.columns.min() - m), min(w, self.columns.max() + m + 1))
+        self.roi = tuple(int(v) for v in roi)
+        # Sub-sample the ROI so that neither side has more than P.focus_roi_max_size samples.
+        y0, y1, x0, x1 = self.roi
+        self.roi_step = max(1, math.ceil(max(y1 - y0, x1 - x0) / P.focus_roi_max_size))
+
+        self._histories = {
+            metric_column_variance: RingBuffer(history, len(self.columns)),
+            metric_edge_width: RingBuffer(history, len(self.columns)),
+            metric_tenengrad: RingBuffer(history, 1),
+            metric_laplacian_energy: RingBuffer(history, 1),
+        }
+
+    def update(self, values:np.ndarray) -> dict:
+        """Compute metrics of a frame and add them to the histories.
+
+        Parameters
+        ----------
+            values : numpy array
+                Frame as a 2D (y, x) array.
+
+        Returns
+        -------
+            dict
+                Metric name -> numpy array of current values.
+        """
+
+        y0, y1, x0, x1 = self.roi
+        s = self.roi_step
+        region = values[y0:y1:s, x0:x1:s]
+        profiles = values[:, self.columns]
+        current = {
+            metric_column_variance: profiles.var(axis=0),
+            metric_edge_width: edge_width(profiles),
+            metric_tenengrad: np.array([tenengrad(region)]),
+            metric_laplacian_energy: np.array([laplacian_energy(region)]),
+        }
+        for name, value in current.items():
+            self._histories[name].append(value)
+        return current
+
+    def history(self, name:str) -> np.ndarray:
+        """History of a metric as a (history, channels) array, oldest first."""
+
+        if name not in self._histories:
+            raise ValueError(f"Unknown focus metric '{name}'. Available metrics are {metric_names}.")
+        return self._histories[name].view()
+
+    def latest(self) -> dict:
+        """Latest values of all metrics."""
+
+        return {name: buffer.latest().copy() for name, buffer in self._histories.items()}
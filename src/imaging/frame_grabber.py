@@ -0,0 +1,115 @@
+"""
+
+Background frame capture with latest-frame semantics.
+
+FrameGrabber runs the stream of a camera interface in its own thread and
+publishes only the newest frame through a single slot. A consumer, such as
+the Preview, picks up the latest frame when it is ready to draw one. Frames
+that were overwritten before being picked up are counted as dropped, so slow
+rendering never delays the capture and slow capture never blocks the GUI.
+
+The slot is a single tuple replaced by assignment, which is atomic in Python,
+so no lock is needed.
+
+"""
+
+import logging
+import threading
+import time
+
+
+class FrameGrabber:
+    """Captures frames in a background thread and keeps the latest one."""
+
+    def __init__(self, cami, smoothing=0.1):
+        """Create a grabber for a camera interface. Call start() to begin capturing.
+
+        Parameters
+        ----------
+            cami :
+                Camera interface with stream() method. The stream must not reuse
+                frame buffers (i.e., no zero copy), as the frames are used in another thread.
+            smoothing : float, default 0.1
+                Weight of the newest interval in the running capture rate estimate.
+        """
+
+        self._cami = cami
+        self._smoothing = smoothing
+        self._thread = None
+        self._stop_event = threading.Event()
+        # (frame, capture time from time.perf_counter(), sequence number)
+        self._slot = None
+        self._taken_seq = 0
+        self.frames_captured = 0
+        self.frames_dropped = 0
+        self.capture_fps = 0.0
+        self.error = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the capture thread if it is not running already."""
+
+        if self.is_running:
+            return
+        self._stop_event.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, name='FrameGrabber', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        """Stop the capture thread and wait for it to finish."""
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.warning(f"Capture thread did not stop in {timeout} s.")
+            self._thread = None
+
+    def _run(self):
+        stream = self._cami.stream()
+        previous = None
+        seq = 0
+        try:
+            for frame in stream:
+                now = time.perf_counter()
+                seq += 1
+                self._slot = (frame, now, seq)
+                self.frames_captured += 1
+                if previous is not None and now > previous:
+                    rate = 1.0 / (now - previous)
+                    if self.capture_fps == 0:
+                        self.capture_fps = rate
+                    else:
+                        self.capture_fps += self._smoothing * (rate - self.capture_fps)
+                previous = now
+                if self._stop_event.is_set():
+                    break
+        except Exception as e:
+            self.error = e
+            logging.error(f"Frame capture failed: {e}")
+        finally:
+            # The generator must be closed in the thread that runs it.
+            stream.close()
+
+    def latest(self):
+        """Take the newest frame if there is one that has not been taken yet.
+
+        Returns
+        -------
+            tuple or None
+                (frame, capture_time) where capture_time is from time.perf_counter(),
+                or None if no new frame has been captured since the last call.
+        """
+
+        slot = self._slot
+        if slot is None or slot[2] == self._taken_seq:
+            return None
+        frame, capture_time, seq = slot
+        # Frames published between two calls were never shown.
+        self.frames_dropped += seq - self._taken_seq - 1
+        self._taken_seq = seq
+        return frame, capture_time
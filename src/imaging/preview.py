@@ -4,6 +4,8 @@ This file contains the Preview class that provides live feed from the connected
 
 """
 
+import math
+import time
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
@@ -12,7 +14,11 @@ import xarray as xr
 import logging
 
 from utilities import plotting
-from core.camera_interface import CameraInterface
+from core import camera_backends
+from core import properties as P
+from core import line_locator
+from imaging import focus_metrics as fm
+from imaging.frame_grabber import FrameGrabber
 
 class Preview:
     """Class for getting raw live feed from the camera.
@@ -22,10 +28,15 @@ class Preview:
     use the lower right corner's Variance view while imaging
     some high-contrast target like a black-white checker illuminated
     with white light, such as sun or a halogen spot. The
-    focus is best when the variance is as high as possible.
+    focus is best when the variance is as high as possible. Other focus
+    metrics (see imaging.focus_metrics) can be shown with set_focus_metric()
+    and read with focus_metrics.latest().
 
-    The scale of the plots is horrible when drastic changes in illumination
-    happen. Restarting the preview helps.
+    By default the preview is rendered with blitting: only the changing
+    artists are redrawn, the camera image is decimated for display, and colour
+    limits follow a running robust percentile estimate. Axes are rescaled only
+    when the data changes significantly, which keeps the scale stable. Use
+    blit=False for the old behaviour of redrawing everything every frame.
 
     """
 
@@ -46,8 +57,19 @@ class Preview:
 
     # How many frames worth of variances are shown in history plot.
     _var_frame_count = 1000
-    # List of maximum variance history values.
-    _mvh_list = None
+    # Focus metrics engine holding the metric histories.
+    focus_metrics = None
+    # Name of the focus metric shown in the history plot.
+    _focus_metric = fm.metric_column_variance
+
+    # Captures frames in a background thread. Created in start() and stopped in stop().
+    _grabber = None
+    # Text showing capture and render rates and latency over the camera feed.
+    _hud = None
+    # Running estimates of render rate and capture-to-screen latency for the HUD.
+    _render_fps = 0.0
+    _latency = 0.0
+    _last_render_time = None
 
     # Animation handle for pyplot function animation. 
     # Used for pausing and unpausing the animation.
@@ -56,6 +78,13 @@ class Preview:
     # Used for animation update
     _fig = None
 
+    # Render with blitting and decimated display image.
+    _blit = True
+    # Decimation step of the displayed camera image.
+    _display_step = 1
+    # Running estimate of the colour limits of the camera image.
+    _clim = None
+
     # -- State variables --
     # Are plots initialized
     _plots_initialized = False
@@ -64,13 +93,34 @@ class Preview:
     # Is the preview object running
     is_running = False
 
-    def __init__(self, camera_settings_path=None):
-        """Initialize the Preview object."""
+    def __init__(self, camera_settings_path=None, cami=None, blit=True, locate_lines=True):
+        """Initialize the Preview object.
+
+        Parameters
+        ----------
+            camera_settings_path : str, optional
+                Camera settings to be loaded by the created camera interface. Also
+                selects the camera backend (see core.camera_backends).
+            cami : optional
+                Camera interface to use instead of creating a new one, e.g.,
+                a SimulatedCameraInterface.
+            blit : bool, default True
+                Use the fast blitting renderer. If False, the whole figure is redrawn
+                every frame with the full resolution image.
+            locate_lines : bool, default True
+                Place the vertical lines on the brightest spectral lines of the first
+                frame. Use locate_lines() to relocate them later.
+        """
 
         print(f"Initializing Preview object.")
 
         self._window_name = 'Preview'
-        self._cami = CameraInterface(camera_settings_path)
+        self._blit = blit
+        self._locate_lines_on_init = locate_lines
+        if cami is not None:
+            self._cami = cami
+        else:
+            self._cami = camera_backends.create_camera_interface(camera_settings_path)
         # self._cami._set_camera_feature('BinningHorizontal', 2)
         # self._cami._set_camera_feature('BinningVertical', 1)
         self._vertical_line_positions = self._make_line_positions('vertical')
@@ -101,6 +151,9 @@ class Preview:
     def close(self):
         """Close the preview and delete the CameraInterface object."""
 
+        if self._grabber is not None:
+            self._grabber.stop()
+            self._grabber = None
         if self._cami is not None:
             del self._cami
         plt.close(self._window_name)
@@ -139,25 +192,40 @@ class Preview:
         self._cami.turn_on()
         frame = self._cami.get_frame()
         self._cami.turn_off()
-        
-        self._plots.append(self._subplot_cam.imshow(frame))
+
+        if self._locate_lines_on_init:
+            self._vertical_line_positions = self._located_line_positions(frame.values)
+
+        if self._blit:
+            h, w = frame.shape
+            # Show at most preview_max_display_size pixels, but not much more than fits the axes.
+            bbox = self._subplot_cam.get_window_extent()
+            self._display_step = max(1, math.ceil(max(h, w) / P.preview_max_display_size),
+                                     math.floor(min(h / bbox.height, w / bbox.width)))
+            self._clim = self._frame_percentiles(frame.values)
+            # Extent keeps the axes in full frame pixel coordinates.
+            self._plots.append(self._subplot_cam.imshow(self._display_image(frame.values),
+                                                        extent=(-0.5, w - 0.5, h - 0.5, -0.5),
+                                                        interpolation='nearest', clim=self._clim))
+        else:
+            self._plots.append(self._subplot_cam.imshow(frame))
         self._fig.colorbar(self._plots[0], ax=self._subplot_cam)
 
         # Make as many variance graphs as there are vertical lines
-        self._mvh_list = []
-        for _, _ in enumerate(self._vertical_line_positions):
-            self._mvh_list += [np.zeros(self._var_frame_count)]
+        self.focus_metrics = fm.FocusMetrics(frame.shape, self._vertical_line_positions,
+                                             self._horizontal_line_positions, history=self._var_frame_count)
+        self.focus_metrics.update(frame.values)
+        self._history_x = np.arange(0, self._var_frame_count)
 
         line_colors = plotting.getColorList(3,'Oranges',0.7) + plotting.getColorList(3,'Purples',0.7)
 
-        frame_var = frame.var(dim='y')
         for i, _ in enumerate(self._vertical_line_positions):
-            self._mvh_list[i][len(self._mvh_list[0]) - 1] = frame_var[self._vertical_line_positions[i]]
             self._plots += self._subplot_variance.plot(
-                np.arange(0, len(self._mvh_list[0])),
-                self._mvh_list[i],
+                self._history_x,
+                self.focus_metrics.history(fm.metric_column_variance)[:, i],
                 color=line_colors[i + len(self._horizontal_line_positions)]
-            )        
+            )
+        self.set_focus_metric(self._focus_metric)
 
         frame_x = frame.x.values
         frame_y = frame.y.values
@@ -180,8 +248,8 @@ class Preview:
         # Horizontal lines over live feed
         for i, _ in enumerate(self._horizontal_line_positions):
             self._plots += self._subplot_cam.plot(
-                frame_x,
-                np.ones_like(frame_x) * self._horizontal_line_positions[i],
+                frame_x[[0, -1]],
+                np.ones(2) * self._horizontal_line_positions[i],
                 '-', 
                 linewidth=1, 
                 color=line_colors[i]
@@ -190,13 +258,31 @@ class Preview:
         # Vertical lines over live feed
         for i, _ in enumerate(self._vertical_line_positions):
             self._plots += self._subplot_cam.plot(
-                np.ones_like(frame_y) * self._vertical_line_positions[i],
-                frame_y,
+                np.ones(2) * self._vertical_line_positions[i],
+                frame_y[[0, -1]],
                 '-', 
                 linewidth=1, 
                 color=line_colors[i + len(self._horizontal_line_positions)]
                 )
 
+        if self._blit:
+            # Limits are managed by _rescale() instead of autoscaling every frame.
+            self._subplot_variance.set_xlim(0, self._var_frame_count - 1)
+            self._subplot_row_values.set_xlim(frame_x[0], frame_x[-1])
+            self._subplot_column_values.set_xlim(frame_y[0], frame_y[-1])
+            for ax in (self._subplot_variance, self._subplot_row_values, self._subplot_column_values):
+                ax.set_autoscale_on(False)
+
+        if self._blit:
+            for line in self._plots[1:]:
+                # Antialiasing is the most expensive part of drawing the lines.
+                line.set_antialiased(False)
+
+        self._hud = self._subplot_cam.text(0.01, 0.99, '', transform=self._subplot_cam.transAxes,
+                                           va='top', ha='left', fontsize='small', color='white',
+                                           bbox=dict(facecolor='black', alpha=0.5, linewidth=0))
+        self._plots.append(self._hud)
+
         self._plots_initialized = True
         print("... done")
     
@@ -211,18 +297,22 @@ class Preview:
             self._initPlots()
 
         if self._animation is None:
-            # Blit off so that autoscale can work. As the autoscale does not work too well, blitting could be
-            # on and rendering a bit faster.
-            self._animation = animation.FuncAnimation(self._fig, self._snap, interval=10, blit=False)
+            # Without blitting, the whole figure is drawn so that autoscale can work.
+            self._animation = animation.FuncAnimation(self._fig, self._snap, interval=10, blit=self._blit,
+                                                      cache_frame_data=False)
         else:
             if self._animation.event_source:
                 self._animation.event_source.start()
             else:
                 logging.warning("No animation event source to start. Creating new animation.")
                 self._cami.turn_on()
-                self._animation = animation.FuncAnimation(self._fig, self._snap, interval=10, blit=False)
+                self._animation = animation.FuncAnimation(self._fig, self._snap, interval=10, blit=self._blit,
+                                                          cache_frame_data=False)
 
         self._cami.turn_on()
+        if self._grabber is None:
+            self._grabber = FrameGrabber(self._cami)
+        self._grabber.start()
         self._animation_is_running = True
         self.is_running = True
         plt.show()
@@ -233,6 +323,9 @@ class Preview:
         Stops the animation if it was running and stops camera acquisition.
         """
 
+        if self._grabber is not None:
+            self._grabber.stop()
+
         if self._animation is not None and self._animation.event_source is not None:
             self._animation.event_source.stop()
             self._animation_is_running = False
@@ -241,40 +334,229 @@ class Preview:
         self.is_running = False
     
     def _snap(self, i):
-        """Update function for the animation."""
+        """Update function for the animation.
 
-        frame = self._cami.get_frame()
-
-        self._plots[0].set_data(frame.values)
-
-        frame_var = frame.var(dim='y')
+        Draws the latest frame of the capture thread. If no new frame has arrived
+        since the last call, nothing is redrawn.
+        """
 
-        for i, _ in enumerate(self._vertical_line_positions):
-            # Shift all values one step to the left and place new max variance last.
-            self._mvh_list[i] = np.roll(self._mvh_list[i], -1)
-            self._mvh_list[i][len(self._mvh_list[0]) - 1] = frame_var[self._vertical_line_positions[i]]
-            self._plots[1 + i].set_data(np.arange(0, len(self._mvh_list[0])), self._mvh_list[i])
+        if self._grabber is None:
+            self._grabber = FrameGrabber(self._cami)
+            self._grabber.start()
+        latest = self._grabber.latest()
+        if latest is None:
+            return [] if self._blit else self._plots
+        frame, capture_time = latest
+        values = frame.values
+
+        if self._blit:
+            self._plots[0].set_data(self._display_image(values))
+        else:
+            self._plots[0].set_data(values)
+
+        self.focus_metrics.update(values)
+        history = self.focus_metrics.history(self._focus_metric)
+        n_history = len(self._vertical_line_positions)
+        for i in range(n_history):
+            # Scalar metrics have a single channel shown with the first line.
+            if i < history.shape[1]:
+                self._plots[1 + i].set_data(self._history_x, history[:, i])
+            else:
+                self._plots[1 + i].set_data([], [])
 
-        self._subplot_variance.relim()
-        self._subplot_column_values.relim()
-        self._subplot_row_values.relim()
+        # Line plots are decimated like the image, as there are not more pixels on screen.
+        step = self._display_step
+        frame_x = frame.x.values[::step]
+        frame_y = frame.y.values[::step]
+        rows = values[self._horizontal_line_positions, ::step]
+        columns = values[::step, self._vertical_line_positions]
 
         # Horizontal lines
         for i, _ in enumerate(self._horizontal_line_positions):
-            self._plots[i + 1 + len(self._mvh_list)]\
-                .set_data(frame.x.values, frame.isel(y=self._horizontal_line_positions[i]).values)
+            self._plots[i + 1 + n_history].set_data(frame_x, rows[i])
 
         # Vertical lines
         for i, _ in enumerate(self._vertical_line_positions):
-            self._plots[i + 1 + len(self._mvh_list) + len(self._horizontal_line_positions)]\
-                .set_data(frame.y.values, frame.isel(x=self._vertical_line_positions[i]).values)
-        
+            self._plots[i + 1 + n_history + len(self._horizontal_line_positions)]\
+                .set_data(frame_y, columns[:, i])
+
+        if self._blit:
+            redraw = self._update_color_limits(values)
+            redraw |= self._rescale(self._subplot_variance, history)
+            redraw |= self._rescale(self._subplot_row_values, rows)
+            redraw |= self._rescale(self._subplot_column_values, columns)
+            if redraw:
+                # Full draw updates ticks and colorbar. Blitting picks up the new background.
+                self._fig.canvas.draw()
+        else:
+            self._subplot_variance.relim()
+            self._subplot_column_values.relim()
+            self._subplot_row_values.relim()
+
+        self._update_hud(capture_time)
         return self._plots
 
+    def _update_hud(self, capture_time:float):
+        """Update running render rate and latency estimates and the HUD text.
+
+        Latency is measured from the arrival of the frame in the capture thread
+        to the end of the update, just before the artists are drawn.
+        """
+
+        now = time.perf_counter()
+        a = 0.1
+        self._latency += a * ((now - capture_time) - self._latency)
+        if self._last_render_time is not None and now > self._last_render_time:
+            self._render_fps += a * (1.0 / (now - self._last_render_time) - self._render_fps)
+        self._last_render_time = now
+        self._hud.set_text(f"capture {self._grabber.capture_fps:5.1f} fps\n"
+                           f"render  {self._render_fps:5.1f} fps\n"
+                           f"latency {self._latency * 1000:5.0f} ms\n"
+                           f"dropped {self._grabber.frames_dropped}")
+
+    def set_focus_metric(self, name:str):
+        """Select the focus metric shown in the history plot.
+
+        Parameters
+        ----------
+            name : str
+                One of imaging.focus_metrics.metric_names.
+        """
+
+        if name not in fm.metric_names:
+            logging.error(f"Unknown focus metric '{name}'. Available metrics are {fm.metric_names}.")
+            return
+        self._focus_metric = name
+        if self._subplot_variance is not None:
+            self._subplot_variance.set_title(f"{name.replace('_', ' ').capitalize()} (focusing)")
+            if self._fig is not None:
+                self._fig.canvas.draw_idle()
+
+    def _display_image(self, values):
+        """Decimated view of the frame for display."""
+
+        step = self._display_step
+        return values[::step, ::step]
+
+    def _frame_percentiles(self, values):
+        """Robust colour limits of a frame estimated from a sparse sample of its pixels."""
+
+        step = self._display_step * 2
+        low, high = np.percentile(values[::step, ::step], P.preview_clim_percentiles)
+        if high <= low:
+            high = low + 1
+        return float(low), float(high)
+
+    def _update_color_limits(self, values) -> bool:
+        """Update the running colour limit estimate and apply it on significant change.
+
+        Returns
+        -------
+            bool
+                True if the colour limits of the image were changed.
+        """
+
+        low, high = self._frame_percentiles(values)
+        old_low, old_high = self._clim
+        half_span = (old_high - old_low) / 2
+        if abs(low - old_low) > half_span or abs(high - old_high) > half_span:
+            # Drastic change in illumination. Jump instead of slowly converging.
+            a = 1.0
+        else:
+            a = P.preview_clim_smoothing
+        new_low = (1 - a) * old_low + a * low
+        new_high = (1 - a) * old_high + a * high
+        self._clim = (new_low, new_high)
+
+        shown_low, shown_high = self._plots[0].get_clim()
+        tolerance = P.preview_rescale_threshold * (shown_high - shown_low)
+        if abs(new_low - shown_low) > tolerance or abs(new_high - shown_high) > tolerance:
+            self._plots[0].set_clim(new_low, new_high)
+            return True
+        return False
+
+    @staticmethod
+    def _rescale(ax, data) -> bool:
+        """Rescale y-axis of given axes if data does not fit or uses only a small part of it.
+
+        Returns
+        -------
+            bool
+                True if the limits were changed.
+        """
+
+        data_min = float(np.min(data))
+        data_max = float(np.max(data))
+        # Margin relative to the magnitude as well, so that flat data does not rescale every frame.
+        margin = max(P.preview_rescale_threshold * max(data_max - data_min, abs(data_max)), 1e-9)
+        low, high = ax.get_ylim()
+        fits = data_min >= low and data_max <= high
+        big_enough = (data_max - data_min) + 2 * margin >= P.preview_rescale_shrink * (high - low)
+        if fits and big_enough:
+            return False
+
+        ax.set_ylim(data_min - margin, data_max + margin)
+        return True
+
+    def _located_line_positions(self, values):
+        """Vertical line positions on the brightest spectral lines of a frame.
+
+        If fewer lines than vertical lines are found, the lines are spread tightly
+        around the brightest one. If none are found, the old positions are kept.
+        """
+
+        n = len(self._vertical_line_positions)
+        lines = line_locator.find_lines(values, count=max(n, P.line_locator_count))
+        if len(lines) == 0:
+            logging.info(f"No spectral lines found. Keeping the old line positions.")
+            return self._vertical_line_positions
+
+        offset_x = 0
+        if hasattr(self._cami, 'get_crop_meta_dict'):
+            offset_x = self._cami.get_crop_meta_dict().get(P.cam_offset_x, 0)
+        print(f"Found spectral lines. Proposed control file entry: "
+              f"{line_locator.format_positions(lines, offset_x)}")
+
+        if len(lines) >= n:
+            return np.sort(lines[:n])
+        return self._make_line_positions('vertical', center=lines[0], spacing=P.line_locator_decimation)
+
+    def locate_lines(self):
+        """Move the vertical lines onto the brightest spectral lines of the latest frame.
+
+        Prints the found positions in the format of the control file. Focus metric
+        histories start over, as they follow the vertical lines.
+        """
+
+        if not self._plots_initialized:
+            self._initPlots()
+            return
+
+        latest = self._grabber.latest() if self._grabber is not None else None
+        if latest is not None:
+            frame = latest[0]
+        else:
+            frame = self._cami.get_frame()
+        positions = self._located_line_positions(frame.values)
+        if np.array_equal(positions, self._vertical_line_positions):
+            return
+        self._vertical_line_positions = positions
+
+        self.focus_metrics = fm.FocusMetrics(frame.shape, self._vertical_line_positions,
+                                             self._horizontal_line_positions, history=self._var_frame_count)
+        n_v = len(self._vertical_line_positions)
+        n_h = len(self._horizontal_line_positions)
+        # Plots: image, variances (n_v), rows (n_h), columns (n_v), horizontal overlays (n_h),
+        # vertical overlays (n_v), HUD.
+        first_overlay = 1 + n_v + n_h + n_v + n_h
+        for i, x in enumerate(self._vertical_line_positions):
+            self._plots[first_overlay + i].set_xdata(np.ones(2) * x)
+        self._fig.canvas.draw_idle()
+
     def _make_line_positions(self, orientation, center=None,  spacing=None):
         """Centers three lines around a center line.
 
-        TODO find an emission line and make a tight spread around it
+        Use _located_line_positions() to center the vertical lines on spectral lines.
         """
 
         max_w = self._cami.width()
@@ -0,0 +1,245 @@
+"""
+
+This file contains the ScanTelemetry class that records per-frame timing and
+data rate information of a scan.
+
+The log is a single preallocated structured NumPy array so that recording a frame
+costs next to nothing inside the acquisition loop. After the scan the log is saved
+as a sidecar file next to the raw cube (e.g. 'raw_telemetry.nc') and can be
+summarized without any plotting, which is handy when tuning the acquisition overhead
+over many scans.
+
+"""
+
+import os
+import errno
+import logging
+import numpy as np
+import xarray as xr
+
+from core import properties as P
+
+# Layout of a single telemetry record.
+telemetry_dtype = np.dtype([
+    (P.tel_capture_latency, np.float64),
+    (P.tel_wait_time, np.float64),
+    (P.tel_deadline_error, np.float64),
+    (P.tel_bytes_written, np.int64),
+    (P.tel_dropped, np.bool_),
+])
+
+
+class ScanTelemetry:
+    """Compact per-frame log of a single scan.
+
+    Attributes
+    ----------
+        frame_time : float
+            Planned time between consecutive frames in seconds.
+        exposure_time : float
+            Exposure time in seconds.
+        overhead : float
+            Acquisition overhead used for the scan (see control file).
+        records : numpy structured array
+            One record per frame. Field names are defined in core.properties.
+        count : int
+            How many records have been written.
+    """
+
+    def __init__(self, frame_count:int, frame_time:float, exposure_time:float, overhead:float):
+        """Preallocate the log for given amount of frames.
+
+        Parameters
+        ----------
+            frame_count : int
+                Amount of frames in the scan.
+            frame_time : float
+                Planned time between consecutive frames in seconds.
+            exposure_time : float
+                Exposure time in seconds.
+            overhead : float
+                Acquisition overhead as in the control file.
+        """
+
+        self.frame_time = float(frame_time)
+        self.exposure_time = float(exposure_time)
+        self.overhead = float(overhead)
+        self.records = np.zeros((frame_count,), dtype=telemetry_dtype)
+        self.count = 0
+        self.duration = 0.0
+
+    def record(self, i, capture_latency, wait_time, deadline_error, bytes_written=0, dropped=False):
+        """Write telemetry of frame i into the log.
+
+        A capture_latency of 0 means that the latency is not known. Such frames are
+        left out of the latency statistics of summary().
+        """
+
+        rec = self.records[i]
+        rec[P.tel_capture_latency] = capture_latency
+        rec[P.tel_wait_time] = wait_time
+        rec[P.tel_deadline_error] = deadline_error
+        rec[P.tel_bytes_written] = bytes_written
+        rec[P.tel_dropped] = dropped
+        self.count = max(self.count, i + 1)
+
+    def finish(self, duration:float):
+        """Mark the scan done and store its total duration in seconds."""
+
+        self.duration = float(duration)
+
+    def field(self, name) -> np.ndarray:
+        """Returns a view of one telemetry field for the recorded frames."""
+
+        return self.records[name][:self.count]
+
+    def summary(self) -> dict:
+        """Summarize the log.
+
+        Returns
+        -------
+            dict
+                Means, standard deviations and percentiles of latency, wait time and
+                deadline error, dropped frame count, total bytes, achieved frame rate
+                and an overhead suggestion which would have covered 95 % of the frame
+                latencies. The suggestion is the used overhead if no latencies are known.
+        """
+
+        latency = self.field(P.tel_capture_latency)
+        wait = self.field(P.tel_wait_time)
+        deadline = self.field(P.tel_deadline_error)
+        dropped = self.field(P.tel_dropped)
+        captured = latency[~dropped & (latency > 0)]
+        latency_known = captured.size > 0
+        if captured.size == 0:
+            captured = np.zeros(1)
+
+        s = {
+            'frame_count': int(self.count),
+            'dropped_count': int(np.count_nonzero(dropped)),
+            'planned_frame_time': self.frame_time,
+            'latency_mean': float(np.mean(captured)),
+            'latency_std': float(np.std(captured)),
+            'latency_p50': float(np.percentile(captured, 50)),
+            'latency_p95': float(np.percentile(captured, 95)),
+            'latency_max': float(np.max(captured)),
+            'wait_mean': float(np.mean(wait)) if wait.size else 0.0,
+            'wait_std': float(np.std(wait)) if wait.size else 0.0,
+            'deadline_error_mean': float(np.mean(deadline)) if deadline.size else 0.0,
+            'deadline_error_max': float(np.max(deadline)) if deadline.size else 0.0,
+            'bytes_total': int(np.sum(self.field(P.tel_bytes_written))),
+            'duration': self.duration,
+            'overhead': self.overhead,
+        }
+        s['fps'] = (self.count / self.duration) if self.duration > 0 else 0.0
+        if self.exposure_time > 0 and latency_known:
+            s['suggested_overhead'] = max(s['latency_p95'] / self.exposure_time - 1.0, 0.0)
+        else:
+            s['suggested_overhead'] = self.overhead
+        return s
+
+    def print_summary(self, rjust=30):
+        """Print the summary in the same fashion as scanning parameters are printed."""
+
+        s = self.summary()
+        print(f"Scan telemetry:")
+        print(f"Frames (dropped):".rjust(rjust) + f"\t {s['frame_count']} ({s['dropped_count']})")
+        print(f"Frame latency:".rjust(rjust) + f"\t {s['latency_mean']:.4f} (+- {s['latency_std']:.6f}) s, "
+                                              f"p95 {s['latency_p95']:.4f} s")
+        print(f"Planned frame time:".rjust(rjust) + f"\t {s['planned_frame_time']:.4f} s")
+        print(f"Wait time:".rjust(rjust) + f"\t {s['wait_mean']:.4f} (+- {s['wait_std']:.6f}) s")
+        print(f"Deadline error (max):".rjust(rjust) + f"\t {s['deadline_error_mean']:.4f} "
+                                                     f"({s['deadline_error_max']:.4f}) s")
+        print(f"Data:".rjust(rjust) + f"\t {s['bytes_total'] / 1e6:.1f} MB")
+        print(f"Achieved FPS:".rjust(rjust) + f"\t {s['fps']:.2f}")
+        print(f"Suggested overhead:".rjust(rjust) + f"\t {s['suggested_overhead']:.3f} "
+                                                   f"(used {s['overhead']:.3f})")
+
+    def to_dataset(self) -> xr.Dataset:
+        """Telemetry as an xarray Dataset with one variable per field along 'frame' dimension."""
+
+        ds = xr.Dataset()
+        for name in telemetry_dtype.names:
+            ds[name] = (P.dim_frame, self.field(name))
+        ds.attrs['frame_time'] = self.frame_time
+        ds.attrs['exposure_time'] = self.exposure_time
+        ds.attrs['overhead'] = self.overhead
+        ds.attrs['duration'] = self.duration
+        return ds
+
+    @classmethod
+    def from_dataset(cls, ds:xr.Dataset):
+        """Reconstruct ScanTelemetry from a Dataset made by to_dataset()."""
+
+        count = ds[P.dim_frame].size
+        tel = cls(count, ds.attrs['frame_time'], ds.attrs['exposure_time'], ds.attrs['overhead'])
+        for name in telemetry_dtype.names:
+            tel.records[name] = ds[name].values.astype(telemetry_dtype[name])
+        tel.count = count
+        tel.duration = float(ds.attrs.get('duration', 0.0))
+        return tel
+
+    def save(self, path):
+        """Save the log to given path. File extension '.nc' is added if missing."""
+
+        path_s = str(path)
+        if not path_s.endswith('.nc'):
+            path_s = path_s + '.nc'
+        abs_path = os.path.abspath(path_s)
+        logging.info(f"Saving scan telemetry to '{abs_path}'")
+        ds = self.to_dataset()
+        try:
+            ds.to_netcdf(abs_path)
+        finally:
+            ds.close()
+
+
+def load_telemetry(path) -> ScanTelemetry:
+    """Loads scan telemetry from given path.
+
+    Raises
+    ------
+        FileNotFoundError
+            if path does not exist.
+    """
+
+    path_s = str(path)
+    if not path_s.endswith('.nc'):
+        path_s = path_s + '.nc'
+    abs_path = os.path.abspath(path_s)
+
+    if not os.path.isfile(abs_path):
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), abs_path)
+    ds = xr.open_dataset(abs_path)
+    ds.load()
+    ds.close()
+    return ScanTelemetry.from_dataset(ds)
+
+
+def summarize_sessions(session_names) -> list:
+    """Summarize telemetry of several scanning sessions.
+
+    Sessions without a telemetry file are skipped with a warning.
+
+    Parameters
+    ----------
+        session_names : list of str
+            Names of sessions under the scans directory.
+
+    Returns
+    -------
+        list of dict
+            Summaries of the scans with the session name added under key 'session'.
+    """
+
+    summaries = []
+    for name in session_names:
+        path = P.path_rel_scan + name + '/' + P.telemetry_name
+        try:
+            s = load_telemetry(path).summary()
+        except FileNotFoundError:
+            logging.warning(f"No scan telemetry found for session '{name}'.")
+            continue
+        s['session'] = name
+        summaries.append(s)
+    return summaries
@@ -8,13 +8,18 @@ the following files:
 - dark.nc (dark reference frame for dark current correction)
 - white.nc (white reference frame for reflectance calculations)
 - light.nc (dark reference frame for smile correction)
+- dark_noise.nc, white_noise.nc, light_noise.nc (per-pixel noise maps of the reference frames)
+- defects.nc (defective pixel map built from dark and white frames)
 - raw.nc (the actual scanned hyperspectral image cube)
+- index_<name>.nc (band index images, see make_index_images())
+- abundances.nc (endmember abundances and residuals of the cube, see unmix())
 
 A template of the control.toml will be generated upon creation of the ScanningSession object.
 
 """
 
 import logging
+import re
 import toml
 import numpy as np
 import os
@@ -23,14 +28,20 @@ from xarray import Dataset
 
 from core import properties as P
 from utilities import file_handling as F
-from core.camera_interface import CameraInterface
-from core import smile_correction as sc
+from core import camera_backends
+from core import defect_pixels
+from core import line_locator
 import core.cube_manipulation as cm
-from analysis.cube_inspector import CubeInspector
-import analysis.frame_inspector as fi
+from analysis import cube_pyramid
+from analysis.band_math import BandMath
+from analysis import unmixing
+from imaging.scan_telemetry import ScanTelemetry
+from imaging.scan_telemetry import load_telemetry
 import time
 import math
-import matplotlib.pyplot as plt
+
+# Plotting, the cube inspector, and smile correction pull in matplotlib and scipy,
+# so they are imported in the methods that need them to keep the start-up light.
 
 def create_example_scan():
     """Creates an example scan. Overwrites existing ones if any."""
@@ -44,7 +55,7 @@ Scanning session binds all relevant data of a scan into the directory structure.
 """
 class ScanningSession:
 
-    def __init__(self, session_name:str):
+    def __init__(self, session_name:str, cami=None):
         """Initializes new scanning session with given name.
 
         Creates a default directory (/scans/<session_name>) if it does not yet exist. If it
@@ -54,6 +65,9 @@ class ScanningSession:
         ----------
         session_name : str
             Name of the session either existing or a new one.
+        cami : optional
+            Camera interface to use instead of creating one with the backend
+            selected in core.camera_backends, e.g., a SimulatedCameraInterface.
         """
 
         self.session_name = session_name
@@ -68,9 +82,11 @@ class ScanningSession:
         self.cube_rfl_path = os.path.abspath(self.session_root + P.cube_reflectance_name + '.nc')
         self.cube_desmiled_lut_path = os.path.abspath(self.session_root + P.cube_desmiled_lut + '.nc')
         self.cube_desmiled_intr_path = os.path.abspath(self.session_root + P.cube_desmiled_intr + '.nc')
+        self.telemetry_path = os.path.abspath(self.session_root + P.telemetry_name + '.nc')
+        self.defect_map_path = os.path.abspath(self.session_root + P.defect_map_name + '.nc')
 
         # CameraInterface object
-        self._cami = None
+        self._cami = cami
         # Contents of the control file as a dictionary
         self.control = None
         # Dark reference frame
@@ -79,6 +95,8 @@ class ScanningSession:
         self.white = None
         # Light reference frame
         self.light = None
+        # Defective pixel map of full sensor frames
+        self.defect_map = None
 
         if self.session_exists():
             print(f"Found existing session '{session_name}'.")
@@ -101,6 +119,9 @@ class ScanningSession:
                 self.light = F.load_frame(self.light_path)
                 print("done")
 
+            if os.path.exists(self.defect_map_path):
+                self.defect_map = defect_pixels.load_defect_map(self.defect_map_path)
+
         else:
             print(f"Creating new session '{session_name}'")
             F.create_directory(self.session_root)
@@ -129,7 +150,7 @@ class ScanningSession:
         """Initialize CameraInterface if not initialized yet."""
 
         if self._cami is None:
-            self._cami = CameraInterface(self.camera_setting_path)
+            self._cami = camera_backends.create_camera_interface(self.camera_setting_path)
 
     def reload_settings(self):
         """Reload all settings.
@@ -147,7 +168,7 @@ class ScanningSession:
         """
 
         if self._cami is None:
-            self._cami = CameraInterface()
+            self._cami = camera_backends.create_camera_interface(self.camera_setting_path)
 
         # load and apply camera settings before scan settings so that
         # the scanning can be controlled by scan settings toml, which
@@ -213,10 +234,17 @@ class ScanningSession:
             logging.debug(f"Crop before starting to shoot {ref_type}:\n {self._cami.get_crop_meta_dict()}")
             old, _ = self._cami.crop(full=True)
             logging.debug(f"New crop:\n {self._cami.get_crop_meta_dict()}")
-            print(f"Shooting frame (avg of {P.dwl_default_count} with {self._cami.exposure():.1f} micro seconds.)")
-            ref_frame = self._cami.get_frame_opt(count=P.dwl_default_count, method=P.dwl_default_method)
+            count = self.control[P.ctrl_scan_settings].get(P.ctrl_reference_count, P.dwl_default_count)
+            method = self.control[P.ctrl_scan_settings].get(P.ctrl_reference_method, P.dwl_default_method)
+            print(f"Shooting frame ({method} of {count} with {self._cami.exposure():.1f} micro seconds.)")
+            ref_frame, stats = self._cami.get_frame_opt(count=count, method=method, return_statistics=True)
+            if ref_frame is None:
+                logging.error(f"Could not shoot {ref_type} frame. Existing {ref_type} frame was not changed.")
+                self._cami.crop(*old)
+                return
             meta_dict = self._cami.get_crop_meta_dict()
             ref_frame = F.save_frame(ref_frame, self.session_root + '/' + ref_type, meta_dict=meta_dict)
+            self._save_noise_map(ref_type, stats, meta_dict)
             self._cami.crop(*old)
             logging.debug(f"Reverted back to crop:\n {self._cami.get_crop_meta_dict()}")
             if ref_type == P.ref_dark_name:
@@ -225,10 +253,100 @@ class ScanningSession:
                 self.white = ref_frame
             if ref_type == P.ref_light_name:
                 self.light = ref_frame
+            if ref_type in (P.ref_dark_name, P.ref_white_name) and self.dark is not None:
+                self.build_defect_map()
             self._show_reference(ref_type)
         else:
             logging.error(f"Wrong reference type '{ref_type}'")
 
+    def _save_noise_map(self, ref_type:str, stats, meta_dict:dict):
+        """Save per-pixel noise map of a reference frame and print its summary.
+
+        The map is the temporal standard deviation of the frames the reference
+        was averaged from. It is saved next to the reference, e.g. 'dark_noise.nc'.
+        """
+
+        summary = stats.summary()
+        meta_dict = dict(meta_dict)
+        meta_dict.update(summary)
+        F.save_frame(stats.noise_map(), self.session_root + '/' + ref_type + P.noise_map_suffix,
+                     meta_dict=meta_dict, save_thumbnail=False)
+        print(f"Noise of {ref_type} frame over {summary['frames']} frames: mean std {summary['mean_std']:.3f}, "
+              f"max std {summary['max_std']:.3f}, noisy pixels {summary['noisy_fraction'] * 100:.3f} %.")
+
+    def build_defect_map(self) -> defect_pixels.DefectMap:
+        """Find defective pixels from dark frame, its noise map, and white frame, and save the map.
+
+        Called automatically after shooting dark or white frame. White frame
+        and the noise map are used if they exist.
+        """
+
+        if self.dark is None:
+            logging.warning(f"Cannot build a defect map without a dark frame.")
+            return None
+
+        dark_noise = None
+        dark_noise_path = self.session_root + P.ref_dark_name + P.noise_map_suffix
+        if os.path.exists(dark_noise_path + '.nc'):
+            dark_noise = F.load_frame(dark_noise_path)
+
+        defect_map = defect_pixels.find_defects(self.dark, dark_noise, self.white)
+        defect_map.print_summary()
+        if defect_map.fraction() > P.max_defect_fraction:
+            logging.warning(f"More than {P.max_defect_fraction * 100:.1f} % of the pixels seem defective. "
+                            f"Check dark and white frames. The defect map is not used.")
+            return None
+
+        self.defect_map = defect_map
+        self.defect_map.save(self.defect_map_path)
+        return self.defect_map
+
+    def _correct_defects(self, cube:Dataset) -> Dataset:
+        """Correct defective pixels of a cube cropped as dictated by the control file.
+
+        Does nothing if there is no defect map, correction is disabled in the control
+        file, or the cube has been corrected already. A cube that has been binned
+        cannot be corrected anymore, as its pixels mix defective and valid ones, so
+        it is left as it is with a warning.
+        """
+
+        if self.defect_map is None or not self.control[P.ctrl_scan_settings].get(P.ctrl_correct_defects, 1):
+            return cube
+        if P.meta_key_defects_corrected in cube.attrs:
+            return cube
+        x_factor, y_factor, _ = cm.binning_of(cube)
+        if x_factor > 1 or y_factor > 1:
+            logging.warning(f"Cannot correct defective pixels of a cube binned by {x_factor} (x) and "
+                            f"{y_factor} (y). Correct defects before binning. The cube was not corrected.")
+            return cube
+        cropped_map = self.defect_map.crop_to_control(self.control)
+        cube = cropped_map.correct(cube)
+        cube.attrs[P.meta_key_defects_corrected] = len(cropped_map)
+        return cube
+
+    def _bin_raw_cube(self, cube:Dataset) -> Dataset:
+        """Bin a freshly scanned cube as dictated by the control file."""
+
+        settings = self.control[P.ctrl_scan_settings]
+        x_factor = settings.get(P.ctrl_binning_x, 1)
+        y_factor = settings.get(P.ctrl_binning_y, 1)
+        method = settings.get(P.ctrl_binning_method, 'mean')
+        if x_factor == 1 and y_factor == 1:
+            return cube
+        print(f"Binning the raw cube by {x_factor} (x) and {y_factor} (y) using {method}")
+        return cm.bin_cube(cube, x_factor, y_factor, method)
+
+    def _save_pyramid(self, cube:Dataset, path):
+        """Append overview levels to a saved cube file if the control file says so."""
+
+        if not self.control[P.ctrl_scan_settings].get(P.ctrl_build_pyramids, 1):
+            return
+        levels = cube_pyramid.build_pyramid(cube)
+        if levels:
+            print(f"Saving {len(levels)} overview levels...", end=' ')
+            cube_pyramid.save_pyramid(levels, path)
+            print(f"done", end=' ')
+
     def _show_reference(self, ref_type: str):
         """General method to show any of the reference frames. """
 
@@ -240,6 +358,7 @@ class ScanningSession:
                 ref_frame = self.white
             if ref_type == P.ref_light_name:
                 ref_frame = self.light
+            import analysis.frame_inspector as fi
             fi.plot_frame(ref_frame)
         else:
             logging.error(f"Wrong reference type '{ref_type}'")
@@ -259,6 +378,7 @@ class ScanningSession:
         length = self.control[P.ctrl_scan_settings][P.ctrl_scanning_length_value]
         exposure_time_s = self.control[P.ctrl_scan_settings][P.ctrl_exporure_time_s]
         overhead = self.control[P.ctrl_scan_settings][P.ctrl_acquisition_overhead]
+        streaming = self.control[P.ctrl_scan_settings].get(P.ctrl_streaming_capture, 0)
 
         time_total = length / speed
         time_frame = exposure_time_s * (overhead + 1)
@@ -291,66 +411,144 @@ class ScanningSession:
             self._cami.turn_on()
             self._cami.exposure(exposure_time_s * 1e6)
             self._cami.crop(width, width_offset, height, height_offset, full=False)
-            frame_list = [None]*frame_count
-            frame_time_list = np.zeros((frame_count,), dtype=np.float64)
-            wait_time_list = np.zeros((frame_count,), dtype=np.float64)
-
-            # Get one frame before starting the loop as it will take more time
-            # than the rest. Probably because some initializations of the camera.
-            # This temporary frame will be overwritten in the loop.
-            frame_list[0] = self._cami.get_frame()
-
-            frame_list = [None]*frame_count
-            frame_time_list = np.zeros((frame_count,), dtype=np.float64)
-            wait_time_list = np.zeros((frame_count,), dtype=np.float64)
-
-            scan_start_time = time.perf_counter()
+            telemetry = ScanTelemetry(frame_count, time_frame, exposure_time_s, overhead)
             print(f"Scan start with exposure {self._cami.exposure()}")
 
-            for i in range(frame_count):
-                time_start = time.perf_counter()
-                f = self._cami.get_frame()
-                time_elapsed = (time.perf_counter() - time_start)
-                f.coords[P.dim_scan] = i
-                frame_list[i] = f.copy(deep=True)
-
-                wait_time = max(time_frame - time_elapsed, 0.0)
-                frame_time_list[i] = time_elapsed
-                wait_time_list[i] = wait_time
-
-                if wait_time > 0.:
-                    time.sleep(wait_time)
+            if streaming:
+                frame_list, scan_start_time = self._scan_streaming(frame_count, time_frame, telemetry)
+            else:
+                frame_list, scan_start_time = self._scan_frame_by_frame(frame_count, time_frame, telemetry)
 
             print("Scan done")
 
-            print(f"Total scan duration {((time.perf_counter() - scan_start_time)):.3f} s.")
+            telemetry.finish(time.perf_counter() - scan_start_time)
+            print(f"Total scan duration {telemetry.duration:.3f} s.")
+            telemetry.print_summary(rjust=rjust)
 
-            avg_frame_time = np.mean(frame_time_list)
-            std_frame_time = np.std(frame_time_list)
-            avg_wait_time = np.mean(wait_time_list)
-            std_wait_time = np.std(wait_time_list)
-            print(f"Average frame time was {avg_frame_time:.4f} (+- {std_frame_time:.6f}) s "
-                  f"while prior estimation was {time_frame:.4f} s.")
-            print(f"Average wait time was {avg_wait_time:.4f} (+- {std_wait_time:.6f}) s ")
-
-            if avg_frame_time < time_frame * 0.9:
+            avg_frame_time = telemetry.summary()['latency_mean']
+            # Zero if latencies are not known, e.g. streamed without hardware timestamps.
+            if 0 < avg_frame_time < time_frame * 0.9:
                 print(f"More than 10 % idle time. Consider reducing the "
                       f"'{P.ctrl_acquisition_overhead}' percentage.")
             elif avg_frame_time > time_frame * 1.1:
                 print(f"Estimated frame time exceeded by more than 10 %. "
                       f"Consider increasing the '{P.ctrl_acquisition_overhead}' percentage.")
 
-            # Plot exposure times for fun
-            plt.plot(frame_time_list)
-            plt.show()
+            telemetry.save(self.telemetry_path)
+            frame_list = [f for f in frame_list if f is not None]
 
             print("Saving the raw cube")
             frames = xr.concat(frame_list, dim=P.dim_scan)
             raw_cube = xr.Dataset(data_vars={P.naming_cube_data: frames})
+            raw_cube = self._correct_defects(raw_cube)
+            raw_cube = self._bin_raw_cube(raw_cube)
             F.save_cube(raw_cube, self.cube_raw_path)
+            self._save_pyramid(raw_cube, self.cube_raw_path)
             print("Cube saved")
             self._cami.turn_off()
 
+    def _scan_frame_by_frame(self, frame_count, time_frame, telemetry):
+        """Acquire frames one by one waiting between frames to keep the frame rate.
+
+        Returns
+        -------
+            frame_list : list
+                Acquired frames. Dropped frames are None.
+            scan_start_time : float
+                Start time of the scan from time.perf_counter().
+        """
+
+        # Get one frame before starting the loop as it will take more time
+        # than the rest. Probably because some initializations of the camera.
+        self._cami.get_frame()
+
+        frame_list = [None]*frame_count
+        scan_start_time = time.perf_counter()
+
+        for i in range(frame_count):
+            time_start = time.perf_counter()
+            deadline_error = time_start - (scan_start_time + i * time_frame)
+            f = self._cami.get_frame()
+            time_elapsed = (time.perf_counter() - time_start)
+            dropped = f is None
+            frame_bytes = 0
+            if not dropped:
+                f.coords[P.dim_scan] = i
+                frame_list[i] = f.copy(deep=True)
+                frame_bytes = frame_list[i].nbytes
+
+            wait_time = max(time_frame - time_elapsed, 0.0)
+            telemetry.record(i, time_elapsed, wait_time, deadline_error,
+                             bytes_written=frame_bytes, dropped=dropped)
+
+            if wait_time > 0.:
+                time.sleep(wait_time)
+
+        return frame_list, scan_start_time
+
+    def _scan_streaming(self, frame_count, time_frame, telemetry):
+        """Acquire frames from a continuous stream of the camera.
+
+        The camera frame rate is set to match the scan if the camera supports it.
+        Frames arriving before their time slot are skipped and time slots that pass
+        without a frame are recorded as dropped frames. The capture latency of a frame
+        is recorded as the time since the previous frame of the sensor, from the
+        hardware timestamps of the camera. It is recorded as 0 (unknown) for the first
+        frame and if the camera gives no timestamps.
+
+        Returns
+        -------
+            frame_list : list
+                Acquired frames. Dropped frames are None.
+            scan_start_time : float
+                Arrival time of the first frame from time.perf_counter().
+        """
+
+        try:
+            self._cami.frame_rate(1 / time_frame)
+        except Exception as e:
+            logging.warning(f"Could not set camera frame rate: {e}")
+
+        frame_list = [None]*frame_count
+        scan_start_time = None
+        last_timestamp = None
+        i = 0
+        stream = self._cami.stream()
+        try:
+            for f in stream:
+                arrival = time.perf_counter()
+                if scan_start_time is None:
+                    scan_start_time = arrival
+                # Time the sensor took for this frame, including frames skipped below.
+                timestamp = float(f.coords['timestamp']) if 'timestamp' in f.coords else None
+                frame_interval = timestamp - last_timestamp if None not in (timestamp, last_timestamp) else 0.0
+                last_timestamp = timestamp
+                deadline = scan_start_time + i * time_frame
+                # The sensor may run faster than needed.
+                if arrival < deadline - 0.5 * time_frame:
+                    continue
+
+                missed_slots = min(int((arrival - deadline) // time_frame), frame_count - i)
+                for _ in range(missed_slots):
+                    telemetry.record(i, 0.0, 0.0, arrival - (scan_start_time + i * time_frame), dropped=True)
+                    i += 1
+                if i >= frame_count:
+                    break
+
+                f.coords[P.dim_scan] = i
+                frame_list[i] = f.copy(deep=True)
+                telemetry.record(i, frame_interval, 0.0, arrival - (scan_start_time + i * time_frame),
+                                 bytes_written=frame_list[i].nbytes)
+                i += 1
+                if i >= frame_count:
+                    break
+        finally:
+            stream.close()
+
+        if scan_start_time is None:
+            scan_start_time = time.perf_counter()
+        return frame_list, scan_start_time
+
     def _crop(self, width=None, width_offset=None, height=None, height_offset=None, full=False):
         """Set the cropping of the camera. No need to access this directly. """
 
@@ -378,9 +576,17 @@ class ScanningSession:
 
             print(f"Default control file created.")
 
-    def make_reflectance_cube(self) -> Dataset:
+    def make_reflectance_cube(self, x_factor=1, y_factor=1, method='mean') -> Dataset:
         """ Makes a reflectance cube out of a raw cube and saves onto disk.
 
+        Parameters
+        ----------
+            x_factor, y_factor : int, default 1
+                Optional spectral and spatial binning of the raw cube on top of
+                the binning done in acquisition.
+            method : str, default 'mean'
+                Binning method, either 'mean' or 'sum'.
+
         Returns
         -------
             Dataset
@@ -388,14 +594,60 @@ class ScanningSession:
         """
 
         org = F.load_cube(self.cube_raw_path)
+        org = self._correct_defects(org)
+        dark = self.dark
+        white = self.white
+        if self.defect_map is not None and self.control[P.ctrl_scan_settings].get(P.ctrl_correct_defects, 1):
+            dark = self.defect_map.correct(dark) if dark is not None else None
+            white = self.defect_map.correct(white) if white is not None else None
 
-        rfl = cm.make_reflectance_cube(org, self.dark, self.white, self.control)
+        rfl = cm.make_reflectance_cube(org, dark, white, self.control, x_factor, y_factor, method)
 
         print(f"Saving reflectance cube to {self.cube_rfl_path}...", end=' ')
         F.save_cube(rfl, self.cube_rfl_path)
+        self._save_pyramid(rfl, self.cube_rfl_path)
         print(f"done")
         return rfl
 
+    def propose_line_positions(self, update_control=False) -> list:
+        """Locate the brightest spectral lines of the light frame and propose them as spectral line positions.
+
+        Parameters
+        ----------
+            update_control : bool, default False
+                If True, the positions are written into the control file. Other content
+                of the file, including comments, is kept as it is.
+
+        Returns
+        -------
+            list
+                Proposed positions in full sensor x-coordinates, or None if there is no light frame.
+        """
+
+        if self.light is None:
+            logging.warning(f"Light data does not exist. Shoot one using ui.shoot_light().")
+            return None
+
+        values = self.light[P.naming_frame_data].transpose(*P.dim_order_frame).values
+        lines = line_locator.find_lines(values)
+        entry = line_locator.format_positions(lines)
+        print(f"Proposed spectral line positions: {entry}")
+
+        if update_control and len(lines) > 0:
+            with open(self.scan_settings_path, 'r') as file:
+                content = file.read()
+            content, n = re.subn(rf"^(\s*){P.ctrl_positions}\s*=\s*\[[^\]]*\]", rf"\g<1>{entry}",
+                                 content, flags=re.MULTILINE)
+            if n == 1:
+                with open(self.scan_settings_path, 'w') as file:
+                    file.write(content)
+                self.load_control_file()
+                print(f"Control file updated.")
+            else:
+                logging.warning(f"Could not find a unique '{P.ctrl_positions}' entry in the control file. "
+                                f"Not updated.")
+        return sorted(int(p) for p in lines)
+
     def make_shift_matrix(self):
         """Make shift matrix and save it to disk.
 
@@ -425,6 +677,7 @@ class ScanningSession:
         light_ds = self.light.isel({P.dim_x: slice(width_offset, width_offset + width),
                                   P.dim_y: slice(height_offset, height_offset + height)})
         light_frame = light_ds[P.naming_frame_data]
+        from core import smile_correction as sc
         bp = sc.construct_bandpass_filter(light_frame, positions, bandpass_width)
         sl_list = sc.construct_spectral_lines(light_frame, positions, bp, peak_width=peak_width)
         shift_matrix = sc.construct_shift_matrix(sl_list, light_frame[P.dim_x].size, light_frame[P.dim_y].size)
@@ -464,6 +717,8 @@ class ScanningSession:
             logging.info(f"Generating new shift matrix for desmiling.")
             shift, _ = self.make_shift_matrix()
 
+        import matplotlib.pyplot as plt
+        from core import smile_correction as sc
         print("This how your shift matrix looks like. Close the window to continue.")
         shift.plot()
         plt.show()
@@ -480,6 +735,11 @@ class ScanningSession:
         else:
             rfl = source_cube
 
+        x_factor, y_factor, _ = cm.binning_of(rfl)
+        if x_factor > 1 or y_factor > 1:
+            # Shifts are in pixels, so they scale down with spectral binning.
+            shift = cm.bin_cube(shift, x_factor, y_factor, 'mean') / x_factor
+
         print(f"Desmiling with {cube_type} shifts...", end=' ')
         desmiled = rfl.copy(deep=True)
         del rfl
@@ -488,9 +748,100 @@ class ScanningSession:
 
         print(f"Saving desmiled cube to {save_path}...", end=' ')
         F.save_cube(desmiled, save_path)
+        self._save_pyramid(desmiled, save_path)
         print(f"done")
         return desmiled
 
+    def make_index_images(self, names=None, force_raw_cube=False) -> dict:
+        """Compute named band indices of the control file and save them as images of the session.
+
+        Each index is saved as a frame named P.band_math_file_prefix + name, e.g. 'index_ndvi.nc',
+        with its expression in the attributes.
+
+        Parameters
+        ----------
+            names : list of str, optional
+                Names of the indices in the control file to compute. All by default.
+            force_raw_cube: bool
+                If true, the reflectance cube is not used even is it exists.
+
+        Returns
+        -------
+            dict
+                Index images as DataArrays (scan_index, y) by name.
+        """
+
+        self.load_control_file()
+        named = self.control.get(P.ctrl_band_indices, {})
+        if names is None:
+            names = list(named)
+        unknown = [name for name in names if name not in named]
+        if unknown:
+            raise ValueError(f"Band indices {unknown} are not defined in the control file.")
+
+        if os.path.exists(self.cube_rfl_path) and not force_raw_cube:
+            cube, viewable = F.load_cube(self.cube_rfl_path), P.naming_reflectance
+        else:
+            cube, viewable = F.load_cube(self.cube_raw_path), P.naming_cube_data
+
+        # Several indices share the prefix-sum index.
+        engine = BandMath(cube, viewable, use_index=len(names) > 1, named=named)
+        images = {}
+        for name in names:
+            print(f"Computing band index '{name}'", end='...')
+            image = xr.DataArray(engine.evaluate(name), dims=(P.dim_scan, P.dim_y),
+                                 coords={P.dim_scan: cube[P.dim_scan], P.dim_y: cube[P.dim_y]}, name=name)
+            F.save_frame(image, self.session_root + P.band_math_file_prefix + name, meta_dict={'expression': named[name]})
+            images[name] = image
+            print("done")
+        return images
+
+    def unmix(self, endmembers, method=unmixing.FCLS, force_raw_cube=False, processes=False) -> Dataset:
+        """Estimate endmember abundances of every pixel of the cube and save them with the residuals.
+
+        Parameters
+        ----------
+            endmembers : DataArray or numpy array
+                Endmember spectra (endmembers, bands). Names of the endmembers are kept
+                if a DataArray has coordinates along the endmember dimension.
+            method : str, default FCLS
+                unmixing.FCLS (abundances sum to one) or unmixing.NNLS (non-negative only).
+            force_raw_cube: bool
+                If true, the reflectance cube is not used even is it exists.
+            processes : bool, default False
+                Solve chunks in a process pool instead of a thread pool.
+
+        Returns
+        -------
+            Dataset
+                Abundances (scan_index, y, endmember) and root mean square residuals
+                (scan_index, y), saved as 'abundances.nc' in the session directory.
+        """
+
+        if os.path.exists(self.cube_rfl_path) and not force_raw_cube:
+            cube, viewable = F.load_cube(self.cube_rfl_path), P.naming_reflectance
+        else:
+            cube, viewable = F.load_cube(self.cube_raw_path), P.naming_cube_data
+
+        print(f"Unmixing the cube with {method.upper()}", end='...')
+        abundances, residual = unmixing.unmix(cube, endmembers, viewable, method=method, processes=processes)
+        print("done")
+
+        coords = {P.dim_scan: cube[P.dim_scan], P.dim_y: cube[P.dim_y]}
+        names = [d for d in getattr(endmembers, 'dims', ()) if d != P.dim_x]
+        if names and names[0] in endmembers.coords:
+            coords[P.dim_endmember] = endmembers[names[0]].values
+        result = xr.Dataset({
+            P.naming_abundance: ((P.dim_scan, P.dim_y, P.dim_endmember), abundances),
+            P.naming_residual: ((P.dim_scan, P.dim_y), residual),
+        }, coords=coords, attrs={'method': method})
+
+        save_path = os.path.abspath(self.session_root + P.abundances_name + '.nc')
+        print(f"Saving abundances to {save_path}...", end=' ')
+        F.save_cube(result, save_path)
+        print(f"done")
+        return result
+
     def show_cube(self, force_raw_cube=False):
         """Start the CubeInspector for inspecting the scanned cube.
 
@@ -505,23 +856,29 @@ class ScanningSession:
         """
         try:
             if os.path.exists(self.cube_rfl_path) and not force_raw_cube:
-                target_cube = F.load_cube(self.cube_rfl_path)
+                target_path = self.cube_rfl_path
                 viewable = P.naming_reflectance
             elif os.path.exists(self.cube_raw_path):
-                target_cube = F.load_cube(self.cube_raw_path)
+                target_path = self.cube_raw_path
                 viewable = P.naming_cube_data
             else:
                 raise RuntimeError(f"No source cube to show.")
+            target_cube = F.load_cube(target_path)
+            pyramids = [cube_pyramid.load_pyramid(target_path)]
             if os.path.exists(self.cube_desmiled_lut_path):
                 target_cube_2 = F.load_cube(self.cube_desmiled_lut_path)
+                pyramids.append(cube_pyramid.load_pyramid(self.cube_desmiled_lut_path))
             else:
                 target_cube_2 = None
-            if os.path.exists(self.cube_desmiled_lut_path):
+            if os.path.exists(self.cube_desmiled_intr_path):
                 target_cube_3 = F.load_cube(self.cube_desmiled_intr_path)
+                pyramids.append(cube_pyramid.load_pyramid(self.cube_desmiled_intr_path))
             else:
                 target_cube_3 = None
 
-            ci = CubeInspector(target_cube, target_cube_2, target_cube_3, viewable=viewable, session_name=self.session_name)
+            from analysis.cube_inspector import CubeInspector
+            ci = CubeInspector(target_cube, target_cube_2, target_cube_3, viewable=viewable, session_name=self.session_name,
+                               pyramids=pyramids)
             ci.show()
         except FileNotFoundError as fnf:
             logging.error(fnf)
@@ -533,15 +890,22 @@ class ScanningSession:
     def show_shift(self):
         """Shows the shift matrix of the session."""
 
+        import matplotlib.pyplot as plt
         s = F.load_shit_matrix(self.shift_path)
         s.plot()
         plt.show()
 
+    def show_telemetry(self):
+        """Prints the telemetry summary of the latest scan of the session."""
+
+        load_telemetry(self.telemetry_path).print_summary()
+
     def show_light(self):
         """Shows the light reference of the session."""
 
         self.reload_settings()
         shift, sl = self.make_shift_matrix()
+        import analysis.frame_inspector as fi
         fi.plot_frame(self.light, spectral_lines=sl, plot_circ_fit=True, plot_fit_points=True, control=self.control)
 
     def exposure(self, value=None) -> int:
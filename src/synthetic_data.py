@@ -82,18 +82,26 @@ key_tilt_measured_mean = 'measured_mean_tilt'
 #     # plt.show()
 #     F.save_frame(frame, example_spectrogram_path)
 
-def make_undistorted_and_dark_frame():
-    """Creates an example of undistorted frame and dark frame to examples directory.
+def generate_undistorted_frame(add_noise=True):
+    """Generates an undistorted full sensor sized frame in memory.
 
-    Created frame is "full sensor size" where the area illuminated by the slit
-    is centered vertically. Use global variables 'row_noise_fac' and 'random_noise_fac'
-    to control the level of added random noise.
+    The area illuminated by the slit is centered vertically. Use global variables
+    'row_noise_fac' and 'random_noise_fac' to control the level of added random noise.
 
-    Frame data follows closely to the form that camazing uses in the frames it provides.
-    Attributes are omitted though.
+    Parameters
+    ----------
+        add_noise: bool, default True
+            If False, only the row-wise multiplicative noise is applied and the random
+            additive noise is left out. Used by the simulated camera, which adds its own noise.
+
+    Returns
+    -------
+        frame: xarray DataArray
+            The generated frame.
+        rando: numpy array
+            The random additive noise added to the frame. Zeros if add_noise is False.
     """
 
-    print(f"Generating frame example to '{undistorted_frame_path}'...", end='')
     source = F.load_frame(example_spectrogram_path)
     height = slit_height
     width = source[P.naming_frame_data][P.dim_x].size
@@ -113,8 +121,11 @@ def make_undistorted_and_dark_frame():
     full_sensor = full_sensor * rand_row[:, None]
 
     # Add random noise
-    rando = np.random.uniform(0, random_noise_fac * max_pixel_val, size=(sensor_height, width))
-    full_sensor = full_sensor + rando
+    if add_noise:
+        rando = np.random.uniform(0, random_noise_fac * max_pixel_val, size=(sensor_height, width))
+        full_sensor = full_sensor + rando
+    else:
+        rando = np.zeros_like(full_sensor)
 
     coords = {
         P.dim_x: (P.dim_x, np.arange(0, source[P.naming_frame_data][P.dim_x].size) + 0.5),
@@ -128,6 +139,23 @@ def make_undistorted_and_dark_frame():
         dims=dims,
         coords=coords,
     )
+    return frame, rando
+
+def make_undistorted_and_dark_frame():
+    """Creates an example of undistorted frame and dark frame to examples directory.
+
+    Created frame is "full sensor size" where the area illuminated by the slit
+    is centered vertically. Use global variables 'row_noise_fac' and 'random_noise_fac'
+    to control the level of added random noise.
+
+    Frame data follows closely to the form that camazing uses in the frames it provides.
+    Attributes are omitted though.
+    """
+
+    print(f"Generating frame example to '{undistorted_frame_path}'...", end='')
+    frame, rando = generate_undistorted_frame()
+    coords = frame.coords
+    dims = frame.dims
 
     # frame_inspector.plot_frame(frame)
     F.save_frame(frame, undistorted_frame_path)
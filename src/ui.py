@@ -9,16 +9,10 @@ Most of the commands expect that there exists a scanning session to connect the
 Scanning sessions are bound to folder "/scans/<scan_name>".
 
 """
-from core.camera_interface  import CameraInterface
-
 from imaging.scanning_session import ScanningSession
 from imaging import scanning_session as scanning_session
-import analysis.frame_inspector as frame_inspector
 from core import properties as P
 from utilities import file_handling as F
-from imaging.preview import Preview
-
-import synthetic_data as synthetic
 
 import logging
 
@@ -83,6 +77,10 @@ class UI:
     def start_preview(self):
         """Starts a new preview for inspecting the camera feed."""
 
+        # Imported here to keep the start-up light. The camera driver is imported
+        # only when the camera is created (see core.camera_backends).
+        from imaging.preview import Preview
+
         camera_settings_path = None
         if self.sc:
             camera_settings_path = self.sc.camera_setting_path
@@ -163,11 +161,15 @@ class UI:
         You can use "synthetic_data.py"'s own methods to generate just some of the examples.
         """
 
+        import synthetic_data as synthetic
+
         synthetic.generate_all_examples()
 
     def show_examples(self):
         """Shows all available examples. """
 
+        import synthetic_data as synthetic
+
         synthetic.show_frame_examples()
         synthetic.show_cube_examples()
 
@@ -188,6 +190,22 @@ class UI:
         else:
             logging.warning(f"No active scanning session exists. Cannot desmile a cube.")
 
+    def make_index_images(self, names=None):
+        """Compute band indices named in the control file and save them as images of the session."""
+
+        if self.sc is not None:
+            return self.sc.make_index_images(names)
+        else:
+            logging.warning(f"No active scanning session exists. Cannot compute band indices.")
+
+    def unmix(self, endmembers, method='fcls'):
+        """Estimate endmember abundances of the cube of current session and save them with residuals."""
+
+        if self.sc is not None:
+            return self.sc.unmix(endmembers, method)
+        else:
+            logging.warning(f"No active scanning session exists. Cannot unmix a cube.")
+
     def show_cube(self):
         """Start the CubeInspector."""
 
@@ -204,6 +222,30 @@ class UI:
         else:
             logging.warning(f"No active scanning session exists. Cannot show the shift matrix.")
 
+    def show_telemetry(self):
+        """Show timing summary of the latest scan. Useful for tuning the acquisition overhead."""
+
+        if self.sc is not None:
+            self.sc.show_telemetry()
+        else:
+            logging.warning(f"No active scanning session exists. Cannot show scan telemetry.")
+
+    def build_defect_map(self):
+        """Rebuild the defective pixel map of current session from its dark and white frames."""
+
+        if self.sc is not None:
+            self.sc.build_defect_map()
+        else:
+            logging.warning(f"No active scanning session exists. Cannot build a defect map.")
+
+    def propose_line_positions(self, update_control=False):
+        """Locate spectral lines of the light frame and propose positions for the control file."""
+
+        if self.sc is not None:
+            return self.sc.propose_line_positions(update_control)
+        else:
+            logging.warning(f"No active scanning session exists. Cannot locate spectral lines.")
+
     def show_light(self):
         """Show light reference frame to see how well the arc fits fit."""
 
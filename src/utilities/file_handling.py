@@ -6,11 +6,9 @@ This file contains file handling for frames, cubes, etc.
 import os
 import logging
 from core import properties as P
-from utilities import plotting
 import xarray as xr
 from xarray import DataArray
 from xarray import Dataset
-import matplotlib.pyplot as plt
 
 import toml
 from toml import TomlDecodeError
@@ -82,6 +80,9 @@ def save_frame(frame:DataArray, path, meta_dict=None, save_thumbnail=True):
     if save_thumbnail:
         thumb_path = os.path.abspath(path_s.rstrip('.nc') + '.png')
         logging.info(f"Saving thumbnail to '{abs_path}'")
+        # Imported here, as only thumbnails need matplotlib.
+        import matplotlib.pyplot as plt
+        from utilities import plotting
         fig,ax = plt.subplots(figsize=plotting.get_figure_size())
         ax.imshow(frame, origin='lower')
         fig.savefig(thumb_path)
@@ -6,6 +6,7 @@ but ofcource we have no time for such undertaking.
 """
 
 import matplotlib
+import matplotlib.pyplot as plt
 
 def get_figure_size():
     """Hard-coded figure size. Pretty stupid, really.
@@ -33,7 +34,8 @@ def getColorList(length, map_name='hsv', portion=1.0):
         A list of colors of length length.
     """
     
-    cm = matplotlib.cm.get_cmap(map_name)
+    # pyplot.get_cmap is available in old and new matplotlib versions, unlike matplotlib.cm.get_cmap.
+    cm = plt.get_cmap(map_name)
 
     colors = []
     stride = portion / length